@@ -0,0 +1,302 @@
+"""
+bench_load.py
+user: vhao
+date: 10-17-2026
+
+Load benchmark which drives launch_scanners against the local fake TTP
+server (see fake_ttp_server.py) with thousands of locations, and reports
+requests/sec, the time from a slot appearing to the user being notified
+about it, and the scanner's CPU time and peak memory.
+
+The fake server runs in a child process so its CPU and memory are not
+counted against the scanner. Notifications are recorded instead of sent, and
+seen appointments go to a temporary directory.
+
+Run from src/:
+    python -m benchmarks.bench_load --locations 2000 --duration 120
+    python -m benchmarks.bench_load --error-rate 0.05 --throttle-rate 0.05
+    python -m benchmarks.bench_load --fetch windowed
+"""
+
+from typing import Dict, List, Tuple
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.fake_ttp_server import (
+    SLOTS_PATH,
+    SYNTH_DAYS,
+    SYNTH_START,
+    load_timeline,
+    make_timeline,
+    save_timeline,
+)
+from datetime import timedelta
+from scanner_logger import ROOT_LOGGER_NAME
+from scanner_matcher import AppointmentMatcher
+from scanner_notifier import NotificationDispatcher, NotificationSender
+from scanner_seen_store import (
+    FileSeenAppointmentStore,
+    StorageSeenAppointmentStore,
+)
+from scanner_storage import FileStorageBackend, SqliteStorageBackend
+from scanner_transport import create_transport
+from scanner_types import Finding, LocationOptions, TwilioOptions, UserOptions
+
+
+class RecordingSender(NotificationSender):
+    channel = "email"
+
+    def __init__(self):
+        # Maps (locationId, "%Y-%m-%d %H:%M") to when it was first delivered
+        self.delivered: Dict[Tuple[int, str], float] = {}
+
+    # The findings travel through the body so that send knows what it sent
+    def format(self, findings: List[Finding]) -> Tuple[str, str]:
+        return "", json.dumps([
+            [finding.locationId, finding.appointments] for finding in findings
+        ])
+
+    async def send(self, recipient: str, subject: str, body: str) -> None:
+        now = time.time()
+        for locationId, appointments in json.loads(body):
+            for appointment in appointments:
+                self.delivered.setdefault((locationId, appointment), now)
+
+
+def make_user_options(
+    timeline: dict,
+    num_users: int,
+    refresh_time: float,
+) -> List[UserOptions]:
+    # Matches every synthetic slot
+    matcher = AppointmentMatcher.from_date_ranges(
+        [{
+            "startDate": SYNTH_START.strftime("%Y-%m-%d"),
+            "endDate": (
+                SYNTH_START + timedelta(days=SYNTH_DAYS)
+            ).strftime("%Y-%m-%d"),
+            "dailyStartTime": "00:00",
+            "dailyEndTime": "23:59",
+        }],
+        "%Y-%m-%d %H:%M",
+    )
+    location_options_list = [
+        LocationOptions(location["id"], location["name"], matcher)
+        for location in timeline["locations"]
+    ]
+    return [
+        UserOptions(
+            email=f"user{i}@example.com",
+            phoneNumber="",
+            twilioOptions=TwilioOptions("", "", ""),
+            locationOptionsList=location_options_list[i::num_users],
+            userId=str(i) if num_users > 1 else "",
+            refreshTime=refresh_time,
+        )
+        for i in range(num_users)
+    ]
+
+
+def start_server(args, timeline_path: str, start_at: float):
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "benchmarks.fake_ttp_server", "serve",
+            "--timeline", timeline_path,
+            "--port", str(args.port),
+            "--start-at", str(start_at),
+            "--latency-ms", str(args.latency_ms),
+            "--jitter-ms", str(args.jitter_ms),
+            "--throttle-rate", str(args.throttle_rate),
+            "--error-rate", str(args.error_rate),
+            "--seed", str(args.seed),
+        ] + (["--etag"] if args.etag else []),
+        cwd=src_dir,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    # Wait until it is listening
+    server.stdout.readline()
+    return server
+
+
+async def get_server_stats(base_url: str) -> dict:
+    transport = create_transport()
+    try:
+        return (await transport.get(base_url + "/stats")).json()
+    finally:
+        await transport.close()
+
+
+async def run_scanners(args, user_options_list, base_url: str, start_at):
+    import scanner_utils
+
+    await asyncio.sleep(max(start_at - time.time(), 0))
+    task = asyncio.create_task(scanner_utils.launch_scanners(
+        user_options_list,
+        scheduler_api=base_url + SLOTS_PATH,
+        transport=create_transport(max_in_flight=args.max_in_flight),
+        requests_per_second=args.rps,
+    ))
+    done, _ = await asyncio.wait([task], timeout=args.duration)
+    if task in done:
+        # Every scanner gave up, which is a result too
+        task.result()
+    else:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+# Returns the slot to notification latencies, and how many slots appeared
+def summarize(
+    timeline: dict,
+    sender: RecordingSender,
+    start_at: float,
+    duration: float,
+) -> Tuple[List[float], int]:
+    latencies = []
+    appeared = 0
+    for locationId, slots in timeline["slots"].items():
+        for timestamp, appear_at, _ in slots:
+            # Slots available from the start only measure the first poll
+            if appear_at <= 0 or appear_at >= duration:
+                continue
+            appeared += 1
+            appointment = timestamp.replace("T", " ")
+            delivered = sender.delivered.get((int(locationId), appointment))
+            if delivered is not None:
+                latencies.append(delivered - (start_at + appear_at))
+    return latencies, appeared
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct), len(samples) - 1)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--locations", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--refresh-time", type=float, default=30)
+    parser.add_argument("--rps", type=float, default=200,
+                        help="Scheduler request budget")
+    parser.add_argument("--max-in-flight", type=int, default=50)
+    parser.add_argument("--churn", type=float, default=1,
+                        help="New slots per location per minute")
+    parser.add_argument("--timeline", default=None,
+                        help="Replay this timeline instead of a synthetic one")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--etag", action="store_true")
+    parser.add_argument("--fetch", choices=["soonest", "windowed"],
+                        default=None, help="Overrides SLOTS_FETCH")
+    parser.add_argument("--storage", choices=["file", "sqlite"],
+                        default=None,
+                        help="Keeps seen appointments in a storage backend")
+    parser.add_argument("--digest-window", type=float, default=0)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    import scanner_utils
+
+    logging.getLogger(ROOT_LOGGER_NAME).setLevel(args.log_level)
+    if args.fetch:
+        scanner_utils.SLOTS_FETCH = args.fetch
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.timeline:
+            timeline = load_timeline(args.timeline)
+            timeline_path = args.timeline
+        else:
+            timeline = make_timeline(
+                args.locations, args.duration, churn=args.churn, seed=args.seed
+            )
+            timeline_path = os.path.join(tmp_dir, "timeline.json")
+            save_timeline(timeline, timeline_path)
+
+        if args.storage == "file":
+            scanner_utils.seen_store = StorageSeenAppointmentStore(
+                FileStorageBackend(os.path.join(tmp_dir, "seen"))
+            )
+        elif args.storage == "sqlite":
+            scanner_utils.seen_store = StorageSeenAppointmentStore(
+                SqliteStorageBackend(
+                    "seen", os.path.join(tmp_dir, "seen.sqlite3")
+                )
+            )
+        else:
+            scanner_utils.seen_store = FileSeenAppointmentStore(
+                os.path.join(tmp_dir, "seen.json"),
+                os.path.join(tmp_dir, "seen.log"),
+            )
+        sender = RecordingSender()
+        scanner_utils.notification_dispatcher = NotificationDispatcher(
+            digest_window=args.digest_window,
+            min_interval=0,
+            batch=lambda: scanner_utils.seen_store.batch(),
+        )
+        scanner_utils.notification_dispatcher.set_sender(sender)
+        user_options_list = make_user_options(
+            timeline, args.users, args.refresh_time
+        )
+
+        base_url = f"http://127.0.0.1:{args.port}"
+        start_at = time.time() + 1
+        server = start_server(args, timeline_path, start_at)
+        try:
+            usage_before = resource.getrusage(resource.RUSAGE_SELF)
+            asyncio.run(
+                run_scanners(args, user_options_list, base_url, start_at)
+            )
+            usage_after = resource.getrusage(resource.RUSAGE_SELF)
+            stats = asyncio.run(get_server_stats(base_url))
+        finally:
+            server.terminate()
+            server.wait()
+
+    elapsed = min(stats["elapsed"], args.duration)
+    cpu = (
+        usage_after.ru_utime - usage_before.ru_utime
+        + usage_after.ru_stime - usage_before.ru_stime
+    )
+    latencies, appeared = summarize(timeline, sender, start_at, elapsed)
+    print(
+        f"{len(timeline['locations'])} locations, {args.users} user(s), "
+        f"{elapsed:.0f}s at refreshTime {args.refresh_time:.0f}s"
+    )
+    print(f"{'requests':<16}{stats['requests']:>10}")
+    print(f"{'requests/sec':<16}{stats['requests'] / elapsed:>10.1f}")
+    print(f"{'statuses':<16}{json.dumps(stats['statuses']):>10}")
+    if latencies:
+        print(
+            f"{'slot->notify':<16}{statistics.median(latencies):>9.2f}s "
+            f"median, {percentile(latencies, 0.95):.2f}s p95, "
+            f"{max(latencies):.2f}s max ({len(latencies)}/{appeared} new "
+            "slots notified)"
+        )
+    else:
+        print(f"{'slot->notify':<16}{'n/a':>10}")
+    print(f"{'cpu':<16}{cpu:>9.2f}s ({cpu / elapsed:.1%} of one core)")
+    print(
+        f"{'peak rss':<16}"
+        f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:>8.1f}MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+bench_matcher.py
+user: vhao
+date: 10-17-2026
+
+Micro-benchmark comparing AppointmentMatcher against the previous per-day
+dateToTimeRanges matcher on 100-slot /slots payloads.
+
+Run from src/:
+    python -m benchmarks.bench_matcher
+"""
+
+from typing import Dict, List, Set, Tuple
+
+import argparse
+import random
+import sys
+import timeit
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+from scanner_matcher import AppointmentMatcher
+
+
+DTFMT = "%Y-%m-%d %H:%M"
+
+
+def make_date_ranges(
+    start: datetime,
+    days: int,
+    num_ranges: int,
+) -> List[dict]:
+    date_ranges = []
+    span = max(days // num_ranges, 1)
+    for i in range(num_ranges):
+        first = start + timedelta(days=i * span)
+        last = first + timedelta(days=span - 1)
+        date_ranges.append({
+            "startDate": first.strftime("%Y-%m-%d"),
+            "endDate": last.strftime("%Y-%m-%d"),
+            "dailyStartTime": "08:00" if i % 2 else "17:00",
+            "dailyEndTime": "12:00" if i % 2 else "21:30",
+        })
+    return date_ranges
+
+
+def make_payload(start: datetime, days: int, slots: int) -> List[dict]:
+    rng = random.Random(0)
+    minutes = sorted(rng.randrange(days * 24 * 4) * 15 for _ in range(slots))
+    return [
+        {
+            "locationId": 5320,
+            "startTimestamp": (
+                start + timedelta(minutes=m)
+            ).strftime("%Y-%m-%dT%H:%M"),
+            "endTimestamp": (
+                start + timedelta(minutes=m + 15)
+            ).strftime("%Y-%m-%dT%H:%M"),
+            "active": True,
+            "duration": 15,
+            "remoteInd": False,
+        }
+        for m in minutes
+    ]
+
+
+# The dateToTimeRanges structure previously built by get_user_options
+def build_legacy(
+    date_ranges: List[dict],
+) -> Dict[str, List[Tuple[datetime, datetime]]]:
+    date_to_time_ranges = defaultdict(list)
+    for date_range in date_ranges:
+        date = datetime.strptime(date_range["startDate"], "%Y-%m-%d")
+        end_date = datetime.strptime(date_range["endDate"], "%Y-%m-%d")
+        while date <= end_date:
+            date_str = date.strftime("%Y-%m-%d")
+            start_time = datetime.strptime(
+                date_str + " " + date_range["dailyStartTime"], DTFMT)
+            end_time = datetime.strptime(
+                date_str + " " + date_range["dailyEndTime"], DTFMT)
+            date_to_time_ranges[date_str].append((start_time, end_time))
+            date += timedelta(days=1)
+    return date_to_time_ranges
+
+
+# The matching loop previously inlined in scan()
+def legacy_filter(
+    date_to_time_ranges: Dict[str, List[Tuple[datetime, datetime]]],
+    available_appointments: List[dict],
+) -> Set[str]:
+    valid_appointments = set()
+    for appointment in available_appointments:
+        appt_start = appointment["startTimestamp"]
+        appt_start_dt = datetime.strptime(appt_start, "%Y-%m-%dT%H:%M")
+        date_str = appt_start_dt.strftime("%Y-%m-%d")
+        if date_str in date_to_time_ranges:
+            for time_range in date_to_time_ranges[date_str]:
+                if (
+                    appt_start_dt >= time_range[0] and
+                    appt_start_dt <= time_range[1]
+                ):
+                    valid_appointments.add(
+                        appt_start_dt.strftime("%Y-%m-%d %H:%M")
+                    )
+    return valid_appointments
+
+
+def measure_memory(build, *args) -> Tuple[object, int]:
+    tracemalloc.start()
+    result = build(*args)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--days", type=int, default=180)
+    parser.add_argument("--ranges", type=int, default=12)
+    parser.add_argument("--slots", type=int, default=100)
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    start = datetime(2022, 7, 1)
+    date_ranges = make_date_ranges(start, args.days, args.ranges)
+    payload = make_payload(start, args.days, args.slots)
+
+    legacy, legacy_bytes = measure_memory(build_legacy, date_ranges)
+    matcher, matcher_bytes = measure_memory(
+        AppointmentMatcher.from_date_ranges, date_ranges, DTFMT
+    )
+
+    expected = legacy_filter(legacy, payload)
+    actual = matcher.filter(payload)
+    if expected != actual:
+        sys.exit(
+            f"Matchers disagree: {sorted(expected ^ actual)[:10]}"
+        )
+
+    legacy_time = min(timeit.repeat(
+        lambda: legacy_filter(legacy, payload), number=args.number, repeat=5
+    )) / args.number
+    matcher_time = min(timeit.repeat(
+        lambda: matcher.filter(payload), number=args.number, repeat=5
+    )) / args.number
+
+    print(
+        f"{args.slots} slots, {args.ranges} date ranges over {args.days} "
+        f"days, {len(expected)} matching"
+    )
+    print(f"{'':<22}{'per poll':>12}{'memory':>12}")
+    print(
+        f"{'dateToTimeRanges':<22}{legacy_time * 1e6:>10.1f}us"
+        f"{legacy_bytes / 1024:>10.1f}KB"
+    )
+    print(
+        f"{'AppointmentMatcher':<22}{matcher_time * 1e6:>10.1f}us"
+        f"{matcher_bytes / 1024:>10.1f}KB"
+    )
+    print(f"Speedup: {legacy_time / matcher_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
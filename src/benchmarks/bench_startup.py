@@ -0,0 +1,131 @@
+"""
+bench_startup.py
+user: vhao
+date: 10-17-2026
+
+Startup benchmark approximating an AWS Lambda cold start. Each run is a fresh
+interpreter which imports lambda_function and then scans one location
+against a canned /slots payload, so no requests leave the machine.
+
+Run from src/:
+    python -m benchmarks.bench_startup
+"""
+
+from typing import List
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from benchmarks.bench_matcher import DTFMT, make_date_ranges, make_payload
+from scanner_transport import Transport
+from scanner_types import HttpResponse
+
+
+# Runs in the child interpreter
+CHILD_SCRIPT = """
+import time
+t0 = time.perf_counter()
+import lambda_function
+t1 = time.perf_counter()
+
+import asyncio
+import json
+import resource
+import sys
+from benchmarks.bench_startup import first_scan
+rss_after_import = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+t2 = time.perf_counter()
+asyncio.run(first_scan())
+t3 = time.perf_counter()
+print(json.dumps({
+    "import": t1 - t0,
+    "first_scan": t3 - t2,
+    "rss_kb": rss_after_import,
+    "modules": len(sys.modules),
+}))
+"""
+
+
+class StaticTransport(Transport):
+    def __init__(self, payload: List[dict]):
+        super().__init__()
+        self._content = json.dumps(payload).encode()
+
+    async def _get(
+        self, url, params, headers, timeout, parser=None
+    ) -> HttpResponse:
+        res = HttpResponse(status_code=200, headers={}, content=self._content)
+        if parser is not None:
+            if not parser.feed(self._content):
+                parser.close()
+            res.content = b""
+            res.parsed = parser
+        return res
+
+
+async def first_scan() -> None:
+    from datetime import datetime
+    from scanner_matcher import AppointmentMatcher
+    from scanner_subscriptions import build_location_index
+    from scanner_types import LocationOptions, TwilioOptions, UserOptions
+    from scanner_utils import scan_once
+
+    start = datetime(2022, 7, 1)
+    location_options = LocationOptions(
+        locationId=5320,
+        name="DTW",
+        matcher=AppointmentMatcher.from_date_ranges(
+            make_date_ranges(start, 30, 2), DTFMT
+        ),
+    )
+    user_options = UserOptions(
+        email="",
+        phoneNumber="",
+        twilioOptions=TwilioOptions("", "", ""),
+        locationOptionsList=[location_options],
+    )
+    transport = StaticTransport(make_payload(start, 30, 100))
+    subscribers = build_location_index([user_options])[5320]
+    await scan_once(transport, subscribers)
+
+
+def run_child() -> dict:
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    res = subprocess.run(
+        [sys.executable, "-c", CHILD_SCRIPT],
+        cwd=src_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # The scanner logs to stdout as well, from a background thread, so log
+    # lines can come after the result
+    for line in reversed(res.stdout.splitlines()):
+        if line.startswith('{"import"'):
+            return json.loads(line)
+    raise RuntimeError(f"No result in the output:\n{res.stdout}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    results = [run_child() for _ in range(args.runs)]
+    print(f"{args.runs} cold starts (median / max)")
+    for key, label in [("import", "import"), ("first_scan", "first scan")]:
+        samples = [result[key] * 1000 for result in results]
+        print(
+            f"{label:<14}{statistics.median(samples):>8.1f}ms"
+            f"{max(samples):>8.1f}ms"
+        )
+    rss = [result["rss_kb"] / 1024 for result in results]
+    print(f"{'rss':<14}{statistics.median(rss):>8.1f}MB{max(rss):>8.1f}MB")
+    print(f"{'modules':<14}{results[0]['modules']:>8}")
+
+
+if __name__ == "__main__":
+    main()
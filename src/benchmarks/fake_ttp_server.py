@@ -0,0 +1,456 @@
+"""
+fake_ttp_server.py
+user: vhao
+date: 10-17-2026
+
+Local stand-in for the TTP scheduler API, used to load test the scanner
+without sending a single request to ttp.cbp.dhs.gov.
+
+The server replays a slot timeline: every slot of every location appears and
+disappears at fixed offsets (in seconds) from the start of the replay, so a
+run is fully deterministic. Timelines are either synthetic (synth) or
+recorded from the live API (record). Latency, 429s and 5xx responses can be
+injected with a seeded RNG.
+
+Endpoints:
+    /schedulerapi/slots?locationId=...&limit=...
+    /schedulerapi/locations/{locationId}/slots
+        ?startTimestamp=...&endTimestamp=...
+    /schedulerapi/locations/
+    /stats      Request counts by status code
+
+Run from src/:
+    python -m benchmarks.fake_ttp_server synth --locations 2000 --out t.json
+    python -m benchmarks.fake_ttp_server serve --timeline t.json --port 8080
+    python -m benchmarks.fake_ttp_server record --location-ids 5140,5320 \\
+        --duration 3600 --out t.json
+
+Timeline format:
+    {
+        "locations": [raw /locations entries],
+        "slots": {"<locationId>": [[startTimestamp, appearAt, disappearAt]]}
+    }
+where disappearAt is null for slots that never disappear.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+
+# [startTimestamp, appearAt, disappearAt]
+Slot = Tuple[str, float, Optional[float]]
+
+SLOTS_PATH = "/schedulerapi/slots"
+LOCATIONS_PATH = "/schedulerapi/locations/"
+LOCATION_SLOTS_PATH = "/schedulerapi/locations/{locationId}/slots"
+# Synthetic slots are all within SYNTH_DAYS days from this day
+SYNTH_START = datetime(2030, 1, 1)
+SYNTH_DAYS = 60
+
+
+def load_timeline(path: str) -> Dict[str, Any]:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_timeline(timeline: Dict[str, Any], path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(timeline, f)
+
+
+"""
+Desc: Generates a synthetic timeline. Every location starts out with
+initial_slots slots, and new slots appear (and old ones disappear) at random
+times throughout the duration at about churn slots per location per minute.
+"""
+def make_timeline(
+    num_locations: int,
+    duration: float,
+    initial_slots: int = 20,
+    churn: float = 0.5,
+    days: int = SYNTH_DAYS,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    locations = []
+    slots: Dict[str, List[Slot]] = {}
+    for i in range(num_locations):
+        locationId = 10000 + i
+        locations.append({
+            "id": locationId,
+            "name": f"Fake Enrollment Center {i}",
+            "shortName": f"FAKE{i}",
+            "state": "MI",
+            "city": "Detroit",
+            "latitude": 42.0 + rng.random(),
+            "longitude": -83.0 - rng.random(),
+        })
+        location_slots: List[Slot] = []
+        taken = set()
+
+        def new_timestamp() -> str:
+            while True:
+                minute = rng.randrange(days * 24 * 4) * 15
+                if minute not in taken:
+                    taken.add(minute)
+                    return (
+                        SYNTH_START + timedelta(minutes=minute)
+                    ).strftime("%Y-%m-%dT%H:%M")
+
+        for _ in range(initial_slots):
+            location_slots.append((new_timestamp(), 0.0, None))
+        appear_at = 0.0
+        while churn > 0:
+            appear_at += rng.expovariate(churn / 60)
+            if appear_at >= duration:
+                break
+            lifetime = rng.expovariate(1 / 300)
+            location_slots.append((
+                new_timestamp(),
+                round(appear_at, 3),
+                round(appear_at + lifetime, 3),
+            ))
+        slots[str(locationId)] = location_slots
+    return {"locations": locations, "slots": slots}
+
+
+"""
+Desc: Records a timeline from the live API by polling each location every
+interval seconds for duration seconds. Slots seen on the first poll appear
+at 0.
+"""
+async def record_timeline(
+    location_ids: List[int],
+    duration: float,
+    interval: float,
+) -> Dict[str, Any]:
+    from scanner_constants import SCHEDULER_API, SCHEDULER_PARAMS
+    from scanner_transport import create_transport
+
+    transport = create_transport()
+    # Maps locationIds to startTimestamps to [appearAt, disappearAt]
+    seen: Dict[int, Dict[str, List[Optional[float]]]] = {
+        locationId: {} for locationId in location_ids
+    }
+    start = time.monotonic()
+    first_round = True
+    try:
+        while True:
+            elapsed = time.monotonic() - start
+            if elapsed >= duration:
+                break
+            for locationId in location_ids:
+                params = {**SCHEDULER_PARAMS, "locationId": locationId}
+                res = await transport.get(SCHEDULER_API, params=params)
+                if not res.ok:
+                    continue
+                now = 0.0 if first_round else round(
+                    time.monotonic() - start, 3
+                )
+                current = {slot["startTimestamp"] for slot in res.json()}
+                location_seen = seen[locationId]
+                for timestamp in current:
+                    span = location_seen.get(timestamp)
+                    if span is None or span[1] is not None:
+                        location_seen[timestamp] = [now, None]
+                for timestamp, span in location_seen.items():
+                    if span[1] is None and timestamp not in current:
+                        span[1] = now
+            first_round = False
+            await asyncio.sleep(interval)
+    finally:
+        await transport.close()
+
+    return {
+        "locations": [
+            {"id": locationId, "name": str(locationId),
+             "shortName": str(locationId), "state": "", "city": ""}
+            for locationId in location_ids
+        ],
+        "slots": {
+            str(locationId): [
+                (timestamp, span[0], span[1])
+                for timestamp, span in sorted(spans.items())
+            ]
+            for locationId, spans in seen.items()
+        },
+    }
+
+
+class FakeTTPServer:
+    """
+    Args:
+        start_at:       time.time() at which the replay starts, now if None
+        latency:        Seconds added to every response
+        jitter:         Up to this many more seconds are added at random
+        throttle_rate:  Fraction of requests answered with 429
+        error_rate:     Fraction of requests answered with a 5xx
+        retry_after:    Retry-After sent with 429s
+        etag:           Send ETags and answer If-None-Match with 304
+    """
+    def __init__(
+        self,
+        timeline: Dict[str, Any],
+        start_at: Optional[float] = None,
+        latency: float = 0,
+        jitter: float = 0,
+        throttle_rate: float = 0,
+        error_rate: float = 0,
+        retry_after: float = 1,
+        etag: bool = False,
+        seed: int = 0,
+    ):
+        self._locations = timeline["locations"]
+        self._slots: Dict[int, List[Slot]] = {
+            int(locationId): sorted(slots)
+            for locationId, slots in timeline["slots"].items()
+        }
+        self._start_at = time.time() if start_at is None else start_at
+        self._latency = latency
+        self._jitter = jitter
+        self._throttle_rate = throttle_rate
+        self._error_rate = error_rate
+        self._retry_after = retry_after
+        self._etag = etag
+        self._rng = random.Random(seed)
+        self.statuses: Counter = Counter()
+
+    def active_slots(
+        self,
+        locationId: int,
+        now: float,
+    ) -> List[Dict[str, Any]]:
+        elapsed = now - self._start_at
+        active = []
+        slots = self._slots.get(locationId, ())
+        for timestamp, appear_at, disappear_at in slots:
+            if appear_at <= elapsed and (
+                disappear_at is None or elapsed < disappear_at
+            ):
+                start = datetime.fromisoformat(timestamp)
+                active.append({
+                    "locationId": locationId,
+                    "startTimestamp": timestamp,
+                    "endTimestamp": (
+                        start + timedelta(minutes=15)
+                    ).strftime("%Y-%m-%dT%H:%M"),
+                    "active": True,
+                    "duration": 15,
+                    "remoteInd": False,
+                })
+        return active
+
+    async def _delay(self) -> None:
+        delay = self._latency + self._rng.random() * self._jitter
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # Returns an injected error response, if any
+    def _inject_fault(self):
+        from aiohttp import web
+
+        roll = self._rng.random()
+        if roll < self._throttle_rate:
+            return web.Response(
+                status=429, headers={"Retry-After": str(self._retry_after)}
+            )
+        if roll < self._throttle_rate + self._error_rate:
+            return web.Response(status=self._rng.choice([500, 502, 503, 504]))
+        return None
+
+    async def handle_slots(self, request):
+        from aiohttp import web
+
+        await self._delay()
+        res = self._inject_fault()
+        if res is None:
+            try:
+                locationId = int(request.query["locationId"])
+                limit = int(request.query.get("limit", 100))
+            except (KeyError, ValueError):
+                res = web.Response(status=400)
+            else:
+                slots = self.active_slots(locationId, time.time())[:limit]
+                body = json.dumps(slots).encode()
+                headers = {}
+                if self._etag:
+                    etag = '"' + hashlib.blake2b(
+                        body, digest_size=8
+                    ).hexdigest() + '"'
+                    headers["ETag"] = etag
+                    if request.headers.get("If-None-Match") == etag:
+                        res = web.Response(status=304, headers=headers)
+                if res is None:
+                    res = web.Response(
+                        body=body,
+                        headers=headers,
+                        content_type="application/json",
+                    )
+        self.statuses[res.status] += 1
+        return res
+
+    # The date-bounded variant, which returns every slot in the span
+    async def handle_location_slots(self, request):
+        from aiohttp import web
+
+        await self._delay()
+        res = self._inject_fault()
+        if res is None:
+            try:
+                locationId = int(request.match_info["locationId"])
+                start = request.query["startTimestamp"][:16]
+                end = request.query["endTimestamp"][:16]
+            except (KeyError, ValueError):
+                res = web.Response(status=400)
+            else:
+                res = web.json_response([
+                    {
+                        "active": 1,
+                        "total": 1,
+                        "pending": 0,
+                        "conflicts": 0,
+                        "duration": slot["duration"],
+                        "timestamp": slot["startTimestamp"],
+                        "remote": False,
+                    }
+                    for slot in self.active_slots(locationId, time.time())
+                    if start <= slot["startTimestamp"] <= end
+                ])
+        self.statuses[res.status] += 1
+        return res
+
+    async def handle_locations(self, request):
+        from aiohttp import web
+
+        await self._delay()
+        res = self._inject_fault() or web.json_response(self._locations)
+        self.statuses[res.status] += 1
+        return res
+
+    async def handle_stats(self, request):
+        from aiohttp import web
+
+        return web.json_response({
+            "requests": sum(self.statuses.values()),
+            "statuses": {
+                str(status): count for status, count in self.statuses.items()
+            },
+            "elapsed": time.time() - self._start_at,
+        })
+
+    def make_app(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get(SLOTS_PATH, self.handle_slots)
+        app.router.add_get(LOCATION_SLOTS_PATH, self.handle_location_slots)
+        app.router.add_get(LOCATIONS_PATH, self.handle_locations)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+    """
+    Desc: Starts serving in the running event loop and returns the runner,
+    call runner.cleanup() to stop.
+    """
+    async def start(self, host: str = "127.0.0.1", port: int = 8080):
+        from aiohttp import web
+
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        return runner
+
+
+async def serve(server: FakeTTPServer, host: str, port: int) -> None:
+    runner = await server.start(host, port)
+    # Parent processes wait for this line before sending requests
+    print(f"Serving on http://{host}:{port}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    synth = subparsers.add_parser("synth", help="Generate a timeline")
+    synth.add_argument("--locations", type=int, default=1000)
+    synth.add_argument("--duration", type=float, default=600)
+    synth.add_argument("--initial-slots", type=int, default=20)
+    synth.add_argument("--churn", type=float, default=0.5,
+                       help="New slots per location per minute")
+    synth.add_argument("--seed", type=int, default=0)
+    synth.add_argument("--out", required=True)
+
+    record = subparsers.add_parser("record", help="Record the live API")
+    record.add_argument("--location-ids", required=True,
+                        help="Comma separated locationIds")
+    record.add_argument("--duration", type=float, default=3600)
+    record.add_argument("--interval", type=float, default=60)
+    record.add_argument("--out", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Replay a timeline")
+    serve_parser.add_argument("--timeline", required=True)
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--start-at", type=float, default=None,
+                              help="Epoch seconds the replay starts at")
+    serve_parser.add_argument("--latency-ms", type=float, default=0)
+    serve_parser.add_argument("--jitter-ms", type=float, default=0)
+    serve_parser.add_argument("--throttle-rate", type=float, default=0)
+    serve_parser.add_argument("--error-rate", type=float, default=0)
+    serve_parser.add_argument("--retry-after", type=float, default=1)
+    serve_parser.add_argument("--etag", action="store_true")
+    serve_parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "synth":
+        save_timeline(
+            make_timeline(
+                args.locations,
+                args.duration,
+                args.initial_slots,
+                args.churn,
+                seed=args.seed,
+            ),
+            args.out,
+        )
+    elif args.command == "record":
+        location_ids = [int(i) for i in args.location_ids.split(",")]
+        save_timeline(
+            asyncio.run(
+                record_timeline(location_ids, args.duration, args.interval)
+            ),
+            args.out,
+        )
+    else:
+        server = FakeTTPServer(
+            load_timeline(args.timeline),
+            start_at=args.start_at,
+            latency=args.latency_ms / 1000,
+            jitter=args.jitter_ms / 1000,
+            throttle_rate=args.throttle_rate,
+            error_rate=args.error_rate,
+            retry_after=args.retry_after,
+            etag=args.etag,
+            seed=args.seed,
+        )
+        try:
+            asyncio.run(serve(server, args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,37 @@ user: vhao
 date: 03-27-2022
 
 AWS Lambda entrypoint.
+
+With LAMBDA_FAN_OUT, the scheduled invocation (whose event has no
+"locationIds") invokes the function once per batch of locations, and those
+invocations do the scanning. See scanner_lambda_fanout.py.
 """
 
-import asyncio
 import json
-from scanner import start_scanning
+from scanner_constants import LAMBDA_FAN_OUT
+from scanner_lambda_fanout import fan_out, scan_batch
+from scanner_metrics import emit_emf
+from scanner_utils import flush_seen_appointments
 
 def lambda_handler(event, context):
-    asyncio.run(start_scanning())
+    event = event or {}
+    if LAMBDA_FAN_OUT and "locationIds" not in event:
+        try:
+            batches = fan_out(context.invoked_function_arn)
+        finally:
+            emit_emf()
+        return {
+            'statusCode': 200,
+            'body': json.dumps(f'Invoked {batches} batches.')
+        }
+
+    try:
+        scan_batch(event.get("batch", ""), event.get("locationIds"), context)
+    finally:
+        # Previously seen appointments are only written to S3 once per
+        # invocation
+        flush_seen_appointments()
+        emit_emf()
     return {
         'statusCode': 200,
         'body': json.dumps('Scanning complete. Lambda finished.')
@@ -8,19 +8,70 @@ the specified dates/times and notifies user when appointments meeting the criter
 are available.
 """
 
-from scanner_constants import USING_AWS_LAMBDA
+from scanner_constants import (
+    DAEMON_MODE,
+    SHARD_WORKER,
+    SHARD_WORKERS,
+    USING_AWS_LAMBDA,
+)
 
+import argparse
 import asyncio
-from scanner_utils import get_locations, get_user_options, launch_scanners
+from scanner_sharding import (
+    is_sharded,
+    make_shard_filter,
+    run_workers,
+    shard_user_options,
+)
+from scanner_utils import (
+    get_all_user_options,
+    get_locations,
+    launch_scanners,
+)
 
 
+# Lambda invocations go through scan_batch in scanner_lambda_fanout.py
 async def start_scanning():
     # Don't attempt to get locations on lambda, the files are static
     if not USING_AWS_LAMBDA:
         get_locations()
 
-    user_options = get_user_options()
-    await launch_scanners(user_options)
+    user_options_list = get_all_user_options()
+    if is_sharded():
+        user_options_list = shard_user_options(
+            user_options_list, make_shard_filter()
+        )
+    await launch_scanners(user_options_list)
+
+
+# Runs until interrupted, applying config changes as they come in
+async def start_daemon():
+    from scanner_daemon import ScannerDaemon
+
+    get_locations()
+    await ScannerDaemon().run()
+
 
 if __name__ == "__main__":
-    asyncio.run(start_scanning())
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        default=DAEMON_MODE,
+        help="Keep running and reload the config when it changes",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=SHARD_WORKERS,
+        help="Split the locations between this many worker processes",
+    )
+    args = parser.parse_args()
+    if args.daemon:
+        asyncio.run(start_daemon())
+    elif args.workers > 1 and not SHARD_WORKER:
+        # Download the locations once, before the workers need them
+        get_locations()
+        run_workers(args.workers)
+    else:
+        asyncio.run(start_scanning())
@@ -0,0 +1,111 @@
+"""
+scanner_circuit_breaker.py
+user: vhao
+date: 10-17-2026
+
+Circuit breaker shared by every scanner talking to the same upstream host.
+
+After BREAKER_FAILURE_THRESHOLD requests in a row fail (ran out of retries or
+ended in a 5xx), the breaker opens and requests to the host are rejected
+right away instead of each scanner separately retrying against a server that
+is down. After BREAKER_RESET_TIMEOUT seconds a single probe request is let
+through: if it succeeds the breaker closes again, otherwise it stays open for
+another BREAKER_RESET_TIMEOUT seconds.
+"""
+
+from typing import Optional
+
+import time
+from scanner_constants import (
+    BREAKER_FAILURE_THRESHOLD,
+    BREAKER_RESET_TIMEOUT,
+)
+from scanner_logger import getScannerLogger
+from scanner_metrics import metrics
+
+
+logger = getScannerLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_timeout: float = BREAKER_RESET_TIMEOUT,
+    ):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._state = CLOSED
+        # The request holding the half-open probe slot, None when free
+        self._probe: Optional[object] = None
+
+    @property
+    def state(self) -> str:
+        if (
+            self._state == OPEN
+            and time.monotonic() - self._opened_at >= self._reset_timeout
+        ):
+            return HALF_OPEN
+        return self._state
+
+    # Seconds until the next probe is let through
+    @property
+    def retry_in(self) -> float:
+        if self._state != OPEN:
+            return 0
+        return max(
+            self._opened_at + self._reset_timeout - time.monotonic(), 0
+        )
+
+    """
+    Desc: Returns whether a request may be sent. While half-open only the
+    first caller gets to probe, and must report back through record_success,
+    record_failure or abandon.
+    Args:
+        request:    Identifies the caller, which passes it to abandon
+    """
+    def allow(self, request: object) -> bool:
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and self._probe is None:
+            self._probe = request
+            return True
+        metrics.inc("ttp_circuit_rejected_total", host=self.name)
+        return False
+
+    def record_success(self) -> None:
+        if self._state != CLOSED:
+            logger.info("Circuit for %s closed, upstream recovered", self.name)
+            metrics.set("ttp_circuit_open", 0, host=self.name)
+        self._state = CLOSED
+        self._failures = 0
+        self._probe = None
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._probe = None
+        if self._state == OPEN or self._failures >= self._failure_threshold:
+            if self._state != OPEN:
+                logger.warning(
+                    "Circuit for %s opened after %d failures in a row, "
+                    "pausing requests for %.0fs", self.name, self._failures,
+                    self._reset_timeout,
+                )
+                metrics.set("ttp_circuit_open", 1, host=self.name)
+            self._state = OPEN
+            self._opened_at = time.monotonic()
+
+    # The request ended without a result, e.g. it was cancelled. Frees the
+    # probe slot if the request was holding it.
+    def abandon(self, request: object) -> None:
+        if self._probe is request:
+            self._probe = None
@@ -6,43 +6,272 @@ date: 03-27-2022
 Set USING_AWS_LAMBDA to True if running on AWS lambda.
 """
 
+from typing import Dict, List
+
 import os
+from datetime import timedelta
 
 # TTP APIs
 SCHEDULER_API = "https://ttp.cbp.dhs.gov/schedulerapi/slots"
 locations_api = "https://ttp.cbp.dhs.gov/schedulerapi/locations/?temporary=false&inviteOnly=false&operational=true&serviceName="
 
-# Default scheduler params
+# HTTP transport used to talk to the TTP APIs. One of "aiohttp" (native
+# asyncio with pooled keep-alive connections) or "requests" (blocking
+# requests.Session run in the default thread pool executor).
+HTTP_TRANSPORT = "aiohttp"
+MAX_REQUESTS_IN_FLIGHT = 10
+REQUEST_TIMEOUT = 5
+KEEPALIVE_TIMEOUT = 30
+# Streamed response bodies (see SLOTS_STREAM_PARSE) are read in chunks of up
+# to STREAM_CHUNK_SIZE bytes. Once the parser has what it needs, the rest of
+# the body is still read and thrown away so the connection can be reused,
+# unless it is longer than STREAM_DRAIN_LIMIT bytes.
+STREAM_CHUNK_SIZE: int = 16 * 1024
+STREAM_DRAIN_LIMIT: int = 64 * 1024
+
+# Retry strategy shared by all transports. Retry n waits a random time of up
+# to RETRY_BACKOFF_FACTOR * 2^(n-1) seconds (capped at RETRY_BACKOFF_MAX) on
+# the event loop, without holding a thread or an in-flight slot.
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR: float = 5
+RETRY_BACKOFF_MAX: float = 30
+RETRY_STATUS_FORCELIST = [429, 500, 502, 503, 504]
+
+# Circuit breaker shared by all scanners, per upstream host. Opens after
+# BREAKER_FAILURE_THRESHOLD failed requests in a row and probes the host again
+# after BREAKER_RESET_TIMEOUT seconds.
+BREAKER_FAILURE_THRESHOLD: int = 5
+BREAKER_RESET_TIMEOUT: float = 30
+
+# Scanners which raise are restarted after a random delay of up to
+# SCANNER_RESTART_BACKOFF * 2^(n-1) seconds on their n-th failure in a row,
+# capped at SCANNER_RESTART_BACKOFF_MAX
+SCANNER_RESTART_BACKOFF: float = 5
+SCANNER_RESTART_BACKOFF_MAX: float = 15 * 60
+
+# Poll scheduler. All location polls share a single global request budget
+# and are spread evenly across the refresh window.
+POLL_REQUESTS_PER_SECOND: float = 5.0
+DEFAULT_REFRESH_TIME: float = 60
+# On lambda we only poll once, so only spread the polls over a few seconds
+LAMBDA_POLL_WINDOW: float = 2
+SCHEDULER_METRICS_INTERVAL: float = 60
+# How many /slots polls between logging the response cache hit ratio
+SLOTS_CACHE_REPORT_EVERY: int = 100
+# Weight of the latest poll when adapting refresh times, see adaptiveRefresh
+# in user_options.json
+ADAPTIVE_REFRESH_SMOOTHING: float = 0.3
+
+# Sharding. Locations are split between shards by consistent hashing on
+# their locationId, first between the hosts (or lambda functions) in
+# SHARD_NODES, then between SHARD_WORKERS worker processes on each host.
+# Shards coordinate through the SQLite seen appointments store, so that no
+# appointment is notified twice. SHARD_ID is this host's name in SHARD_NODES.
+SHARD_WORKERS: int = int(os.environ.get("SCANNER_SHARD_WORKERS", 1))
+SHARD_NODES: List[str] = [
+    node for node in os.environ.get("SCANNER_SHARD_NODES", "").split(",")
+    if node
+]
+SHARD_ID: str = os.environ.get("SCANNER_SHARD_ID", "")
+# Points per shard on the hash ring, more spread locations more evenly
+SHARD_VNODES: int = 256
+# Set by the parent process in each worker process, "" outside of workers
+SHARD_WORKER: str = os.environ.get("SCANNER_SHARD_WORKER", "")
+# Logs and metrics snapshots of worker processes get their own files
+_WORKER_SUFFIX = f".worker{SHARD_WORKER}" if SHARD_WORKER else ""
+
+# Default scheduler params. The limit can be well above what a location
+# usually has, since streamed responses stop being read past the last time
+# any of the location's users wants.
 SCHEDULER_PARAMS = {
     "orderBy": "soonest",
-    "limit": 100,
+    "limit": 500,
     "minimum": 1,
 }
+# Decode /slots responses one appointment at a time as they are received, and
+# stop reading at the first appointment later than every subscriber's last
+# dateRanges end. Slots past that point are never seen, including by the slot
+# history.
+SLOTS_STREAM_PARSE: bool = True
+# How slots are fetched. "soonest" asks SCHEDULER_API for the first "limit"
+# slots of a location. "windowed" only asks for the date spans some user of
+# the location wants, with one concurrent request per span of at most
+# SLOTS_WINDOW_MAX_DAYS days, and merges the results. It never misses slots
+# past the first "limit" ones, but takes a request per span. Spans less than
+# SLOTS_WINDOW_MERGE_GAP_DAYS days apart are fetched together.
+SLOTS_FETCH: str = "soonest"
+SLOTS_WINDOW_MAX_DAYS: int = 31
+SLOTS_WINDOW_MERGE_GAP_DAYS: int = 1
 
 # TTP to serviceName in link
 ttp_to_link_service_name = {
     "Global Entry": "Global%20Entry",
-    "NEUXS": "NEXUS",
+    "NEXUS": "NEXUS",
     "SENTRI": "SENTRI",
     "FAST Mexico": "U.S.%20%2F%20Mexico%20FAST",
     "FAST Canada": "U.S.%20%2F%20Canada%20FAST",
 }
 
-# Selected Trusted Traveler Program for scanner to scan for
-# If changing this variable, remember to delete config/locations.json
-# and config/raw_locations.json so they can be regenerated.
-SELECTED_TTP = "Global Entry"
-SELECTED_TTP_LINK = locations_api + ttp_to_link_service_name[SELECTED_TTP]
+# Selected Trusted Traveler Programs for scanner to scan for. Each program
+# has its own locations catalog, which is generated the first time the
+# program is selected. Locations in the configs belong to DEFAULT_TTP unless
+# they set "program".
+SELECTED_TTPS: List[str] = ["Global Entry"]
+DEFAULT_TTP: str = SELECTED_TTPS[0]
+TTP_LOCATIONS_LINKS: Dict[str, str] = {
+    ttp: locations_api + service_name
+    for ttp, service_name in ttp_to_link_service_name.items()
+}
 
 # AWS Lambda related
 USING_AWS_LAMBDA: bool = False
 DEBUG_AWS_LAMBDA_LOCAL: bool = False
 S3_BUCKET: str = ""
 S3_PATH: str = ""
+# Validate /tmp copies of S3 objects with a conditional GET before using them
+LAMBDA_VALIDATE_TMP_CACHE: bool = True
+# Flush buffered writes to S3 once the invocation has less time than this left
+LAMBDA_FLUSH_MARGIN_MS: int = 5000
+# Fan-out mode. The scheduled invocation only splits the locations into
+# batches of about LAMBDA_BATCH_SIZE and invokes the function asynchronously
+# once per batch (LAMBDA_INVOKE_THREADS at a time), so that each invocation
+# takes about as long no matter how many locations are watched.
+LAMBDA_FAN_OUT: bool = False
+LAMBDA_BATCH_SIZE: int = 20
+LAMBDA_INVOKE_THREADS: int = 8
+
+# Notifications. Findings for the same recipient within NOTIFY_DIGEST_WINDOW
+# seconds are sent as one message, at most one message per recipient every
+# NOTIFY_MIN_INTERVAL seconds.
+NOTIFY_DIGEST_WINDOW: float = 10
+NOTIFY_MIN_INTERVAL: float = 30
+NOTIFY_WORKERS: int = 2
+NOTIFY_RETRIES: int = 3
+NOTIFY_RETRY_BACKOFF: float = 5
 
 # Config and log paths
 PREV_SEEN_APPTS_PATH = os.path.join("..", "configs", "prev_seen_appts.json")
 USER_OPTIONS_PATH = os.path.join("..", "configs", "user_options.json")
-RAW_LOCATIONS_PATH = os.path.join("..", "configs", "raw_locations.json")
-LOCATIONS_PATH = os.path.join("..", "configs", "locations.json")
-LOGS_PATH = os.path.join("..", "logs", "scanner.log")
+# When this file exists, the scanner runs in multi-user mode and ignores
+# USER_OPTIONS_PATH
+MULTI_USER_OPTIONS_PATH = os.path.join("..", "configs", "users.json")
+# Global Entry keeps the original raw_locations.json/locations.json names
+_TTP_LOCATIONS_SUFFIXES = {
+    "Global Entry": "",
+    "NEXUS": "_nexus",
+    "SENTRI": "_sentri",
+    "FAST Mexico": "_fast_mexico",
+    "FAST Canada": "_fast_canada",
+}
+RAW_LOCATIONS_PATHS: Dict[str, str] = {
+    ttp: os.path.join("..", "configs", f"raw_locations{suffix}.json")
+    for ttp, suffix in _TTP_LOCATIONS_SUFFIXES.items()
+}
+LOCATIONS_PATHS: Dict[str, str] = {
+    ttp: os.path.join("..", "configs", f"locations{suffix}.json")
+    for ttp, suffix in _TTP_LOCATIONS_SUFFIXES.items()
+}
+# Compiled location catalogs, loaded instead of parsing the JSON files
+LOCATIONS_CACHE_PATHS: Dict[str, str] = {
+    ttp: os.path.join("..", "configs", f"locations{suffix}.pickle")
+    for ttp, suffix in _TTP_LOCATIONS_SUFFIXES.items()
+}
+LOGS_PATH = os.path.join("..", "logs", f"scanner{_WORKER_SUFFIX}.log")
+# Compiled user options are pickled here, keyed by a hash of the config and
+# location catalog files, and loaded instead of parsing the config as long
+# as none of them changed. On lambda the snapshot is written under /tmp, and
+# one uploaded with the configs (from a local run) is used too.
+USER_OPTIONS_SNAPSHOT: bool = True
+USER_OPTIONS_SNAPSHOT_PATH = os.path.join(
+    "..", "configs", "user_options.snapshot.pickle"
+)
+
+# Logging. With LOG_ASYNC, log records are written by a background thread
+# instead of the event loop (never on lambda). LOG_FORMAT is "text" or "json".
+# Repetitive messages, such as a location having no matching appointments,
+# are written at most once every LOG_SAMPLE_INTERVAL seconds per location.
+LOG_ASYNC: bool = True
+LOG_FORMAT: str = "text"
+LOG_SAMPLE_INTERVAL: float = 10 * 60
+
+# Metrics export, one of "prometheus" (text format served on
+# http://127.0.0.1:METRICS_PORT/metrics), "json" (snapshot written to
+# METRICS_SNAPSHOT_PATH every METRICS_SNAPSHOT_INTERVAL seconds) or "" (off).
+# On lambda metrics are always printed as CloudWatch EMF lines instead.
+METRICS_EXPORT: str = ""
+# Worker processes serve on METRICS_PORT + 10 + their index
+METRICS_PORT: int = 9108 + (10 + int(SHARD_WORKER) if SHARD_WORKER else 0)
+METRICS_SNAPSHOT_PATH = os.path.join(
+    "..", "logs", f"metrics{_WORKER_SUFFIX}.json"
+)
+METRICS_SNAPSHOT_INTERVAL: float = 60
+METRICS_EMF_NAMESPACE: str = "TTPScanner"
+
+# Event loop watchdog. Every LOOP_WATCHDOG_INTERVAL seconds it records how
+# late the event loop ran a timer (scanner_loop_lag_seconds) and how many
+# jobs are queued and running in the default executor. When the loop is
+# stuck for more than LOOP_BLOCK_THRESHOLD seconds, the blocking task and
+# its stack are logged.
+LOOP_WATCHDOG: bool = False
+LOOP_WATCHDOG_INTERVAL: float = 0.5
+LOOP_BLOCK_THRESHOLD: float = 0.25
+
+# Sampling profiler, toggled by sending SIGUSR2 to a running scanner or
+# through the daemon's control API (POST /profile). While it runs, every
+# thread's stack is sampled every PROFILER_INTERVAL seconds. Stopping it
+# writes the samples to PROFILER_DIR as collapsed stacks, the input format
+# of flamegraph.pl and speedscope.
+PROFILER_INTERVAL: float = 0.005
+PROFILER_DIR = os.path.join("..", "logs", "profiles")
+
+# Daemon mode (scanner.py --daemon) keeps running when the config changes:
+# the config file is checked every CONFIG_WATCH_INTERVAL seconds and only the
+# locations which changed are started, stopped or re-targeted. Updates can
+# also be pushed through the control API on
+# http://127.0.0.1:DAEMON_CONTROL_PORT (0 disables it).
+DAEMON_MODE: bool = False
+CONFIG_WATCH_INTERVAL: float = 5
+DAEMON_CONTROL_PORT: int = 9109
+
+# Slot history, off by default. Every change in a location's available
+# slots is appended to gzipped daily segments in SLOT_HISTORY_DIR, written
+# every SLOT_HISTORY_FLUSH_INTERVAL seconds. Segments older than
+# SLOT_HISTORY_RETENTION are deleted. Never recorded on lambda, whose disk
+# does not outlive the container. See python scanner_slot_history.py --help
+# for reports.
+SLOT_HISTORY: bool = False
+SLOT_HISTORY_DIR = os.path.join("..", "logs", "slot_history")
+SLOT_HISTORY_FLUSH_INTERVAL: float = 60
+SLOT_HISTORY_RETENTION = timedelta(days=90)
+
+# Location catalogs older than LOCATIONS_CACHE_TTL are downloaded again on
+# start, and every LOCATIONS_REFRESH_INTERVAL seconds while scanning. Never
+# done on lambda, where the files are static.
+LOCATIONS_CACHE_TTL: timedelta = timedelta(days=1)
+LOCATIONS_REFRESH_INTERVAL: float = 60 * 60
+
+# Previously seen appointments. Updates are appended to SEEN_APPTS_LOG_PATH
+# and compacted into PREV_SEEN_APPTS_PATH every SEEN_APPTS_COMPACT_EVERY
+# updates. Appointments older than SEEN_APPTS_RETENTION are dropped.
+SEEN_APPTS_LOG_PATH = os.path.join("..", "configs", "prev_seen_appts.log")
+SEEN_APPTS_COMPACT_EVERY: int = 100
+SEEN_APPTS_RETENTION = timedelta(days=1)
+# "file" (the files above) or "sqlite", which several processes can share.
+# Always "sqlite" when sharding across worker processes.
+SEEN_STORE: str = "file"
+SEEN_APPTS_DB_PATH = os.path.join("..", "configs", "prev_seen_appts.sqlite3")
+# Appointments claimed by a shard which crashed before notifying can be
+# claimed by another shard after this many seconds
+SEEN_CLAIM_TIMEOUT: float = 10 * 60
+# Seconds to wait for another process's write lock on SEEN_APPTS_DB_PATH.
+# Waiting happens on a thread of its own, never on the event loop.
+SEEN_DB_BUSY_TIMEOUT: float = 30
+
+# Storage backend behind SEEN_STORE = "storage", one of "file" (one file per
+# record under STORAGE_DIR), "sqlite" (STORAGE_DB_PATH, in WAL mode) or "s3"
+# (one object per record under S3_PATH). "" picks "s3" on lambda and "file"
+# otherwise. Up to STORAGE_CACHE_SIZE records are cached in memory.
+STORAGE_BACKEND: str = ""
+STORAGE_DIR = os.path.join("..", "configs", "storage")
+STORAGE_DB_PATH = os.path.join("..", "configs", "storage.sqlite3")
+STORAGE_CACHE_SIZE: int = 4096
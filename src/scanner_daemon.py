@@ -0,0 +1,303 @@
+"""
+scanner_daemon.py
+user: vhao
+date: 10-17-2026
+
+Long-running daemon mode (DAEMON_MODE in scanner_constants.py, or
+python scanner.py --daemon).
+
+Instead of reading the config once, the daemon keeps one PollScheduler,
+transport and set of in-memory state for its whole lifetime and applies
+config changes to it as they come in:
+    - locations which are no longer watched have their scanner stopped
+    - new locations get a scanner
+    - locations whose subscribers, windows or refresh times changed are
+      re-targeted in place, keeping their place in the refresh window
+Scanners for locations which did not change keep running untouched, and
+date ranges which did not change are not compiled again.
+
+Changes are picked up by checking the config file every
+CONFIG_WATCH_INTERVAL seconds, or pushed through the control API served on
+127.0.0.1:DAEMON_CONTROL_PORT:
+    GET  /status    Watched locations and scheduler metrics
+    POST /reload    Reloads the config file right away
+    PUT  /config    Validates and applies a new config, then saves it to the
+                    config file
+    POST /profile   Starts the sampling profiler, or stops it and returns
+                    the path of the collapsed stacks it wrote
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import asyncio
+import dataclasses
+import json
+import os
+from scanner_constants import (
+    CONFIG_WATCH_INTERVAL,
+    DAEMON_CONTROL_PORT,
+    MULTI_USER_OPTIONS_PATH,
+    POLL_REQUESTS_PER_SECOND,
+    SCHEDULER_API,
+)
+from scanner_logger import getScannerLogger
+from scanner_scheduler import PollScheduler
+from scanner_sharding import (
+    is_sharded,
+    make_shard_filter,
+    shard_user_options,
+)
+from scanner_subscriptions import LocationSubscribers, build_location_index
+from scanner_transport import Transport, create_transport
+from scanner_types import ConfigDiff, UserOptions
+from scanner_utils import (
+    add_scanner,
+    forget_location,
+    get_all_user_options,
+    get_user_options_path,
+    parse_all_user_options,
+    register_senders,
+    reset_location,
+    scanner_services,
+)
+from scanner_watchdog import profiler
+
+
+logger = getScannerLogger(__name__)
+
+
+# What decides how a location is scheduled
+def _schedule_key(subscribers: LocationSubscribers) -> Tuple:
+    return (subscribers.refreshTime, subscribers.adaptiveRefresh)
+
+
+class ScannerDaemon:
+    def __init__(
+        self,
+        scheduler_api: str = SCHEDULER_API,
+        transport: Optional[Transport] = None,
+        requests_per_second: float = POLL_REQUESTS_PER_SECOND,
+        watch_interval: float = CONFIG_WATCH_INTERVAL,
+        control_port: int = DAEMON_CONTROL_PORT,
+    ):
+        self.scheduler_api = scheduler_api
+        self.transport = transport or create_transport()
+        self.scheduler = PollScheduler(requests_per_second)
+        self.location_index: Dict[int, LocationSubscribers] = {}
+        self._watch_interval = watch_interval
+        self._control_port = control_port
+        # (path, mtime, size) of the config file when it was last applied
+        self._config_stat: Optional[Tuple[str, int, int]] = None
+        self._lock = asyncio.Lock()
+        # Sharded daemons only run the locations of their shard
+        self._owns = make_shard_filter() if is_sharded() else None
+
+    """
+    Desc: Diffs the new config against the running scanners and starts,
+    stops or re-targets only the locations which changed.
+    """
+    def apply(self, user_options_list: List[UserOptions]) -> ConfigDiff:
+        diff = ConfigDiff()
+        if self._owns is not None:
+            user_options_list = shard_user_options(
+                user_options_list, self._owns
+            )
+        new_index = build_location_index(user_options_list)
+
+        for locationId in list(self.location_index):
+            if locationId not in new_index:
+                self.scheduler.remove(locationId)
+                del self.location_index[locationId]
+                forget_location(locationId)
+                diff.removed.append(locationId)
+
+        for locationId, subscribers in new_index.items():
+            current = self.location_index.get(locationId)
+            if current is None:
+                self.location_index[locationId] = subscribers
+                add_scanner(
+                    self.scheduler,
+                    self.transport,
+                    subscribers,
+                    self.scheduler_api,
+                )
+                diff.added.append(locationId)
+                continue
+
+            old_schedule = _schedule_key(current)
+            # scan() holds on to current, so swapping its subscriptions
+            # re-targets the running scanner
+            if current.retarget(subscribers.subscriptions):
+                # Slots already in an unchanged response have to be matched
+                # against the new subscriptions too
+                reset_location(locationId)
+                diff.retargeted.append(locationId)
+            if _schedule_key(current) == old_schedule:
+                continue
+            diff.rescheduled.append(locationId)
+            if old_schedule[1] is None and current.adaptiveRefresh is None:
+                self.scheduler.set_interval(locationId, current.refreshTime)
+            else:
+                # The AdaptiveInterval has to be rebuilt
+                add_scanner(
+                    self.scheduler,
+                    self.transport,
+                    current,
+                    self.scheduler_api,
+                )
+
+        if diff.added or diff.removed or diff.retargeted or diff.rescheduled:
+            logger.info(
+                "Config applied: %d added, %d removed, %d re-targeted, %d "
+                "rescheduled, watching %d locations", len(diff.added),
+                len(diff.removed), len(diff.retargeted),
+                len(diff.rescheduled), len(self.location_index),
+            )
+        else:
+            logger.info("Config applied, nothing changed")
+        return diff
+
+    def _stat_config(self) -> Optional[Tuple[str, int, int]]:
+        path = get_user_options_path()
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (path, stat.st_mtime_ns, stat.st_size)
+
+    # Reloads the config file. A config which does not parse is logged and
+    # ignored, the scanners keep running with the previous one.
+    async def reload(self) -> Optional[ConfigDiff]:
+        async with self._lock:
+            config_stat = self._stat_config()
+            try:
+                user_options_list = get_all_user_options(load_seen=False)
+            except Exception as e:
+                self._config_stat = config_stat
+                logger.error(
+                    "Keeping the previous config, could not load %s: %r",
+                    get_user_options_path(), e,
+                )
+                return None
+            self._config_stat = config_stat
+            return self.apply(user_options_list)
+
+    async def _watch_config(self) -> None:
+        while True:
+            await asyncio.sleep(self._watch_interval)
+            if self._stat_config() != self._config_stat:
+                logger.info(
+                    "%s changed, reloading", get_user_options_path()
+                )
+                await self.reload()
+
+    """
+    Desc: Applies a new config (the contents of either config file) and
+    saves it over the config file. Raises ValueError if it does not parse,
+    in which case nothing is changed.
+    """
+    async def update_config(self, options_dict: dict) -> ConfigDiff:
+        async with self._lock:
+            path = get_user_options_path()
+            if not isinstance(options_dict, dict):
+                raise ValueError("Config must be a JSON object")
+            if ("users" in options_dict) != (
+                path == MULTI_USER_OPTIONS_PATH
+            ):
+                raise ValueError(
+                    f"Config does not match the format of {path}"
+                )
+            try:
+                user_options_list = parse_all_user_options(options_dict)
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"Invalid config: {e!r}") from e
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(options_dict, f, indent=4)
+            os.replace(tmp_path, path)
+            self._config_stat = self._stat_config()
+            register_senders(user_options_list)
+            return self.apply(user_options_list)
+
+    def status(self) -> dict:
+        return {
+            "locations": [
+                {
+                    "locationId": locationId,
+                    "name": subscribers.name,
+                    "programs": subscribers.programs,
+                    "subscribers": len(subscribers.subscriptions),
+                    "interval": self.scheduler.get_interval(locationId),
+                }
+                for locationId, subscribers in sorted(
+                    self.location_index.items()
+                )
+            ],
+            "scheduler": dataclasses.asdict(self.scheduler.get_metrics()),
+        }
+
+    async def _serve_control_api(self) -> None:
+        from aiohttp import web
+
+        def diff_response(diff: Optional[ConfigDiff]):
+            if diff is None:
+                return web.json_response(
+                    {"error": "Config could not be loaded, see the logs"},
+                    status=400,
+                )
+            return web.json_response(dataclasses.asdict(diff))
+
+        async def handle_status(request):
+            return web.json_response(self.status())
+
+        async def handle_reload(request):
+            return diff_response(await self.reload())
+
+        async def handle_config(request):
+            try:
+                options_dict = await request.json()
+                return diff_response(await self.update_config(options_dict))
+            except ValueError as e:
+                return web.json_response({"error": str(e)}, status=400)
+
+        async def handle_profile(request):
+            path = profiler.toggle()
+            return web.json_response(
+                {"profiling": profiler.running, "path": path}
+            )
+
+        app = web.Application()
+        app.router.add_get("/status", handle_status)
+        app.router.add_post("/reload", handle_reload)
+        app.router.add_put("/config", handle_config)
+        app.router.add_post("/profile", handle_profile)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", self._control_port).start()
+        logger.info(
+            f"Control API listening on http://127.0.0.1:{self._control_port}"
+        )
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    # Runs until cancelled or stop() is called
+    async def run(self) -> None:
+        self._config_stat = self._stat_config()
+        self.apply(get_all_user_options())
+
+        async with scanner_services(self.transport):
+            tasks = [asyncio.create_task(self._watch_config())]
+            if self._control_port:
+                tasks.append(asyncio.create_task(self._serve_control_api()))
+            try:
+                await self.scheduler.run(forever=True)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info("Daemon stopped")
+
+    def stop(self) -> None:
+        self.scheduler.stop()
@@ -0,0 +1,230 @@
+"""
+scanner_lambda_fanout.py
+user: vhao
+date: 10-17-2026
+
+Runs the scanner on AWS Lambda, optionally fanned out over one invocation
+per batch of locations (LAMBDA_FAN_OUT in scanner_constants.py).
+
+In fan-out mode the scheduled invocation is only an orchestrator: it splits
+the locations into batches of about LAMBDA_BATCH_SIZE and asynchronously
+invokes the function once per batch, with the batch in the event:
+    {"batch": "batch-3", "locationIds": [5140, 5446, ...]}
+Each batch invocation scans only its locations, so its duration (and cost)
+stays the same as the location list grows. Locations are assigned to batches
+with consistent hashing, so a location stays in the same batch unless the
+number of batches changes. Each batch keeps its own previously seen
+appointments file in S3, which avoids races between concurrent batches.
+
+A warm container reuses, between invocations:
+    - the event loop and the transport's pooled connections
+    - the parsed user options, re-parsed only once the config or locations
+      files change
+    - each batch's previously seen appointments, re-read only once the S3
+      object changes (checked with a conditional GET)
+"""
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+import asyncio
+import json
+import math
+import os
+import re
+import scanner_utils
+from concurrent.futures import ThreadPoolExecutor
+from scanner_constants import (
+    LAMBDA_BATCH_SIZE,
+    LAMBDA_INVOKE_THREADS,
+    LOCATIONS_CACHE_PATHS,
+    SELECTED_TTPS,
+)
+from scanner_logger import getScannerLogger
+from scanner_seen_store import SeenAppointmentStore, create_seen_store
+from scanner_sharding import (
+    HashRing,
+    is_sharded,
+    make_shard_filter,
+    shard_user_options,
+)
+from scanner_transport import Transport, create_transport
+from scanner_types import UserOptions
+
+
+logger = getScannerLogger(__name__)
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_transport: Optional[Transport] = None
+_lambda_client = None
+# (config files stamp, user options parsed from them)
+_user_options: Optional[Tuple[Tuple, List[UserOptions]]] = None
+# Maps batch names to their previously seen appointments
+_seen_stores: Dict[str, SeenAppointmentStore] = {}
+
+
+# Kept open between invocations, asyncio.run would close it every time
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop
+
+
+def get_transport() -> Transport:
+    global _transport
+    if _transport is None:
+        _transport = create_transport()
+    return _transport
+
+
+def get_lambda_client():
+    global _lambda_client
+    if _lambda_client is None:
+        import boto3
+        _lambda_client = boto3.client("lambda")
+    return _lambda_client
+
+
+# Changes whenever the config or any locations file is replaced
+def _config_stamp() -> Tuple:
+    paths = [scanner_utils.get_user_options_path()] + [
+        LOCATIONS_CACHE_PATHS[program] for program in SELECTED_TTPS
+    ]
+    stamp = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamp.append((path, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            stamp.append((path, None, None))
+    return tuple(stamp)
+
+
+def get_cached_user_options() -> List[UserOptions]:
+    global _user_options
+    stamp = _config_stamp()
+    if _user_options is not None and _user_options[0] == stamp:
+        logger.debug("Reusing user options parsed by a previous invocation")
+        return _user_options[1]
+    user_options_list = scanner_utils.get_all_user_options(load_seen=False)
+    if is_sharded():
+        user_options_list = shard_user_options(
+            user_options_list, make_shard_filter()
+        )
+    if _user_options is not None:
+        # Responses cached by earlier invocations were only matched against
+        # the old subscriptions
+        scanner_utils.reset_locations()
+    _user_options = (stamp, user_options_list)
+    return user_options_list
+
+
+# Makes the batch's previously seen appointments the ones scan() uses
+def use_seen_store(batch: str) -> SeenAppointmentStore:
+    store = _seen_stores.get(batch)
+    if store is None:
+        store = _seen_stores[batch] = create_seen_store(batch or None)
+    store.load()
+    scanner_utils.seen_store = store
+    return store
+
+
+"""
+Desc: Splits locationIds into batches of about batch_size, keyed by batch
+name.
+"""
+def make_batches(
+    location_ids: List[int],
+    batch_size: int = LAMBDA_BATCH_SIZE,
+) -> Dict[str, List[int]]:
+    if not location_ids:
+        return {}
+    num_batches = math.ceil(len(location_ids) / batch_size)
+    ring = HashRing(f"batch-{i}" for i in range(num_batches))
+    batches: Dict[str, List[int]] = {}
+    for locationId in sorted(location_ids):
+        batches.setdefault(ring.node_for(locationId), []).append(locationId)
+    return batches
+
+
+def _invoke(function_name: str, batch: str, location_ids: List[int]) -> None:
+    get_lambda_client().invoke(
+        FunctionName=function_name,
+        InvocationType="Event",
+        Payload=json.dumps({"batch": batch, "locationIds": location_ids}),
+    )
+
+
+"""
+Desc: Invokes function_name once per batch of watched locations, without
+waiting for the invocations to finish. Returns the number of batches.
+"""
+def fan_out(function_name: str) -> int:
+    location_ids = sorted({
+        location_options.locationId
+        for user_options in get_cached_user_options()
+        for location_options in user_options.locationOptionsList
+    })
+    batches = make_batches(location_ids)
+    with ThreadPoolExecutor(LAMBDA_INVOKE_THREADS) as executor:
+        futures = [
+            executor.submit(_invoke, function_name, batch, batch_ids)
+            for batch, batch_ids in sorted(batches.items())
+        ]
+        for future in futures:
+            future.result()
+    logger.info(
+        f"Invoked {len(batches)} batches for {len(location_ids)} locations"
+    )
+    return len(batches)
+
+
+async def _scan(
+    user_options_list: List[UserOptions],
+    get_remaining_ms: Optional[Callable[[], int]],
+) -> None:
+    flush_task = None
+    if get_remaining_ms is not None:
+        flush_task = asyncio.create_task(
+            scanner_utils.flush_before_deadline(get_remaining_ms)
+        )
+    try:
+        await scanner_utils.launch_scanners(
+            user_options_list,
+            transport=get_transport(),
+            close_transport=False,
+        )
+    finally:
+        if flush_task is not None:
+            flush_task.cancel()
+
+
+"""
+Args:
+    batch:          Batch name from the event, "" to scan every location
+    location_ids:   The batch's locations, None to scan every location
+    context:        The AWS Lambda context
+"""
+def scan_batch(
+    batch: str = "",
+    location_ids: Optional[List[int]] = None,
+    context=None,
+) -> None:
+    # The batch name ends up in an S3 key
+    if batch and not re.fullmatch(r"batch-\d+", batch):
+        logger.fatal(f"Invalid batch {batch!r} in the event")
+        raise ValueError(f"Invalid batch {batch!r}")
+    use_seen_store(batch)
+    user_options_list = get_cached_user_options()
+    if location_ids is not None:
+        batch_ids = set(location_ids)
+        user_options_list = shard_user_options(
+            user_options_list, lambda locationId: locationId in batch_ids
+        )
+    get_remaining_ms = None
+    if context is not None:
+        get_remaining_ms = context.get_remaining_time_in_millis
+    get_event_loop().run_until_complete(
+        _scan(user_options_list, get_remaining_ms)
+    )
@@ -33,35 +33,83 @@ As part of the AWS Free Tier, you can get ... 20,000 GET Requests; 2,000 PUT,
 COPY, POST, or LIST Requests; and 100 GB of Data Transfer Out each month.
 """
 
+from typing import Optional
+
 import logging
 
-import boto3
 import os
 import sys
 import traceback
-from scanner_constants import USING_AWS_LAMBDA, S3_BUCKET, S3_PATH
+from scanner_constants import (
+    LAMBDA_VALIDATE_TMP_CACHE,
+    USING_AWS_LAMBDA,
+    S3_BUCKET,
+    S3_PATH,
+)
 from scanner_logger import getScannerLogger
 
 
 logger = getScannerLogger(__name__)
-s3 = boto3.client('s3')
+_s3_client = None
+
+
+# boto3 is slow to import, so only import it and create the client once S3
+# is actually needed
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        _s3_client = boto3.client('s3')
+    return _s3_client
+
+
+# Maps paths under the working directory (e.g. ../configs/foo.json) to
+# /tmp/configs/foo.json so that they cannot escape /tmp
+def get_local_path(path: str) -> str:
+    parts = [
+        part for part in os.path.normpath(path).split(os.path.sep)
+        if part not in ("", ".", "..")
+    ]
+    return os.path.join(os.path.sep, "tmp", *parts)
+
+
+def _read_local(local_path: str) -> Optional[str]:
+    try:
+        with open(local_path, "r") as f:
+            return f.read()
+    except Exception:
+        return None
+
+
+def _write_etag(local_path: str, etag: Optional[str]) -> None:
+    if not etag:
+        return
+    try:
+        with open(local_path + ".etag", "w") as f:
+            f.write(etag)
+    except Exception:
+        pass
 
 
 """
 Desc: Tries to read from /tmp if file exists. Otherwise reads from S3. If that 
 also fails, then this function rethrows the exception.
+
+When LAMBDA_VALIDATE_TMP_CACHE is True, the /tmp copy is only used after a
+conditional GET (If-None-Match with the ETag saved next to it) confirms that
+the S3 object has not changed, e.g. by another container. Unchanged objects
+are not downloaded again.
 """
 def lambda_read(path: str) -> str:
-    try:
-        local_path = os.path.join(os.path.sep, "tmp", path)
-        with open(local_path, "r") as f:
-            data = f.read()
-            logger.info(
-                f"Successfully read {local_path} from lambda "
-                "local storage"
-            )
-            return data
-    except:
+    local_path = get_local_path(path)
+    data = _read_local(local_path)
+    etag = _read_local(local_path + ".etag")
+    if data is not None and (not LAMBDA_VALIDATE_TMP_CACHE or etag is None):
+        logger.info(
+            f"Successfully read {local_path} from lambda local storage"
+        )
+        return data
+    if data is None:
         logger.info(
             f"Failed to read {local_path} from lambda local storage, "
             "falling back on S3"
@@ -69,15 +117,30 @@ def lambda_read(path: str) -> str:
 
     # Read from S3 instead
     s3_path = os.path.join(S3_PATH, path)
+    kwargs = {"Bucket": S3_BUCKET, "Key": s3_path}
+    if data is not None:
+        kwargs["IfNoneMatch"] = etag
     try:
-        data = s3.get_object(Bucket=S3_BUCKET, Key=s3_path)
-        return data['Body'].read()
+        res = get_s3_client().get_object(**kwargs)
     except Exception as e:
+        response = getattr(e, "response", None) or {}
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        if data is not None and status == 304:
+            logger.info(
+                f"{s3_path} unchanged in S3, using {local_path} from lambda "
+                "local storage"
+            )
+            return data
         logger.warning(
             f"Unable to read {s3_path} from S3. Does the file not exist yet?"
         )
         raise e
 
+    data = res['Body'].read().decode()
+    lambda_write(path, data, writethrough=False)
+    _write_etag(local_path, res.get("ETag"))
+    return data
+
 
 """
 Args:
@@ -86,11 +149,17 @@ Args:
                     False.
 """
 def lambda_write(path: str, bytes: str, writethrough: bool = True) -> None:
-    local_path = os.path.join(os.path.sep, "tmp", path)
+    local_path = get_local_path(path)
     try:
-        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
         with open(local_path, "w") as f:
             f.write(bytes)
+        if not writethrough:
+            # /tmp no longer matches S3 until the next writethrough
+            try:
+                os.remove(local_path + ".etag")
+            except FileNotFoundError:
+                pass
     except Exception as e:
         # Swallow exception as we don't really care if we manage
         # to write to ephemeral storage or not
@@ -104,7 +173,10 @@ def lambda_write(path: str, bytes: str, writethrough: bool = True) -> None:
     if writethrough:
         s3_path = os.path.join(S3_PATH, path)
         try:
-            _ = s3.put_object(Bucket=S3_BUCKET, Key=s3_path, Body=bytes)
+            res = get_s3_client().put_object(
+                Bucket=S3_BUCKET, Key=s3_path, Body=bytes
+            )
         except Exception as e:
             logger.warning(f"Unable to write {s3_path} to S3")
             raise e
+        _write_etag(local_path, res.get("ETag"))
@@ -0,0 +1,397 @@
+"""
+scanner_locations.py
+user: vhao
+date: 10-17-2026
+
+Location catalog of each Trusted Traveler Program.
+
+The raw locations list from the TTP website is compiled into a
+LocationCatalog, which indexes the locations by locationId, by state and by
+latitude (for "within N miles" lookups). The catalog is pickled as plain
+tuples next to locations.json, so later starts (and Lambda cold starts, when
+the pickle is uploaded with the other configs) load it directly instead of
+parsing and walking the JSON.
+
+Catalogs older than LOCATIONS_CACHE_TTL are downloaded again when the
+scanner starts, and checked every LOCATIONS_REFRESH_INTERVAL seconds in the
+background while scanning.
+"""
+
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+import asyncio
+import json
+import math
+import os
+import pickle
+import time
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from scanner_constants import (
+    LOCATIONS_CACHE_PATHS,
+    LOCATIONS_CACHE_TTL,
+    LOCATIONS_PATHS,
+    LOCATIONS_REFRESH_INTERVAL,
+    RAW_LOCATIONS_PATHS,
+    REQUEST_TIMEOUT,
+    SELECTED_TTPS,
+    TTP_LOCATIONS_LINKS,
+    USING_AWS_LAMBDA,
+)
+from scanner_logger import getScannerLogger
+
+
+logger = getScannerLogger(__name__)
+
+EARTH_RADIUS_MILES = 3958.8
+# Bump whenever the pickled layout changes so stale caches are rebuilt
+_CACHE_VERSION = 1
+
+
+class Location(NamedTuple):
+    locationId: int
+    name: str
+    shortName: str
+    state: str
+    city: str
+    # Not every location has coordinates
+    latitude: Optional[float]
+    longitude: Optional[float]
+
+
+def _get_coordinate(
+    raw_location: Dict[str, Any],
+    *keys: str,
+) -> Optional[float]:
+    for key in keys:
+        value = raw_location.get(key)
+        if value not in (None, ""):
+            return float(value)
+    return None
+
+
+def miles_between(
+    latitude1: float,
+    longitude1: float,
+    latitude2: float,
+    longitude2: float,
+) -> float:
+    phi1 = math.radians(latitude1)
+    phi2 = math.radians(latitude2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(longitude2 - longitude1)
+    a = (
+        math.sin(dphi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_MILES * math.asin(min(1, math.sqrt(a)))
+
+
+class LocationCatalog:
+    """
+    Args:
+        fetchedAt:  time.time() when the raw locations were downloaded
+    """
+    def __init__(
+        self,
+        program: str,
+        locations: Iterable[Location],
+        fetchedAt: float,
+    ):
+        self.program = program
+        self.fetchedAt = fetchedAt
+        self._by_id: Dict[int, Location] = {}
+        self._by_state: Dict[str, List[Location]] = defaultdict(list)
+        for location in locations:
+            self._by_id[location.locationId] = location
+            self._by_state[location.state.upper()].append(location)
+        # Sorted by latitude so a radius lookup only measures the distance to
+        # locations inside the radius' latitude band
+        self._by_latitude = sorted(
+            (
+                location for location in self._by_id.values()
+                if location.latitude is not None
+                and location.longitude is not None
+            ),
+            key=lambda location: location.latitude,
+        )
+        self._latitudes = [location.latitude for location in self._by_latitude]
+
+    @classmethod
+    def from_raw(
+        cls,
+        program: str,
+        raw_locations: List[Dict[str, Any]],
+        fetchedAt: float,
+    ) -> "LocationCatalog":
+        return cls(
+            program,
+            (
+                Location(
+                    locationId=raw_location["id"],
+                    name=raw_location["name"],
+                    shortName=raw_location.get("shortName", ""),
+                    state=raw_location.get("state") or "",
+                    city=raw_location.get("city") or "",
+                    latitude=_get_coordinate(raw_location, "latitude", "lat"),
+                    longitude=_get_coordinate(
+                        raw_location, "longitude", "lng", "lon"
+                    ),
+                )
+                for raw_location in raw_locations
+            ),
+            fetchedAt,
+        )
+
+    # Plain tuples pickle smaller and load faster than Location instances
+    def to_bytes(self) -> bytes:
+        return pickle.dumps(
+            (
+                _CACHE_VERSION,
+                self.program,
+                self.fetchedAt,
+                [tuple(location) for location in self._by_id.values()],
+            ),
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "LocationCatalog":
+        version, program, fetchedAt, locations = pickle.loads(data)
+        if version != _CACHE_VERSION:
+            raise ValueError(f"Unsupported location cache version {version}")
+        return cls(
+            program, (Location(*location) for location in locations), fetchedAt
+        )
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, locationId: int) -> bool:
+        return locationId in self._by_id
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def get(self, locationId: int) -> Optional[Location]:
+        return self._by_id.get(locationId)
+
+    def in_state(self, state: str) -> List[Location]:
+        return list(self._by_state.get(state.upper(), ()))
+
+    """
+    Desc: Returns the locations within miles of the given coordinates, closest
+    first. Locations without coordinates are never returned.
+    """
+    def within(
+        self,
+        latitude: float,
+        longitude: float,
+        miles: float,
+    ) -> List[Location]:
+        # One degree of latitude is the same distance everywhere
+        band = math.degrees(miles / EARTH_RADIUS_MILES)
+        lo = bisect_left(self._latitudes, latitude - band)
+        hi = bisect_right(self._latitudes, latitude + band)
+        distances = []
+        for location in self._by_latitude[lo:hi]:
+            distance = miles_between(
+                latitude, longitude, location.latitude, location.longitude
+            )
+            if distance <= miles:
+                distances.append((distance, location))
+        distances.sort(key=lambda pair: pair[0])
+        return [location for _, location in distances]
+
+    def is_stale(self, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        return now - self.fetchedAt > LOCATIONS_CACHE_TTL.total_seconds()
+
+
+# Maps programs to their loaded catalogs. Kept for the lifetime of the
+# process so warm lambda invocations do not load them again.
+_catalogs: Dict[str, LocationCatalog] = {}
+
+
+# Formats raw locations JSON into something user readable
+def pretty_fmt_locations(raw_locations: List[Dict]) -> str:
+    state_to_location = defaultdict(list)
+    for location in raw_locations:
+        state = location["state"]
+        state_to_location[state].append({
+            "name": location["name"],
+            "shortName": location["shortName"],
+            "locationId": location["id"],
+        })
+    return json.dumps(state_to_location, indent=4, sort_keys=True)
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _load_cache(program: str) -> Optional[LocationCatalog]:
+    cache_path = LOCATIONS_CACHE_PATHS[program]
+    raw_path = RAW_LOCATIONS_PATHS[program]
+    if not os.path.isfile(cache_path):
+        return None
+    # raw_locations.json may have been replaced by hand since
+    if (
+        os.path.isfile(raw_path)
+        and os.path.getmtime(raw_path) > os.path.getmtime(cache_path)
+    ):
+        return None
+    try:
+        with open(cache_path, "rb") as f:
+            return LocationCatalog.from_bytes(f.read())
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable {cache_path}: {e!r}")
+        return None
+
+
+def _load_raw(program: str) -> Optional[LocationCatalog]:
+    raw_path = RAW_LOCATIONS_PATHS[program]
+    if not os.path.isfile(raw_path):
+        return None
+    with open(raw_path, "r") as f:
+        raw_locations = json.load(f)
+    return LocationCatalog.from_raw(
+        program, raw_locations, os.path.getmtime(raw_path)
+    )
+
+
+"""
+Desc: Writes freshly downloaded raw locations along with the user readable
+locations.json and the compiled cache, and makes them the program's catalog.
+"""
+def _save(
+    program: str,
+    raw_locations: List[Dict[str, Any]],
+) -> LocationCatalog:
+    catalog = LocationCatalog.from_raw(program, raw_locations, time.time())
+    _write_atomic(
+        RAW_LOCATIONS_PATHS[program],
+        json.dumps(raw_locations, indent=4, sort_keys=True).encode(),
+    )
+    _write_atomic(
+        LOCATIONS_PATHS[program], pretty_fmt_locations(raw_locations).encode()
+    )
+    _write_atomic(LOCATIONS_CACHE_PATHS[program], catalog.to_bytes())
+    _swap_catalog(program, catalog)
+    return catalog
+
+
+def _swap_catalog(program: str, catalog: LocationCatalog) -> None:
+    previous = _catalogs.get(program)
+    _catalogs[program] = catalog
+    if previous is not None:
+        added = {location.locationId for location in catalog} - {
+            location.locationId for location in previous
+        }
+        removed = {location.locationId for location in previous} - {
+            location.locationId for location in catalog
+        }
+        if added or removed:
+            logger.info(
+                f"{program} locations changed: {len(added)} added "
+                f"({sorted(added)}), {len(removed)} removed "
+                f"({sorted(removed)})"
+            )
+
+
+"""
+Desc: Returns the program's catalog, loading it from the compiled cache if
+possible and from the raw locations otherwise. Does not download anything.
+"""
+def get_catalog(program: str) -> LocationCatalog:
+    catalog = _catalogs.get(program)
+    if catalog is not None:
+        return catalog
+
+    catalog = _load_cache(program)
+    if catalog is None:
+        catalog = _load_raw(program)
+        if catalog is None:
+            logger.fatal(
+                f"No locations found for {program}, please make sure "
+                f"{RAW_LOCATIONS_PATHS[program]} exists"
+            )
+            raise RuntimeError(f"Missing {program} locations")
+        # Lambda's working directory is read-only, upload the pickle
+        # generated by a local run instead
+        if not USING_AWS_LAMBDA:
+            _write_atomic(LOCATIONS_CACHE_PATHS[program], catalog.to_bytes())
+            if not os.path.isfile(LOCATIONS_PATHS[program]):
+                with open(RAW_LOCATIONS_PATHS[program], "r") as f:
+                    raw_locations = json.load(f)
+                _write_atomic(
+                    LOCATIONS_PATHS[program],
+                    pretty_fmt_locations(raw_locations).encode(),
+                )
+    _catalogs[program] = catalog
+    return catalog
+
+
+"""
+Desc: Downloads the program's locations if there are none yet, or if they
+are older than LOCATIONS_CACHE_TTL. Keeps using the old locations when a
+refresh fails.
+"""
+def refresh_locations(program: str) -> None:
+    try:
+        catalog = get_catalog(program)
+    except RuntimeError:
+        catalog = None
+    if catalog is not None and not catalog.is_stale():
+        return
+
+    link = TTP_LOCATIONS_LINKS[program]
+    logger.info(f"Getting {program} locations from TTP website")
+    import requests
+    try:
+        # A hung request would otherwise block startup forever
+        res = requests.get(link, timeout=REQUEST_TIMEOUT)
+        res.raise_for_status()
+        _save(program, res.json())
+    except Exception as e:
+        if catalog is not None:
+            logger.warning(
+                f"Failed to refresh {program} locations, will keep using "
+                f"the ones from {RAW_LOCATIONS_PATHS[program]}: {e!r}"
+            )
+            return
+        logger.fatal(
+            f"Failed to get raw {program} locations list, if this continues "
+            "to occur, please try to retrieve them manually"
+        )
+        raise e
+
+
+"""
+Desc: Refreshes stale catalogs of the selected programs in the background,
+sharing the scanners' transport.
+
+Args:
+    transport:  scanner_transport.Transport
+"""
+async def refresh_locations_periodically(
+    transport,
+    interval: float = LOCATIONS_REFRESH_INTERVAL,
+) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        for program in SELECTED_TTPS:
+            if not get_catalog(program).is_stale():
+                continue
+            logger.info(f"{program} locations are stale, refreshing...")
+            try:
+                res = await transport.get(TTP_LOCATIONS_LINKS[program])
+                if not res.ok:
+                    raise RuntimeError(f"Status code {res.status_code}")
+                _save(program, res.json())
+            except Exception as e:
+                logger.warning(f"Failed to refresh {program} locations: {e!r}")
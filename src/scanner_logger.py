@@ -1,28 +1,206 @@
-from cmath import log
-import logging
+"""
+scanner_logger.py
+user: vhao
+date: 03-27-2022
+
+Logging setup shared by every scanner module.
+
+All scanner loggers are children of a single "scanner" logger whose handlers
+(stdout, plus the log file when running locally) are set up exactly once.
+
+When LOG_ASYNC is set, records are only put on a queue by the logging call,
+and a background thread formats and writes them, so slow stdout/file writes
+never block the event loop. Messages should use %-style arguments (or
+LazyFormat for expensive values) so that formatting also happens on that
+thread, and only for records which are actually written.
+
+LOG_FORMAT = "json" writes one JSON object per line instead of plain text,
+with any extra={...} fields included. Records logged with
+extra={"sample_key": ...} are sampled: at most one record per key is written
+every LOG_SAMPLE_INTERVAL seconds, the next one noting how many were dropped.
+"""
 
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import atexit
+import json
+import logging
+import logging.handlers
 import os
+import queue
 import sys
-from scanner_constants import LOGS_PATH, USING_AWS_LAMBDA
+import time
+from scanner_constants import (
+    LOG_ASYNC,
+    LOG_FORMAT,
+    LOG_SAMPLE_INTERVAL,
+    LOGS_PATH,
+    USING_AWS_LAMBDA,
+)
+
+
+ROOT_LOGGER_NAME = "scanner"
+TEXT_FORMAT = (
+    "%(asctime)s %(threadName)s %(filename)s:%(funcName)s:%(lineno)d "
+    "[%(levelname)s]: %(message)s"
+)
+
+_root_logger: Optional[logging.Logger] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+"""
+Desc: Defers an expensive log argument until the record is written, e.g.
+logger.debug("Sending %s", LazyFormat(pretty_fmt_req, "GET", url)).
+"""
+class LazyFormat:
+    def __init__(self, fn: Callable[..., Any], *args, **kwargs):
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+
+    def __str__(self) -> str:
+        return str(self._fn(*self._args, **self._kwargs))
+
+
+# Attributes every LogRecord has, anything else came from extra={...}
+_RECORD_ATTRS = set(
+    logging.LogRecord("", 0, "", 0, "", (), None).__dict__
+) | {"message", "asctime", "suppressed"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "func": record.funcName,
+            "line": record.lineno,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
 
-def getScannerLogger(name: str) -> logging.Logger:
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
-    logfmt = "%(asctime)s %(threadName)s %(filename)s:%(funcName)s:%(lineno)d [%(levelname)s]: %(message)s"
-    log_formatter = logging.Formatter(logfmt)
 
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setFormatter(log_formatter)
-    ch.setLevel(logging.DEBUG if USING_AWS_LAMBDA else logging.INFO)
-    logger.addHandler(ch)
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            message += f" ({suppressed} similar messages suppressed)"
+        return message
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, interval: float = LOG_SAMPLE_INTERVAL):
+        super().__init__()
+        self._interval = interval
+        # Maps sample keys to (time last written, records dropped since)
+        self._state: Dict[Hashable, Tuple[float, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample_key", None)
+        if key is None or self._interval <= 0:
+            return True
+        now = time.monotonic()
+        last, dropped = self._state.get(key, (None, 0))
+        if last is not None and now - last < self._interval:
+            self._state[key] = (last, dropped + 1)
+            return False
+        self._state[key] = (now, 0)
+        record.suppressed = dropped
+        return True
+
+
+# Primitive args are safe to format later, on the listener thread
+_DEFERRABLE_TYPES = (str, int, float, bool, type(None), LazyFormat)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Desc: Unlike QueueHandler.prepare, does not format the message before
+    queueing it. Messages with mutable arguments (which could change before
+    the listener gets to them) are still formatted right away.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        args = record.args
+        if args and not (
+            isinstance(args, tuple)
+            and all(isinstance(arg, _DEFERRABLE_TYPES) for arg in args)
+        ):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def _create_handlers():
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(
+        TEXT_FORMAT
+    )
+    handlers = []
+
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setFormatter(formatter)
+    stdout_handler.setLevel(
+        logging.DEBUG if USING_AWS_LAMBDA else logging.INFO
+    )
+    handlers.append(stdout_handler)
 
     if not USING_AWS_LAMBDA:
         os.makedirs(os.path.dirname(LOGS_PATH), exist_ok=True)
-        fh = logging.FileHandler(LOGS_PATH, "w")
-        fh.setFormatter(log_formatter)
-        fh.setLevel(logging.DEBUG)
-        logger.addHandler(fh)
+        file_handler = logging.FileHandler(LOGS_PATH, "w")
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(logging.DEBUG)
+        handlers.append(file_handler)
+    return handlers
+
+
+def _configure() -> logging.Logger:
+    global _listener
+
+    root_logger = logging.getLogger(ROOT_LOGGER_NAME)
+    root_logger.setLevel(logging.DEBUG)
+    # Prevent log duplication in AWS lambda, whose root logger has a handler
+    root_logger.propagate = False
+
+    handlers = _create_handlers()
+    # Lambda freezes the process between invocations, which could strand
+    # records in the queue, so it always logs synchronously
+    if LOG_ASYNC and not USING_AWS_LAMBDA:
+        queue_handler = LazyQueueHandler(queue.SimpleQueue())
+        queue_handler.addFilter(SamplingFilter())
+        root_logger.addHandler(queue_handler)
+        _listener = logging.handlers.QueueListener(
+            queue_handler.queue, *handlers, respect_handler_level=True
+        )
+        _listener.start()
+        atexit.register(stop_logging)
     else:
-        logger.propagate = False # Prevent log duplication in AWS lambda
+        for handler in handlers:
+            handler.addFilter(SamplingFilter())
+            root_logger.addHandler(handler)
+    return root_logger
 
-    return logger
\ No newline at end of file
+
+# Writes out any queued records and stops the listener thread
+def stop_logging() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def getScannerLogger(name: str) -> logging.Logger:
+    global _root_logger
+    if _root_logger is None:
+        _root_logger = _configure()
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
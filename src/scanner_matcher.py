@@ -0,0 +1,205 @@
+"""
+scanner_matcher.py
+user: vhao
+date: 10-17-2026
+
+Matches appointment start times against the user's preferred dates/times.
+
+Each user date range is kept as a single recurring daily window (first day,
+last day, daily start minute, daily end minute) instead of being expanded
+into one entry per day. Windows are kept sorted by their first day so that a
+timestamp can be matched with a binary search.
+
+Compiled matchers are cached by their date ranges (compile_date_ranges), so
+reloading the config only compiles the date ranges which changed.
+"""
+
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import json
+from bisect import bisect_right
+from datetime import date, datetime, time, timedelta
+
+
+class DailyWindow(NamedTuple):
+    # date.toordinal() of the first and last day (inclusive)
+    firstDay: int
+    lastDay: int
+    # Minutes since midnight (inclusive)
+    startMinute: int
+    endMinute: int
+
+
+"""
+Desc: Parses a TTP API timestamp such as "2022-07-10T08:00" into its day
+ordinal and minute of day.
+"""
+def parse_timestamp(timestamp: str) -> Tuple[int, int]:
+    dt = datetime.fromisoformat(timestamp)
+    return dt.toordinal(), dt.hour * 60 + dt.minute
+
+
+# Non-ISO date formats which the date range config has accepted, tried in
+# order after date.fromisoformat
+_DATE_FORMATS: Tuple[str, ...] = (
+    "%m/%d/%Y",
+    "%Y/%m/%d",
+    "%m-%d-%Y",
+    "%B %d %Y",
+    "%B %d, %Y",
+    "%b %d %Y",
+    "%b %d, %Y",
+    "%d %B %Y",
+    "%d %b %Y",
+)
+
+
+"""
+Desc: Parses a "startDate"/"endDate" value. Returns None when it is not in a
+known format.
+"""
+def _parse_date(value: str) -> Optional[date]:
+    value = value.strip()
+    try:
+        return datetime.fromisoformat(value).date()
+    except ValueError:
+        pass
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    return None
+
+
+"""
+Desc: Combines a "startDate"/"endDate" with a daily time using dtfmt. The
+date is normalised to YYYY-MM-DD first (as the config has always been read),
+and is only passed to dtfmt as written when it is not a date format we know.
+"""
+def _parse_date_time(day: str, daily_time: str, dtfmt: str) -> datetime:
+    parsed = _parse_date(day)
+    if parsed is not None:
+        day = parsed.strftime("%Y-%m-%d")
+    return datetime.strptime(day + " " + daily_time, dtfmt)
+
+
+class AppointmentMatcher:
+    def __init__(self, windows: Iterable[DailyWindow]):
+        self._windows: List[DailyWindow] = sorted(windows)
+        self._first_days = [window.firstDay for window in self._windows]
+        # _max_last_days[i] is the latest lastDay among windows[:i+1], which
+        # lets a lookup stop scanning backwards as soon as no earlier window
+        # can still cover the day
+        self._max_last_days: List[int] = []
+        max_last_day = -1
+        for window in self._windows:
+            max_last_day = max(max_last_day, window.lastDay)
+            self._max_last_days.append(max_last_day)
+
+    """
+    Args:
+        date_ranges:    "dateRanges" entries from user_options.json
+        dtfmt:          "dateTimeFormat" from user_options.json
+    """
+    @classmethod
+    def from_date_ranges(
+        cls,
+        date_ranges: Iterable[dict],
+        dtfmt: str,
+    ) -> "AppointmentMatcher":
+        windows = []
+        for date_range in date_ranges:
+            start = _parse_date_time(
+                date_range["startDate"], date_range["dailyStartTime"], dtfmt
+            )
+            end = _parse_date_time(
+                date_range["endDate"], date_range["dailyEndTime"], dtfmt
+            )
+            windows.append(DailyWindow(
+                firstDay=start.toordinal(),
+                lastDay=end.toordinal(),
+                startMinute=start.hour * 60 + start.minute,
+                endMinute=end.hour * 60 + end.minute,
+            ))
+        return cls(windows)
+
+    @property
+    def windows(self) -> List[DailyWindow]:
+        return list(self._windows)
+
+    # The latest start time which could match, None if nothing can match
+    @property
+    def latest(self) -> Optional[datetime]:
+        if not self._windows:
+            return None
+        last_day = self._max_last_days[-1]
+        end_minute = max(
+            window.endMinute for window in self._windows
+            if window.lastDay == last_day
+        )
+        return datetime.combine(
+            date.fromordinal(last_day), time()
+        ) + timedelta(minutes=end_minute)
+
+    def matches_parsed(self, day: int, minute: int) -> bool:
+        i = bisect_right(self._first_days, day) - 1
+        while i >= 0 and self._max_last_days[i] >= day:
+            window = self._windows[i]
+            if (
+                window.lastDay >= day and
+                window.startMinute <= minute <= window.endMinute
+            ):
+                return True
+            i -= 1
+        return False
+
+    def matches(self, timestamp: str) -> bool:
+        return self.matches_parsed(*parse_timestamp(timestamp))
+
+    """
+    Desc: Returns the start times of the matching appointments formatted as
+    "%Y-%m-%d %H:%M" strings.
+    """
+    def filter(self, appointments: Iterable[dict]) -> Set[str]:
+        valid_appointments = set()
+        for appointment in appointments:
+            timestamp = appointment["startTimestamp"]
+            if self.matches(timestamp):
+                valid_appointments.add(timestamp[:16].replace("T", " "))
+        return valid_appointments
+
+
+# Maps (dateRanges as JSON, dateTimeFormat) to the compiled matcher
+_compiled: Dict[Tuple[str, str], AppointmentMatcher] = {}
+_MAX_COMPILED = 4096
+
+
+"""
+Desc: AppointmentMatcher.from_date_ranges, reusing the matcher compiled for
+identical date ranges. Matchers are never modified once built, so they can
+be shared between locations and users.
+"""
+def compile_date_ranges(
+    date_ranges: Iterable[dict],
+    dtfmt: str,
+) -> AppointmentMatcher:
+    date_ranges = list(date_ranges)
+    key = (json.dumps(date_ranges, sort_keys=True), dtfmt)
+    matcher = _compiled.get(key)
+    if matcher is None:
+        if len(_compiled) >= _MAX_COMPILED:
+            # Drop the oldest entry
+            del _compiled[next(iter(_compiled))]
+        matcher = _compiled[key] = AppointmentMatcher.from_date_ranges(
+            date_ranges, dtfmt
+        )
+    return matcher
@@ -0,0 +1,366 @@
+"""
+scanner_metrics.py
+user: vhao
+date: 10-17-2026
+
+In-process metrics: counters, gauges and fixed-bucket histograms, keyed by
+metric name and labels. Every metric the scanner records is declared in
+METRIC_FAMILIES below.
+
+The registry can be exported three ways (METRICS_EXPORT in
+scanner_constants.py):
+    "prometheus"    Prometheus text format served on METRICS_PORT
+    "json"          A JSON snapshot rewritten every METRICS_SNAPSHOT_INTERVAL
+                    seconds to METRICS_SNAPSHOT_PATH
+On AWS Lambda, counters and histogram observations recorded during the
+invocation are printed as CloudWatch Embedded Metric Format (EMF) lines
+instead, which CloudWatch turns into metrics without any API calls.
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import asyncio
+import json
+import math
+import os
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from scanner_constants import (
+    METRICS_EMF_NAMESPACE,
+    METRICS_EXPORT,
+    METRICS_PORT,
+    METRICS_SNAPSHOT_INTERVAL,
+    METRICS_SNAPSHOT_PATH,
+)
+from scanner_logger import getScannerLogger
+
+
+logger = getScannerLogger(__name__)
+
+# Sorted (name, value) label pairs
+Labels = Tuple[Tuple[str, str], ...]
+
+# Seconds
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 120, 300, 600,
+)
+# EMF allows at most 100 values per metric in one line
+_EMF_MAX_VALUES = 100
+
+# Maps metric names to (type, help)
+METRIC_FAMILIES: Dict[str, Tuple[str, str]] = {
+    "ttp_request_seconds": (
+        "histogram",
+        "TTP API request latency including retries, by endpoint",
+    ),
+    "ttp_responses_total": (
+        "counter", "TTP API responses by endpoint and status code",
+    ),
+    "ttp_retries_total": (
+        "counter", "Retried TTP API requests by endpoint",
+    ),
+    "ttp_backoff_seconds_total": (
+        "counter", "Seconds spent backing off before retries, by endpoint",
+    ),
+    "ttp_retries_exhausted_total": (
+        "counter", "TTP API requests which ran out of retries, by endpoint",
+    ),
+    "ttp_circuit_open": (
+        "gauge", "1 while the circuit breaker for the host is open",
+    ),
+    "ttp_circuit_rejected_total": (
+        "counter", "Requests rejected by an open circuit breaker, by host",
+    ),
+    "scanner_restarts_total": (
+        "counter", "Scanner polls which raised and were restarted",
+    ),
+    "scanner_poll_lag_seconds": (
+        "histogram", "Seconds between when a poll was due and dispatched",
+    ),
+    "scanner_location_poll_lag_seconds": (
+        "gauge", "Lag of the last poll of each location",
+    ),
+    "scanner_slot_to_notify_seconds": (
+        "histogram",
+        "Seconds from a slot first being seen by scan() to the user being "
+        "notified about it",
+    ),
+    "scanner_slots_stopped_early_total": (
+        "counter",
+        "/slots responses which were not read past the last start time any "
+        "subscriber wants",
+    ),
+    "scanner_notifications_total": (
+        "counter", "Notification sends by channel and result",
+    ),
+    "scanner_loop_lag_seconds": (
+        "histogram", "Seconds the event loop ran the watchdog's timer late",
+    ),
+    "scanner_loop_blocked_total": (
+        "counter",
+        "Times the event loop was blocked for over LOOP_BLOCK_THRESHOLD",
+    ),
+    "scanner_executor_queued": (
+        "gauge", "Jobs waiting for a thread of the default executor",
+    ),
+    "scanner_executor_active": (
+        "gauge", "Jobs running on the default executor's threads",
+    ),
+}
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # counts[i] is the number of observations <= buckets[i], the last
+        # count is for +Inf. Not cumulative, see cumulative_counts.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        # Observations not yet emitted as EMF
+        self.recent: List[float] = []
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if len(self.recent) < _EMF_MAX_VALUES:
+            self.recent.append(value)
+
+    def cumulative_counts(self) -> List[int]:
+        total = 0
+        cumulative = []
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+    # Upper bound of the bucket holding the given quantile
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0
+        rank = q * self.count
+        for bound, total in zip(
+            self.buckets + (math.inf,), self.cumulative_counts()
+        ):
+            if total >= rank:
+                return bound
+        return math.inf
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._counters: Dict[str, Dict[Labels, float]] = defaultdict(dict)
+        self._gauges: Dict[str, Dict[Labels, float]] = defaultdict(dict)
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = (
+            defaultdict(dict)
+        )
+        # Counter values at the last EMF flush
+        self._emitted: Dict[Tuple[str, Labels], float] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        series = self._counters[name]
+        key = _labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        self._gauges[name][_labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        series = self._histograms[name]
+        key = _labels(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def get_histogram(self, name: str, **labels) -> Optional[Histogram]:
+        return self._histograms.get(name, {}).get(_labels(labels))
+
+    def clear(self) -> None:
+        self._counters.clear()
+        self._gauges.clear()
+        self._histograms.clear()
+        self._emitted.clear()
+
+    def to_prometheus(self) -> str:
+        lines = []
+
+        def fmt_labels(labels: Labels, extra: Labels = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return ""
+            return "{" + ",".join(
+                f'{name}="{value}"' for name, value in pairs
+            ) + "}"
+
+        for name, (kind, help_text) in METRIC_FAMILIES.items():
+            if kind == "histogram":
+                series = self._histograms.get(name)
+            elif kind == "counter":
+                series = self._counters.get(name)
+            else:
+                series = self._gauges.get(name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(series.items()):
+                if kind != "histogram":
+                    lines.append(f"{name}{fmt_labels(labels)} {value}")
+                    continue
+                bounds = value.buckets + (math.inf,)
+                for bound, total in zip(bounds, value.cumulative_counts()):
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    lines.append(
+                        f"{name}_bucket{fmt_labels(labels, (('le', le),))} "
+                        f"{total}"
+                    )
+                lines.append(f"{name}_sum{fmt_labels(labels)} {value.sum}")
+                lines.append(f"{name}_count{fmt_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        def series_list(series, fmt):
+            return [
+                {"labels": dict(labels), **fmt(value)}
+                for labels, value in sorted(series.items())
+            ]
+
+        return {
+            "timestamp": time.time(),
+            "counters": {
+                name: series_list(series, lambda value: {"value": value})
+                for name, series in self._counters.items()
+            },
+            "gauges": {
+                name: series_list(series, lambda value: {"value": value})
+                for name, series in self._gauges.items()
+            },
+            "histograms": {
+                name: series_list(series, lambda histogram: {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "p99": histogram.quantile(0.99),
+                })
+                for name, series in self._histograms.items()
+            },
+        }
+
+    """
+    Desc: Returns EMF lines for the counter increments and histogram
+    observations since the last call. Gauges are left out since the per
+    location ones would be a CloudWatch dimension per location.
+    """
+    def to_emf(self, namespace: str = METRICS_EMF_NAMESPACE) -> List[str]:
+        timestamp = int(time.time() * 1000)
+        lines = []
+
+        def emf_line(name, labels, value, unit) -> str:
+            return json.dumps({
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": namespace,
+                        "Dimensions": [[label for label, _ in labels]],
+                        "Metrics": [{"Name": name, "Unit": unit}],
+                    }],
+                },
+                **dict(labels),
+                name: value,
+            })
+
+        for name, series in self._counters.items():
+            for labels, value in sorted(series.items()):
+                delta = value - self._emitted.get((name, labels), 0)
+                self._emitted[(name, labels)] = value
+                if delta:
+                    unit = "Seconds" if name.endswith("_seconds_total") else (
+                        "Count"
+                    )
+                    lines.append(emf_line(name, labels, delta, unit))
+        for name, series in self._histograms.items():
+            for labels, histogram in sorted(series.items()):
+                if histogram.recent:
+                    lines.append(
+                        emf_line(name, labels, histogram.recent, "Seconds")
+                    )
+                    histogram.recent = []
+        return lines
+
+
+metrics = MetricsRegistry()
+
+
+def write_snapshot(path: str = METRICS_SNAPSHOT_PATH) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(metrics.snapshot(), f, indent=4)
+    os.replace(tmp_path, path)
+
+
+async def _write_snapshots(interval: float) -> None:
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            write_snapshot()
+    finally:
+        # One last snapshot on shutdown
+        write_snapshot()
+
+
+async def _serve_prometheus(port: int) -> None:
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(
+            text=metrics.to_prometheus(),
+            content_type="text/plain",
+            headers={"X-Content-Type-Options": "nosniff"},
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    logger.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+"""
+Desc: Starts the exporter picked by METRICS_EXPORT, returns its task (None
+when metrics are not exported). Cancel the task to stop exporting.
+"""
+def start_exporter(
+    kind: str = METRICS_EXPORT,
+) -> Optional[asyncio.Task]:
+    if kind == "prometheus":
+        return asyncio.create_task(_serve_prometheus(METRICS_PORT))
+    elif kind == "json":
+        return asyncio.create_task(
+            _write_snapshots(METRICS_SNAPSHOT_INTERVAL)
+        )
+    elif kind:
+        logger.fatal(f"Unknown METRICS_EXPORT {kind!r}")
+        raise ValueError(f"Unknown METRICS_EXPORT {kind!r}")
+    return None
+
+
+# Prints the metrics recorded since the last call as EMF lines. Printed
+# rather than logged since CloudWatch only parses lines which are pure JSON.
+def emit_emf() -> None:
+    for line in metrics.to_emf():
+        print(line, flush=True)
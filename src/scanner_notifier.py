@@ -0,0 +1,390 @@
+"""
+scanner_notifier.py
+user: vhao
+date: 10-17-2026
+
+Non-blocking notification pipeline.
+
+notify() only submits a Finding to the NotificationDispatcher and returns
+immediately. Findings for the same recipient which arrive within
+NOTIFY_DIGEST_WINDOW seconds are combined into a single digest message, which
+is then sent by one of NOTIFY_WORKERS worker tasks. Each recipient is sent at
+most one message every NOTIFY_MIN_INTERVAL seconds, and failed sends are
+retried with exponential backoff.
+
+Messages are delivered through pluggable NotificationSenders, one per
+channel ("sms", "email"). The blocking Twilio and SMTP clients are run in the
+default executor so a slow send never stalls the location scanners.
+"""
+
+from typing import (
+    Callable,
+    ContextManager,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import asyncio
+import functools
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from scanner_constants import (
+    NOTIFY_DIGEST_WINDOW,
+    NOTIFY_MIN_INTERVAL,
+    NOTIFY_RETRIES,
+    NOTIFY_RETRY_BACKOFF,
+    NOTIFY_WORKERS,
+)
+from scanner_logger import getScannerLogger
+from scanner_metrics import metrics
+from scanner_seen_store import seen_key
+from scanner_types import EmailOptions, Finding, TwilioOptions
+
+
+logger = getScannerLogger(__name__)
+
+
+class NotificationSender:
+    channel: str = ""
+
+    def format(self, findings: List[Finding]) -> Tuple[str, str]:
+        subject = _format_subject(findings)
+        lines = [subject]
+        for finding in findings:
+            lines.append(f"Appointment Location: {finding.locationName}")
+            lines.append(f"Appointment Times: {finding.appointments}")
+        return subject, "\n".join(lines)
+
+    async def send(self, recipient: str, subject: str, body: str) -> None:
+        raise NotImplementedError
+
+
+class TwilioSmsSender(NotificationSender):
+    channel = "sms"
+    # Only list this many times per location to keep texts short
+    max_times_per_location = 3
+
+    def __init__(self, twilio_options: TwilioOptions):
+        self._twilio_options = twilio_options
+        self._from_number = twilio_options.number
+        self._client = None
+
+    # Runs in the executor. twilio is slow to import, so the client is only
+    # created when the first text is sent, not every time the config loads.
+    def _create_message(self, recipient: str, body: str):
+        if self._client is None:
+            from twilio.rest import Client as TwilioClient
+            self._client = TwilioClient(
+                self._twilio_options.sid, self._twilio_options.auth
+            )
+        return self._client.messages.create(
+            body=body, from_=self._from_number, to=recipient
+        )
+
+    def format(self, findings: List[Finding]) -> Tuple[str, str]:
+        subject = _format_subject(findings)
+        body = subject
+        for finding in findings:
+            appointments = finding.appointments
+            truncate = min(len(appointments), self.max_times_per_location)
+            body += (
+                f"\nAppointment Location: {finding.locationName}\n"
+                f"Appointment Times: {appointments[:truncate]}"
+            )
+            if len(appointments) > truncate:
+                body += (
+                    f" as well as {len(appointments) - truncate} more! "
+                    f"To see all times, please check the {finding.program} "
+                    "website."
+                )
+        return subject, body
+
+    async def send(self, recipient: str, subject: str, body: str) -> None:
+        loop = asyncio.get_running_loop()
+        message = await loop.run_in_executor(
+            None, self._create_message, recipient, body
+        )
+        # We assume success since not using StatusCallback URL
+        logger.debug("Successfully sent text with message sid %s", message.sid)
+
+
+class SmtpEmailSender(NotificationSender):
+    channel = "email"
+
+    def __init__(self, email_options: EmailOptions):
+        self._options = email_options
+
+    def _send_blocking(self, recipient: str, subject: str, body: str) -> None:
+        import smtplib
+        from email.message import EmailMessage
+
+        options = self._options
+        message = EmailMessage()
+        message["Subject"] = subject
+        message["From"] = options.sender or options.username
+        message["To"] = recipient
+        message.set_content(body)
+
+        with smtplib.SMTP(options.host, options.port, timeout=30) as smtp:
+            if options.useTls:
+                smtp.starttls()
+            if options.username:
+                smtp.login(options.username, options.password)
+            smtp.send_message(message)
+
+    async def send(self, recipient: str, subject: str, body: str) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None,
+            functools.partial(self._send_blocking, recipient, subject, body)
+        )
+
+
+@dataclass
+class _FindingState:
+    finding: Finding
+    on_delivered: Callable[[Finding], None]
+    on_failed: Callable[[Finding], None]
+    # Number of channels which have not reported back yet
+    remaining: int
+    delivered: bool = False
+
+
+@dataclass
+class _Digest:
+    channel: str
+    recipient: str
+    states: List[_FindingState] = field(default_factory=list)
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+class NotificationDispatcher:
+    """
+    Args:
+        batch:  Returns a context inside which the findings of a digest are
+                reported delivered, so that they are persisted together
+    """
+    def __init__(
+        self,
+        digest_window: float = NOTIFY_DIGEST_WINDOW,
+        workers: int = NOTIFY_WORKERS,
+        min_interval: float = NOTIFY_MIN_INTERVAL,
+        retries: int = NOTIFY_RETRIES,
+        batch: Callable[[], ContextManager] = nullcontext,
+    ):
+        self._batch = batch
+        self._digest_window = digest_window
+        self._num_workers = workers
+        self._min_interval = min_interval
+        self._retries = retries
+        self._senders: Dict[str, NotificationSender] = {}
+        self._digests: Dict[Tuple[str, str], _Digest] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._last_sent: Dict[Tuple[str, str], float] = {}
+        self._recipient_locks: Dict[Tuple[str, str], asyncio.Lock] = (
+            defaultdict(asyncio.Lock)
+        )
+        # Maps seen_keys to appointments which are waiting to be delivered
+        self._pending: Dict[str, Set[str]] = defaultdict(set)
+
+    def set_sender(self, sender: NotificationSender) -> None:
+        self._senders[sender.channel] = sender
+
+    def has_sender(self, channel: str) -> bool:
+        return channel in self._senders
+
+    def pending(self, key: str) -> Set[str]:
+        return self._pending.get(key, set())
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        # asyncio primitives belong to the loop they are first used on, and
+        # a warm lambda runs each invocation in a new loop
+        self._queue = asyncio.Queue()
+        self._recipient_locks = defaultdict(asyncio.Lock)
+        self._workers = [
+            asyncio.create_task(self._worker())
+            for _ in range(self._num_workers)
+        ]
+
+    """
+    Desc: Queues a finding for every (channel, recipient) pair. on_delivered
+    is called once the finding reached the user through at least one channel,
+    on_failed if every channel failed.
+    """
+    def submit(
+        self,
+        finding: Finding,
+        recipients: List[Tuple[str, str]],
+        on_delivered: Callable[[Finding], None],
+        on_failed: Callable[[Finding], None],
+    ) -> None:
+        recipients = [
+            (channel, recipient) for channel, recipient in recipients
+            if channel in self._senders
+        ]
+        if not recipients:
+            on_failed(finding)
+            return
+        self.start()
+
+        key = seen_key(finding.userId, finding.locationId)
+        self._pending[key].update(finding.appointments)
+        state = _FindingState(
+            finding, on_delivered, on_failed, remaining=len(recipients)
+        )
+        loop = asyncio.get_running_loop()
+        for key in recipients:
+            digest = self._digests.get(key)
+            if digest is None:
+                digest = _Digest(*key)
+                digest.timer = loop.call_later(
+                    self._digest_window, self._enqueue, key
+                )
+                self._digests[key] = digest
+            digest.states.append(state)
+
+    def _enqueue(self, key: Tuple[str, str]) -> None:
+        digest = self._digests.pop(key, None)
+        if digest is None:
+            return
+        if digest.timer is not None:
+            digest.timer.cancel()
+        self._queue.put_nowait(digest)
+
+    async def _worker(self) -> None:
+        while True:
+            digest = await self._queue.get()
+            try:
+                await self._deliver(digest)
+            except Exception:
+                logger.exception("Unexpected error delivering notification")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, digest: _Digest) -> None:
+        key = (digest.channel, digest.recipient)
+        success = False
+        try:
+            sender = self._senders[digest.channel]
+            findings = _merge_findings(
+                [state.finding for state in digest.states]
+            )
+            subject, body = sender.format(findings)
+
+            async with self._recipient_locks[key]:
+                for attempt in range(self._retries + 1):
+                    wait = self._last_sent.get(key, 0) + self._min_interval
+                    wait -= time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    try:
+                        logger.info(
+                            "Sending %s to %s about %d location(s)...",
+                            digest.channel, digest.recipient, len(findings),
+                        )
+                        self._last_sent[key] = time.monotonic()
+                        await sender.send(digest.recipient, subject, body)
+                        success = True
+                        break
+                    except Exception as e:
+                        backoff = NOTIFY_RETRY_BACKOFF * (2 ** attempt)
+                        logger.warning(
+                            f"Failed to send {digest.channel} to "
+                            f"{digest.recipient} (attempt {attempt + 1}/"
+                            f"{self._retries + 1}): {e!r}"
+                        )
+                        if attempt < self._retries:
+                            await asyncio.sleep(backoff)
+        finally:
+            metrics.inc(
+                "scanner_notifications_total",
+                channel=digest.channel,
+                result="sent" if success else "failed",
+            )
+            self._finish(digest, success)
+
+    """
+    Desc: Reports a digest's outcome to its findings' callbacks. A callback
+    which raises is logged without affecting the other findings, and the
+    appointments of every finished finding stop being pending even if
+    recording them fails.
+    """
+    def _finish(self, digest: _Digest, success: bool) -> None:
+        finished = []
+        for state in digest.states:
+            state.remaining -= 1
+            if state.remaining == 0:
+                finished.append(state)
+        try:
+            with self._batch():
+                for state in digest.states:
+                    if success and not state.delivered:
+                        state.delivered = True
+                        _run_callback(state.on_delivered, state.finding)
+                    if state.remaining == 0 and not state.delivered:
+                        _run_callback(state.on_failed, state.finding)
+        finally:
+            for state in finished:
+                finding = state.finding
+                self._pending[
+                    seen_key(finding.userId, finding.locationId)
+                ].difference_update(finding.appointments)
+
+    # Sends every buffered digest right away and waits until all are done
+    async def drain(self) -> None:
+        for key in list(self._digests):
+            self._enqueue(key)
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self) -> None:
+        await self.drain()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+def _run_callback(
+    callback: Callable[[Finding], None],
+    finding: Finding,
+) -> None:
+    try:
+        callback(finding)
+    except Exception:
+        logger.exception(
+            "Notification callback failed for location %s",
+            finding.locationId,
+        )
+
+
+def _format_subject(findings: List[Finding]) -> str:
+    programs = "/".join(sorted({finding.program for finding in findings}))
+    return f"[{programs} SCANNER]: Preferred appointment(s) available!"
+
+
+# Combines findings for the same location into one
+def _merge_findings(findings: List[Finding]) -> List[Finding]:
+    merged: Dict[int, Finding] = {}
+    for finding in findings:
+        if finding.locationId in merged:
+            existing = merged[finding.locationId]
+            existing.appointments = sorted(
+                set(existing.appointments) | set(finding.appointments)
+            )
+        else:
+            merged[finding.locationId] = Finding(
+                finding.locationId,
+                finding.locationName,
+                list(finding.appointments),
+                program=finding.program,
+            )
+    return sorted(merged.values(), key=lambda finding: finding.locationName)
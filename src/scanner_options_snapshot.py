@@ -0,0 +1,120 @@
+"""
+scanner_options_snapshot.py
+user: vhao
+date: 10-17-2026
+
+Snapshot of the compiled user options (UserOptions with their
+AppointmentMatchers and resolved locations), so that starts where nothing
+changed skip parsing the config, loading the location catalogs and
+compiling date ranges.
+
+The snapshot is a pickle of (key, user options). The key hashes everything
+the result depends on: the config file, the location catalog of every
+selected program and the selected programs themselves. A snapshot whose key
+does not match is ignored, and replaced once the config has been parsed.
+"""
+
+from typing import List, Optional
+
+import hashlib
+import os
+import pickle
+from scanner_constants import (
+    DEFAULT_TTP,
+    LOCATIONS_CACHE_PATHS,
+    RAW_LOCATIONS_PATHS,
+    SELECTED_TTPS,
+    USER_OPTIONS_SNAPSHOT_PATH,
+    USING_AWS_LAMBDA,
+)
+from scanner_logger import getScannerLogger
+from scanner_types import UserOptions
+
+
+logger = getScannerLogger(__name__)
+
+# Bump whenever UserOptions, LocationOptions or AppointmentMatcher change so
+# stale snapshots are ignored
+_SNAPSHOT_VERSION = 1
+
+
+# Where snapshots are read from, the first one is also where they are written
+def _snapshot_paths() -> List[str]:
+    if USING_AWS_LAMBDA:
+        from scanner_lambdas_utils import get_local_path
+
+        # The working directory is read-only on lambda
+        return [
+            get_local_path(USER_OPTIONS_SNAPSHOT_PATH),
+            USER_OPTIONS_SNAPSHOT_PATH,
+        ]
+    return [USER_OPTIONS_SNAPSHOT_PATH]
+
+
+def _hash_file(digest, path: str) -> None:
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        data = b""
+    digest.update(len(data).to_bytes(8, "big"))
+    digest.update(data)
+
+
+def file_digest(path: str) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    _hash_file(digest, path)
+    return digest.digest()
+
+
+"""
+Desc: Hashes the config file and what parsing it depends on. Catalogs are
+hashed through their compiled pickle when there is one, since that is what
+gets loaded.
+"""
+def snapshot_key(config_path: str) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(
+        repr((_SNAPSHOT_VERSION, SELECTED_TTPS, DEFAULT_TTP)).encode()
+    )
+    _hash_file(digest, config_path)
+    for program in SELECTED_TTPS:
+        catalog_path = LOCATIONS_CACHE_PATHS[program]
+        if not os.path.isfile(catalog_path):
+            catalog_path = RAW_LOCATIONS_PATHS[program]
+        _hash_file(digest, catalog_path)
+    return digest.digest()
+
+
+# Returns the snapshotted user options, None if there is no valid snapshot
+def load_snapshot(key: bytes) -> Optional[List[UserOptions]]:
+    for path in _snapshot_paths():
+        try:
+            with open(path, "rb") as f:
+                snapshot_key, user_options_list = pickle.load(f)
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable snapshot {path}: {e!r}")
+            continue
+        if snapshot_key == key:
+            logger.debug(f"Loaded the compiled user options from {path}")
+            return user_options_list
+    return None
+
+
+def save_snapshot(key: bytes, user_options_list: List[UserOptions]) -> None:
+    path = _snapshot_paths()[0]
+    tmp_path = path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Holds the same credentials as the config
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(
+                (key, user_options_list), f, pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(tmp_path, path)
+    except OSError as e:
+        # Only costs the next start a parse
+        logger.warning(f"Could not save the user options snapshot: {e!r}")
@@ -0,0 +1,379 @@
+"""
+scanner_scheduler.py
+user: vhao
+date: 10-17-2026
+
+A single poll scheduler shared by all location scanners.
+
+Instead of every location sleeping on its own, each location registers a poll
+coroutine with the scheduler. Poll times are spread evenly across the refresh
+window and dispatched under one global requests per second budget, so the
+request rate stays steady no matter how many locations are watched.
+
+A poll which raises is restarted (rescheduled) after an exponential backoff
+capped at SCANNER_RESTART_BACKOFF_MAX, rather than the location silently
+dropping out, unless the scheduler was created with restart_failed=False.
+"""
+
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import asyncio
+import heapq
+import random
+import time
+from dataclasses import dataclass
+from scanner_constants import (
+    ADAPTIVE_REFRESH_SMOOTHING,
+    DEFAULT_REFRESH_TIME,
+    POLL_REQUESTS_PER_SECOND,
+    SCANNER_RESTART_BACKOFF,
+    SCANNER_RESTART_BACKOFF_MAX,
+    SCHEDULER_METRICS_INTERVAL,
+)
+from scanner_logger import getScannerLogger
+from scanner_metrics import metrics
+from scanner_types import SchedulerMetrics
+
+
+logger = getScannerLogger(__name__)
+
+# Used to place locations added while the scheduler is running. Successive
+# multiples of the golden ratio stay evenly spread over the window.
+_GOLDEN_RATIO = 0.6180339887498949
+
+
+"""
+Desc: Returns True if the location should be polled again, False to stop
+polling it.
+"""
+PollFn = Callable[[], Awaitable[bool]]
+
+
+@dataclass
+class _PollEntry:
+    key: Hashable
+    poll: PollFn
+    interval: float
+    adaptive: Optional["AdaptiveInterval"] = None
+    due: float = 0
+    # Bumped whenever the entry is rescheduled or removed so that stale heap
+    # items can be skipped
+    version: int = 0
+    running: bool = False
+    # Polls in a row which raised
+    failures: int = 0
+
+
+class PollScheduler:
+    def __init__(
+        self,
+        requests_per_second: float = POLL_REQUESTS_PER_SECOND,
+        metrics_interval: float = SCHEDULER_METRICS_INTERVAL,
+        restart_failed: bool = True,
+    ):
+        self._rate = requests_per_second
+        self._metrics_interval = metrics_interval
+        self._restart_failed = restart_failed
+        self._entries: Dict[Hashable, _PollEntry] = {}
+        self._heap: List[Tuple[float, int, int, Hashable]] = []
+        self._counter = 0
+        self._added = 0
+        self._started = False
+        self._forever = False
+        self._stopping = False
+        self._tasks: Set[asyncio.Task] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._next_token = 0.0
+
+        self._dispatched = 0
+        self._last_lag = 0.0
+        self._max_lag = 0.0
+        self._total_lag = 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def add(
+        self,
+        key: Hashable,
+        poll: PollFn,
+        interval: Union[float, "AdaptiveInterval"] = DEFAULT_REFRESH_TIME,
+    ) -> None:
+        if key in self._entries:
+            self.remove(key)
+        if isinstance(interval, AdaptiveInterval):
+            entry = _PollEntry(key, poll, interval.current, interval)
+        else:
+            entry = _PollEntry(key, poll, interval)
+        interval = entry.interval
+        self._entries[key] = entry
+        if self._started:
+            self._added += 1
+            offset = ((self._added * _GOLDEN_RATIO) % 1) * interval
+            self._push(entry, time.monotonic() + offset)
+
+    def remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry.version += 1
+
+    def set_interval(self, key: Hashable, interval: float) -> None:
+        entry = self._entries.get(key)
+        if entry is None or entry.interval == interval:
+            return
+        entry.interval = interval
+        # Pull the next poll in if the new interval is shorter
+        if not entry.running:
+            due = min(entry.due, time.monotonic() + interval)
+            if due != entry.due:
+                self._push(entry, due)
+
+    def get_interval(self, key: Hashable) -> Optional[float]:
+        entry = self._entries.get(key)
+        return entry.interval if entry is not None else None
+
+    def get_metrics(self) -> SchedulerMetrics:
+        now = time.monotonic()
+        queue_depth = sum(
+            1 for entry in self._entries.values()
+            if not entry.running and entry.due <= now
+        )
+        return SchedulerMetrics(
+            locations=len(self._entries),
+            queueDepth=queue_depth,
+            inFlight=len(self._tasks),
+            dispatched=self._dispatched,
+            lastLag=self._last_lag,
+            maxLag=self._max_lag,
+            meanLag=(
+                self._total_lag / self._dispatched if self._dispatched else 0
+            ),
+        )
+
+    def _push(self, entry: _PollEntry, due: float) -> None:
+        entry.version += 1
+        entry.due = due
+        self._counter += 1
+        heapq.heappush(
+            self._heap, (due, self._counter, entry.version, entry.key)
+        )
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # Spreads the initial polls evenly across the window
+    def _spread(self, now: float, window: Optional[float]) -> None:
+        entries = list(self._entries.values())
+        for i, entry in enumerate(entries):
+            span = entry.interval if window is None else window
+            self._push(entry, now + i * span / len(entries))
+
+    async def _wait_for_token(self) -> None:
+        if self._rate <= 0:
+            return
+        now = time.monotonic()
+        if self._next_token > now:
+            await asyncio.sleep(self._next_token - now)
+        self._next_token = max(now, self._next_token) + 1 / self._rate
+
+    # Jittered exponential backoff before restarting a poll which raised
+    def _restart_delay(self, failures: int) -> float:
+        return random.uniform(0.5, 1) * min(
+            SCANNER_RESTART_BACKOFF_MAX,
+            SCANNER_RESTART_BACKOFF * (2 ** (failures - 1)),
+        )
+
+    async def _run_poll(self, entry: _PollEntry) -> None:
+        keep_polling = False
+        due = None
+        try:
+            keep_polling = await entry.poll()
+            entry.failures = 0
+        except Exception:
+            if self._restart_failed:
+                entry.failures += 1
+                delay = self._restart_delay(entry.failures)
+                due = time.monotonic() + delay
+                keep_polling = True
+                metrics.inc("scanner_restarts_total")
+                logger.exception(
+                    "Poll for %s raised (%d in a row), restarting it in "
+                    "%.0fs", entry.key, entry.failures, delay,
+                )
+            else:
+                logger.exception(f"Poll for {entry.key} raised, removing it")
+        finally:
+            entry.running = False
+
+        if not keep_polling:
+            if self._entries.get(entry.key) is entry:
+                self.remove(entry.key)
+            return
+
+        if self._entries.get(entry.key) is entry:
+            if entry.adaptive is not None:
+                entry.interval = entry.adaptive.current
+            if due is None:
+                # Keep the location's phase in the window unless we fell
+                # behind
+                due = max(entry.due + entry.interval, time.monotonic())
+            self._push(entry, due)
+
+    def _on_task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _log_metrics(self) -> None:
+        metrics = self.get_metrics()
+        logger.info(
+            f"Scheduler: {metrics.locations} locations, "
+            f"queue depth {metrics.queueDepth}, "
+            f"{metrics.inFlight} in flight, "
+            f"lag last/max/mean {metrics.lastLag:.2f}/{metrics.maxLag:.2f}/"
+            f"{metrics.meanLag:.2f}s"
+        )
+
+    # Stops dispatching polls, run() returns once the running ones finish
+    def stop(self) -> None:
+        self._stopping = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    """
+    Desc: Dispatches polls until every location has stopped polling.
+
+    Args:
+        window:     Seconds to spread the initial polls across. Defaults to
+                    each location's own interval.
+        forever:    Keep running while there is nothing to poll, waiting for
+                    locations to be added, until stop() is called
+    """
+    async def run(
+        self,
+        window: Optional[float] = None,
+        forever: bool = False,
+    ) -> None:
+        self._wakeup = asyncio.Event()
+        self._forever = forever
+        self._stopping = False
+        self._started = True
+        now = time.monotonic()
+        self._spread(now, window)
+        next_metrics = now + self._metrics_interval
+        try:
+            await self._dispatch(next_metrics)
+        finally:
+            # Don't leave polls running once run() is cancelled, they would
+            # outlive the transport they poll with
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._started = False
+        self._log_metrics()
+
+    async def _dispatch(self, next_metrics: float) -> None:
+        while self._tasks or (
+            not self._stopping and (self._entries or self._forever)
+        ):
+            if self._stopping:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            if now >= next_metrics:
+                self._log_metrics()
+                next_metrics = now + self._metrics_interval
+
+            # Drop heap items for removed/rescheduled entries
+            while self._heap:
+                due, _, version, key = self._heap[0]
+                entry = self._entries.get(key)
+                if entry is not None and entry.version == version:
+                    break
+                heapq.heappop(self._heap)
+
+            if not self._heap:
+                timeout = next_metrics - now
+            else:
+                timeout = self._heap[0][0] - now
+
+            if timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, _, key = heapq.heappop(self._heap)
+            entry = self._entries[key]
+            await self._wait_for_token()
+            if self._stopping or self._entries.get(key) is not entry:
+                continue
+
+            lag = time.monotonic() - entry.due
+            self._dispatched += 1
+            self._last_lag = lag
+            self._max_lag = max(self._max_lag, lag)
+            self._total_lag += lag
+            metrics.observe("scanner_poll_lag_seconds", lag)
+            metrics.set(
+                "scanner_location_poll_lag_seconds", lag, location=key
+            )
+
+            entry.running = True
+            entry.version += 1
+            task = asyncio.create_task(self._run_poll(entry))
+            self._tasks.add(task)
+            task.add_done_callback(self._on_task_done)
+
+
+"""
+Desc: Per location refresh time which adapts to how often the location's
+slots have been changing. Keeps an exponentially weighted change rate over
+recent polls: locations whose slots keep changing are polled close to
+min_interval, locations which stay the same back off towards max_interval.
+"""
+class AdaptiveInterval:
+    def __init__(
+        self,
+        initial: float,
+        min_interval: float,
+        max_interval: float,
+        smoothing: float = ADAPTIVE_REFRESH_SMOOTHING,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self._smoothing = smoothing
+        span = self.max_interval - self.min_interval
+        initial = min(max(initial, self.min_interval), self.max_interval)
+        # Start at the change rate which corresponds to the initial interval
+        self.change_rate = (
+            1 - (initial - self.min_interval) / span if span else 1
+        )
+
+    @property
+    def current(self) -> float:
+        span = self.max_interval - self.min_interval
+        return self.max_interval - span * self.change_rate
+
+    def update(self, changed: bool) -> float:
+        self.change_rate = (
+            (1 - self._smoothing) * self.change_rate +
+            self._smoothing * (1 if changed else 0)
+        )
+        return self.current
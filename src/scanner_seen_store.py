@@ -0,0 +1,777 @@
+"""
+scanner_seen_store.py
+user: vhao
+date: 10-17-2026
+
+Keeps track of the appointments the user has already been notified about so
+that they are not notified about them again.
+
+Seen appointments are indexed in memory as a set of appointment start times
+("%Y-%m-%d %H:%M") per location. When running locally, every update is
+appended to a log file next to PREV_SEEN_APPTS_PATH instead of rewriting the
+whole file. The log is periodically compacted into PREV_SEEN_APPTS_PATH,
+dropping appointments which are already in the past. Both the appends and
+the compaction are crash safe: a torn final log line is ignored on load and
+the snapshot is replaced atomically.
+
+On AWS Lambda appending is not possible (S3 objects are immutable). Updates
+made during an invocation are buffered in /tmp and the whole snapshot is
+written to S3 once by flush(), at the end of the invocation. When lambdas are
+sharded (SHARD_NODES), each shard keeps its own snapshot, since shards never
+share locations.
+
+Several processes (sharded worker processes) share SqliteSeenAppointmentStore
+instead. Before notifying, a process atomically claims the appointments it
+is about to send, so an appointment is only ever sent by one process even
+while locations move between shards.
+
+With SEEN_STORE = "storage", StorageSeenAppointmentStore keeps one record
+per seen_key in a storage backend (see scanner_storage.py), so that only the
+records of the locations being notified about are read and written. On
+lambda its writes are batched until flush(), like LambdaSeenAppointmentStore.
+"""
+
+from typing import (
+    Callable,
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Set,
+    TypeVar,
+)
+
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from scanner_constants import (
+    DEBUG_AWS_LAMBDA_LOCAL,
+    PREV_SEEN_APPTS_PATH,
+    SEEN_APPTS_COMPACT_EVERY,
+    SEEN_APPTS_DB_PATH,
+    SEEN_APPTS_LOG_PATH,
+    SEEN_APPTS_RETENTION,
+    SEEN_CLAIM_TIMEOUT,
+    SEEN_DB_BUSY_TIMEOUT,
+    SEEN_STORE,
+    SHARD_ID,
+    SHARD_NODES,
+    SHARD_WORKERS,
+    USING_AWS_LAMBDA,
+)
+from scanner_logger import getScannerLogger
+from scanner_storage import StorageBackend, create_storage_backend
+
+
+logger = getScannerLogger(__name__)
+
+T = TypeVar("T")
+
+
+# Seen appointments are tracked per user in multi-user mode. Single user
+# setups keep using the plain locationId so existing files stay valid.
+def seen_key(userId: str, locationId: int) -> str:
+    return f"{userId}:{locationId}" if userId else str(locationId)
+
+
+class SeenAppointmentStore:
+    def __init__(self, snapshot_path: str = PREV_SEEN_APPTS_PATH):
+        self._snapshot_path = snapshot_path
+        # Maps seen_keys to seen appointment start times
+        self._index: Dict[str, Set[str]] = defaultdict(set)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def get(self, key) -> Set[str]:
+        return set(self._index.get(str(key), ()))
+
+    # Returns the appointments which have not been seen yet
+    def unseen(self, key, appointments: Iterable[str]) -> Set[str]:
+        seen = self._index.get(str(key))
+        if not seen:
+            return set(appointments)
+        return {appt for appt in appointments if appt not in seen}
+
+    def add(
+        self,
+        key,
+        appointments: Iterable[str],
+        writethrough: bool = True,
+    ) -> None:
+        new_appointments = self.unseen(key, appointments)
+        if not new_appointments:
+            return
+        self._index[str(key)].update(new_appointments)
+        self._persist(str(key), sorted(new_appointments), writethrough)
+
+    """
+    Desc: Claims the right to notify about the given unseen appointments,
+    returning the ones claimed. A store used by a single process has no one
+    to race with, so it claims all of them.
+    """
+    def claim(self, key, appointments: Iterable[str]) -> Set[str]:
+        return set(appointments)
+
+    # Gives up claims after failing to notify, so they can be retried
+    def release(self, key, appointments: Iterable[str]) -> None:
+        pass
+
+    def load(self) -> None:
+        raise NotImplementedError
+
+    """
+    Desc: Returns the appointments which were not seen yet nor are pending,
+    and which this process could claim. Used by notify() on the event loop.
+    """
+    async def claim_unseen(
+        self,
+        key,
+        appointments: Iterable[str],
+        pending: Set[str],
+    ) -> Set[str]:
+        new_appointments = self.unseen(key, appointments) - pending
+        if new_appointments:
+            new_appointments = self.claim(key, new_appointments)
+        return new_appointments
+
+    # Persists any buffered updates
+    def flush(self) -> None:
+        pass
+
+    # Updates made inside the returned context are persisted together
+    def batch(self) -> ContextManager:
+        return nullcontext()
+
+    def _persist(
+        self,
+        key: str,
+        appointments: Iterable[str],
+        writethrough: bool,
+    ) -> None:
+        raise NotImplementedError
+
+    # Drops appointments which are already in the past
+    def prune(self, now: Optional[datetime] = None) -> int:
+        cutoff = ((now or datetime.now()) - SEEN_APPTS_RETENTION).strftime(
+            "%Y-%m-%d %H:%M"
+        )
+        dropped = 0
+        for key in list(self._index):
+            seen = self._index[key]
+            expired = {appt for appt in seen if appt < cutoff}
+            seen -= expired
+            dropped += len(expired)
+            if not seen:
+                del self._index[key]
+        return dropped
+
+    def _load_snapshot(self, data: str) -> None:
+        for key, appointments in json.loads(data).items():
+            self._index[key].update(appointments)
+
+    def _dump_snapshot(self) -> str:
+        return json.dumps(
+            {key: sorted(appts) for key, appts in self._index.items()},
+            indent=4,
+            sort_keys=True,
+        )
+
+
+class FileSeenAppointmentStore(SeenAppointmentStore):
+    def __init__(
+        self,
+        snapshot_path: str = PREV_SEEN_APPTS_PATH,
+        log_path: str = SEEN_APPTS_LOG_PATH,
+        compact_every: int = SEEN_APPTS_COMPACT_EVERY,
+    ):
+        super().__init__(snapshot_path)
+        self._log_path = log_path
+        self._compact_every = compact_every
+        self._log_entries = 0
+
+    def load(self) -> None:
+        self._index.clear()
+        try:
+            with open(self._snapshot_path, "r") as f:
+                self._load_snapshot(f.read())
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(
+                "".join(traceback.format_exception(None, e, e.__traceback__))
+            )
+            logger.warning("Unable to load previously seen appointments.")
+
+        self._log_entries = 0
+        corrupt = False
+        try:
+            with open(self._log_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn write from a crash, everything before it is
+                        # still intact
+                        logger.warning(
+                            f"Skipping corrupt line in {self._log_path}"
+                        )
+                        corrupt = True
+                        continue
+                    self._index[entry["key"]].update(entry["appointments"])
+                    self._log_entries += 1
+        except FileNotFoundError:
+            pass
+
+        # Fold the log into the snapshot and drop past appointments
+        if self._log_entries or corrupt or self.prune():
+            self.compact()
+        logger.debug(f"Loaded previously seen appointments:\n{self._index}")
+
+    def _persist(self, key, appointments, writethrough) -> None:
+        line = json.dumps({"key": key, "appointments": appointments}) + "\n"
+        os.makedirs(os.path.dirname(self._log_path), exist_ok=True)
+        # A single write to a file opened with O_APPEND never interleaves
+        # with other appends
+        fd = os.open(
+            self._log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+        try:
+            os.write(fd, line.encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        self._log_entries += 1
+        if self._log_entries >= self._compact_every:
+            self.compact()
+
+    def compact(self) -> None:
+        self.prune()
+        os.makedirs(os.path.dirname(self._snapshot_path), exist_ok=True)
+        tmp_path = self._snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self._dump_snapshot())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._snapshot_path)
+        # Only truncate once the snapshot is in place. If we crash in
+        # between, replaying the log again on load is harmless.
+        with open(self._log_path, "w"):
+            pass
+        self._log_entries = 0
+
+
+class LambdaSeenAppointmentStore(SeenAppointmentStore):
+    def __init__(self, snapshot_path: str = PREV_SEEN_APPTS_PATH):
+        super().__init__(snapshot_path)
+        self._dirty = False
+        # The snapshot the index was last loaded from or flushed as
+        self._loaded: Optional[str] = None
+
+    def load(self) -> None:
+        from scanner_lambdas_utils import lambda_read
+        self._dirty = False
+        try:
+            # lambda_read keeps the /tmp copy in sync with S3
+            data = lambda_read(self._snapshot_path)
+        except Exception as e:
+            self._index.clear()
+            self._loaded = None
+            # While not being able to read the file could cause spam,
+            # we have no way of knowing if this is the first time running
+            # the script or if the user has simply deleted the file.
+            logger.warning(
+                "Unable to load previously seen appointments from file. If this "
+                "is the first time running the lambda or if the file was deleted "
+                "on purpose, this warning can be safely ignored. Otherwise spam "
+                "may occur; please be careful."
+            )
+            return
+        # A warm container already has the snapshot indexed, unless another
+        # container changed it since
+        if data == self._loaded:
+            logger.debug("Previously seen appointments unchanged")
+            return
+        self._index.clear()
+        self._load_snapshot(data)
+        self._loaded = data
+        logger.debug(f"Loaded previously seen appointments:\n{self._index}")
+
+    # Only writes to /tmp, S3 is written once by flush()
+    def _persist(self, key, appointments, writethrough) -> None:
+        from scanner_lambdas_utils import lambda_write
+        self._dirty = self._dirty or writethrough
+        lambda_write(
+            self._snapshot_path, self._dump_snapshot(), writethrough=False
+        )
+
+    def flush(self) -> None:
+        from scanner_lambdas_utils import lambda_write
+        if not self._dirty:
+            return
+        self.prune()
+        snapshot = self._dump_snapshot()
+        try:
+            lambda_write(self._snapshot_path, snapshot, writethrough=True)
+            self._dirty = False
+            self._loaded = snapshot
+        except Exception as e:
+            logger.fatal(
+                f"SERIOUS ISSUE: Unable to write previously seen appointments to "
+                "S3. This could cause a ton of spam. Please stop the lambda "
+                "trigger event ASAP."
+            )
+            raise e
+
+
+class SqliteSeenAppointmentStore(SeenAppointmentStore):
+    def __init__(
+        self,
+        db_path: str = SEEN_APPTS_DB_PATH,
+        claim_timeout: float = SEEN_CLAIM_TIMEOUT,
+        owner: Optional[str] = None,
+    ):
+        super().__init__()
+        self._db_path = db_path
+        self._claim_timeout = claim_timeout
+        self._owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self._conn: Optional[sqlite3.Connection] = None
+        # Only ever used from this thread, so that waiting for another
+        # process's write lock never blocks the event loop
+        self._db_thread = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="seen-db"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._db_path), exist_ok=True)
+            # Autocommit, transactions are started explicitly
+            conn = sqlite3.connect(
+                self._db_path,
+                timeout=SEEN_DB_BUSY_TIMEOUT,
+                isolation_level=None,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS seen ("
+                "key TEXT NOT NULL, "
+                "appointment TEXT NOT NULL, "
+                "delivered INTEGER NOT NULL DEFAULT 0, "
+                "owner TEXT, "
+                "claimedAt REAL, "
+                "PRIMARY KEY (key, appointment)"
+                ") WITHOUT ROWID"
+            )
+            # For prune()
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS seen_appointment "
+                "ON seen (appointment)"
+            )
+            self._conn = conn
+        return self._conn
+
+    # Runs fn on the database thread and waits for it
+    def _call(self, fn: Callable[..., T], *args) -> T:
+        return self._db_thread.submit(fn, *args).result()
+
+    # Runs fn on the database thread without waiting, after any queued call
+    def _queue(self, fn: Callable, *args) -> None:
+        def log_failure(future: Future) -> None:
+            if future.exception() is not None:
+                logger.error(
+                    "Failed to update previously seen appointments: "
+                    f"{future.exception()!r}"
+                )
+
+        self._db_thread.submit(fn, *args).add_done_callback(log_failure)
+
+    def __contains__(self, key: str) -> bool:
+        return self._call(self._contains, key)
+
+    def get(self, key) -> Set[str]:
+        return self._call(self._get, key)
+
+    def unseen(self, key, appointments: Iterable[str]) -> Set[str]:
+        return self._call(self._unseen, key, list(appointments))
+
+    # Queued, so that notification callbacks never wait for the database
+    def add(
+        self,
+        key,
+        appointments: Iterable[str],
+        writethrough: bool = True,
+    ) -> None:
+        self._queue(self._add, key, list(appointments))
+
+    def claim(self, key, appointments: Iterable[str]) -> Set[str]:
+        return self._call(self._claim, key, list(appointments))
+
+    def release(self, key, appointments: Iterable[str]) -> None:
+        self._queue(self._release, key, list(appointments))
+
+    async def claim_unseen(
+        self,
+        key,
+        appointments: Iterable[str],
+        pending: Set[str],
+    ) -> Set[str]:
+        def claim_unseen():
+            new_appointments = self._unseen(key, appointments) - pending
+            if new_appointments:
+                new_appointments = self._claim(key, new_appointments)
+            return new_appointments
+
+        # Copied, since the event loop keeps changing them
+        appointments = list(appointments)
+        pending = set(pending)
+        return await asyncio.get_running_loop().run_in_executor(
+            self._db_thread, claim_unseen
+        )
+
+    def load(self) -> None:
+        self._call(self._load)
+
+    # Waits for queued updates
+    def flush(self) -> None:
+        self._call(lambda: None)
+
+    def prune(self, now: Optional[datetime] = None) -> int:
+        return self._call(self._prune, now)
+
+    def _contains(self, key: str) -> bool:
+        return self._connect().execute(
+            "SELECT 1 FROM seen WHERE key = ? AND delivered = 1 LIMIT 1",
+            (str(key),),
+        ).fetchone() is not None
+
+    def _get(self, key) -> Set[str]:
+        return {
+            appointment for appointment, in self._connect().execute(
+                "SELECT appointment FROM seen WHERE key = ? AND delivered = 1",
+                (str(key),),
+            )
+        }
+
+    def _unseen(self, key, appointments: Iterable[str]) -> Set[str]:
+        return set(appointments) - self._get(key)
+
+    def _add(self, key, appointments: Iterable[str]) -> None:
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT INTO seen (key, appointment, delivered) "
+                "VALUES (?, ?, 1) "
+                "ON CONFLICT (key, appointment) DO UPDATE SET delivered = 1",
+                [(str(key), appointment) for appointment in appointments],
+            )
+
+    """
+    Desc: Claims appointments nobody has notified about or claimed yet, or
+    whose claim is older than claim_timeout. Runs as a single write
+    transaction, so two processes can never both claim an appointment.
+    """
+    def _claim(self, key, appointments: Iterable[str]) -> Set[str]:
+        now = time.time()
+        conn = self._connect()
+        claimed = set()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for appointment in sorted(appointments):
+                cursor = conn.execute(
+                    "INSERT INTO seen (key, appointment, owner, claimedAt) "
+                    "VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (key, appointment) DO UPDATE SET "
+                    "owner = excluded.owner, claimedAt = excluded.claimedAt "
+                    "WHERE delivered = 0 AND claimedAt < ?",
+                    (
+                        str(key), appointment, self._owner, now,
+                        now - self._claim_timeout,
+                    ),
+                )
+                if cursor.rowcount:
+                    claimed.add(appointment)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return claimed
+
+    def _release(self, key, appointments: Iterable[str]) -> None:
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "DELETE FROM seen WHERE key = ? AND appointment = ? "
+                "AND delivered = 0 AND owner = ?",
+                [
+                    (str(key), appointment, self._owner)
+                    for appointment in appointments
+                ],
+            )
+
+    # Imports the file store's appointments into a new database
+    def _import_file_store(self) -> None:
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM seen LIMIT 1").fetchone():
+            return
+        if not os.path.exists(self._snapshot_path):
+            return
+        file_store = FileSeenAppointmentStore(self._snapshot_path)
+        file_store.load()
+        for key, appointments in file_store._index.items():
+            self._add(key, appointments)
+        logger.info(
+            f"Imported previously seen appointments from "
+            f"{self._snapshot_path} into {self._db_path}"
+        )
+
+    def _load(self) -> None:
+        self._import_file_store()
+        dropped = self._prune()
+        if dropped:
+            logger.debug(f"Dropped {dropped} past seen appointments")
+
+    def _prune(self, now: Optional[datetime] = None) -> int:
+        cutoff = ((now or datetime.now()) - SEEN_APPTS_RETENTION).strftime(
+            "%Y-%m-%d %H:%M"
+        )
+        conn = self._connect()
+        with conn:
+            return conn.execute(
+                "DELETE FROM seen WHERE appointment < ?", (cutoff,)
+            ).rowcount
+
+
+class StorageSeenAppointmentStore(SeenAppointmentStore):
+    """
+    Args:
+        defer_writes:   Buffers updates from load() until flush()
+        prune_on_load:  Drops past appointments of every key on load(),
+                        which lists every record. Otherwise they are only
+                        dropped from records being updated.
+    """
+    def __init__(
+        self,
+        backend: StorageBackend,
+        defer_writes: bool = False,
+        prune_on_load: bool = True,
+    ):
+        super().__init__()
+        self._backend = backend
+        self._defer_writes = defer_writes
+        self._prune_on_load = prune_on_load
+        # Whether the backend batch deferring writes until flush() is open
+        self._deferred = False
+        # Held while using the backend, which claim_unseen reads from the
+        # default executor
+        self._lock = threading.RLock()
+        # Bumped by every update, all of which are made on the event loop.
+        # load() changes every key.
+        self._generation = 0
+        self._key_generations: Dict[str, int] = defaultdict(int)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return self._backend.get(str(key)) is not None
+
+    def get(self, key) -> Set[str]:
+        with self._lock:
+            record = self._backend.get(str(key))
+        return set(json.loads(record)) if record is not None else set()
+
+    def unseen(self, key, appointments: Iterable[str]) -> Set[str]:
+        return set(appointments) - self.get(key)
+
+    def add(
+        self,
+        key,
+        appointments: Iterable[str],
+        writethrough: bool = True,
+    ) -> None:
+        with self._lock:
+            self._key_generations[str(key)] += 1
+            seen = self.get(key)
+            new_appointments = set(appointments) - seen
+            if not new_appointments:
+                return
+            self._put(str(key), _unexpired(seen | new_appointments))
+
+    """
+    Desc: Reads the record in the default executor when it is not cached,
+    since the backend may have to fetch it from disk or S3. Read again if
+    the store was updated while waiting, so that an appointment delivered in
+    the meantime is not claimed again.
+    """
+    async def claim_unseen(
+        self,
+        key,
+        appointments: Iterable[str],
+        pending: Set[str],
+    ) -> Set[str]:
+        appointments = list(appointments)
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._backend.is_cached(str(key)):
+                    new_appointments = self.unseen(key, appointments)
+                    break
+            generation = (self._generation, self._key_generations[str(key)])
+            new_appointments = await loop.run_in_executor(
+                None, self.unseen, key, appointments
+            )
+            if generation == (
+                self._generation, self._key_generations[str(key)]
+            ):
+                break
+        # pending is read after waiting, it changes on the event loop
+        new_appointments -= pending
+        if new_appointments:
+            new_appointments = self.claim(key, new_appointments)
+        return new_appointments
+
+    def load(self) -> None:
+        with self._lock:
+            self._generation += 1
+            # Other processes or containers may have changed the records
+            self._backend.invalidate()
+            if self._defer_writes and not self._deferred:
+                self._backend.begin()
+                self._deferred = True
+            if self._prune_on_load:
+                self._import_file_store()
+                dropped = self.prune()
+                if dropped:
+                    logger.debug(f"Pruned {dropped} past seen appointments")
+
+    # Imports the file store's appointments into an empty backend
+    def _import_file_store(self) -> None:
+        if self._backend.keys() or not os.path.exists(self._snapshot_path):
+            return
+        file_store = FileSeenAppointmentStore(self._snapshot_path)
+        file_store.load()
+        with self._backend.batch():
+            for key, appointments in file_store._index.items():
+                self._put(key, appointments)
+        logger.info(
+            f"Imported previously seen appointments from "
+            f"{self._snapshot_path} into the storage backend"
+        )
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._deferred:
+                return
+            self._deferred = False
+            try:
+                self._backend.commit()
+            except Exception as e:
+                logger.fatal(
+                    "SERIOUS ISSUE: Unable to write previously seen "
+                    "appointments. This could cause a ton of spam."
+                )
+                raise e
+            if self._defer_writes:
+                self._backend.begin()
+                self._deferred = True
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        with self._lock, self._backend.batch():
+            yield
+
+    """
+    Desc: Drops past appointments. A backend which expires records deletes
+    every record whose appointments are all past with a single query, and
+    the past appointments of the other records are dropped when they are
+    next updated. Other backends are scanned record by record.
+    Returns how many appointments were dropped, or records when expired.
+    """
+    def prune(self, now: Optional[datetime] = None) -> int:
+        if self._backend.supports_expiry:
+            with self._lock:
+                return self._backend.delete_expired(_cutoff(now))
+        dropped = 0
+        with self._lock, self._backend.batch():
+            for key, record in self._backend.items():
+                seen = set(json.loads(record))
+                unexpired = _unexpired(seen, now)
+                if len(unexpired) < len(seen):
+                    dropped += len(seen) - len(unexpired)
+                    self._put(key, unexpired)
+        return dropped
+
+    # The record expires with its latest appointment
+    def _put(self, key: str, appointments: Set[str]) -> None:
+        if appointments:
+            appointments = sorted(appointments)
+            self._backend.put(
+                key, json.dumps(appointments).encode(),
+                expires=appointments[-1],
+            )
+        else:
+            self._backend.delete(key)
+
+
+# Appointments before the returned start time are past
+def _cutoff(now: Optional[datetime] = None) -> str:
+    return ((now or datetime.now()) - SEEN_APPTS_RETENTION).strftime(
+        "%Y-%m-%d %H:%M"
+    )
+
+
+def _unexpired(
+    appointments: Set[str],
+    now: Optional[datetime] = None,
+) -> Set[str]:
+    cutoff = _cutoff(now)
+    return {appt for appt in appointments if appt >= cutoff}
+
+
+# Sharded lambdas never share locations, so each keeps its own snapshot
+def _shard_path(path: str, shard: str) -> str:
+    if not shard:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{shard}{ext}"
+
+
+"""
+Args:
+    shard:  Shard (or lambda batch) whose seen appointments to keep, this
+            host's SHARD_ID by default
+"""
+def create_seen_store(shard: Optional[str] = None) -> SeenAppointmentStore:
+    if shard is None:
+        shard = SHARD_ID if SHARD_NODES else ""
+    on_lambda = USING_AWS_LAMBDA and not DEBUG_AWS_LAMBDA_LOCAL
+    # Claims between worker processes need SqliteSeenAppointmentStore
+    if SEEN_STORE == "storage" and SHARD_WORKERS <= 1:
+        # Records are per seen_key, which shards never share
+        return StorageSeenAppointmentStore(
+            create_storage_backend("seen"),
+            defer_writes=on_lambda,
+            # Listing every object on each invocation would cost more S3
+            # requests than the scan itself
+            prune_on_load=not on_lambda,
+        )
+    if on_lambda:
+        return LambdaSeenAppointmentStore(
+            _shard_path(PREV_SEEN_APPTS_PATH, shard)
+        )
+    if SEEN_STORE == "sqlite" or SHARD_WORKERS > 1:
+        return SqliteSeenAppointmentStore()
+    if SEEN_STORE != "file":
+        logger.fatal(f"Unknown SEEN_STORE {SEEN_STORE!r}")
+        raise ValueError(f"Unknown SEEN_STORE {SEEN_STORE!r}")
+    return FileSeenAppointmentStore()
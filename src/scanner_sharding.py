@@ -0,0 +1,216 @@
+"""
+scanner_sharding.py
+user: vhao
+date: 10-17-2026
+
+Splits locations between shards so that scanning scales with the number of
+cores and hosts.
+
+Locations are assigned with consistent hashing on their locationId, in two
+levels: between the hosts (or lambda functions) listed in SHARD_NODES, then
+between the SHARD_WORKERS worker processes of each host. Adding or removing
+a shard only moves the locations on its part of the ring, about 1/n of them.
+
+Worker processes are started by run_workers and are restarted if they
+crash. They share the SQLite seen appointments store (see
+scanner_seen_store.py), whose atomic claims make sure an appointment is
+never notified by two shards, e.g. while a location moves between them.
+"""
+
+from typing import Callable, Dict, Iterable, List
+
+import dataclasses
+import hashlib
+import multiprocessing
+import os
+import random
+import time
+from bisect import bisect
+from scanner_constants import (
+    SCANNER_RESTART_BACKOFF,
+    SCANNER_RESTART_BACKOFF_MAX,
+    SHARD_ID,
+    SHARD_NODES,
+    SHARD_VNODES,
+    SHARD_WORKER,
+    SHARD_WORKERS,
+)
+from scanner_logger import getScannerLogger
+from scanner_types import UserOptions
+
+
+logger = getScannerLogger(__name__)
+
+
+# Stable across processes and hosts, unlike hash()
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes: Iterable[str], vnodes: int = SHARD_VNODES):
+        self.nodes = sorted(set(nodes))
+        if not self.nodes:
+            logger.fatal("A hash ring needs at least one node")
+            raise ValueError("A hash ring needs at least one node")
+        points = sorted(
+            (_hash(f"{node}#{i}"), node)
+            for node in self.nodes
+            for i in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key) -> str:
+        i = bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._owners[i]
+
+
+def worker_name(index: int) -> str:
+    return f"worker-{index}"
+
+
+"""
+Desc: Returns whether this process scans the location. Without sharding
+every location is scanned.
+"""
+def make_shard_filter(
+    nodes: List[str] = SHARD_NODES,
+    shard_id: str = SHARD_ID,
+    num_workers: int = SHARD_WORKERS,
+    worker: str = SHARD_WORKER,
+) -> Callable[[int], bool]:
+    node_ring = HashRing(nodes) if nodes else None
+    if node_ring is not None and shard_id not in node_ring.nodes:
+        logger.fatal(
+            f"SHARD_ID {shard_id!r} is not one of SHARD_NODES {nodes}"
+        )
+        raise ValueError(f"SHARD_ID {shard_id!r} is not in SHARD_NODES")
+    worker_ring = None
+    if num_workers > 1 and worker:
+        worker_ring = HashRing(worker_name(i) for i in range(num_workers))
+
+    def owns(locationId: int) -> bool:
+        if node_ring is not None:
+            if node_ring.node_for(locationId) != shard_id:
+                return False
+        if worker_ring is not None:
+            if worker_ring.node_for(locationId) != worker_name(int(worker)):
+                return False
+        return True
+
+    return owns
+
+
+def is_sharded() -> bool:
+    return bool(SHARD_NODES) or (SHARD_WORKERS > 1 and bool(SHARD_WORKER))
+
+
+# Keeps only the locations owned by this shard, and the users watching them
+def shard_user_options(
+    user_options_list: List[UserOptions],
+    owns: Callable[[int], bool],
+) -> List[UserOptions]:
+    sharded = []
+    for user_options in user_options_list:
+        location_options_list = [
+            location_options
+            for location_options in user_options.locationOptionsList
+            if owns(location_options.locationId)
+        ]
+        if location_options_list:
+            sharded.append(dataclasses.replace(
+                user_options, locationOptionsList=location_options_list
+            ))
+    return sharded
+
+
+def _run_worker() -> None:
+    import asyncio
+    from scanner import start_scanning
+
+    asyncio.run(start_scanning())
+
+
+def _start_worker(
+    ctx,
+    index: int,
+    num_workers: int,
+) -> multiprocessing.Process:
+    # Read by scanner_constants when the worker imports it. Spawned
+    # processes get a copy of the environment at start().
+    environ = {
+        "SCANNER_SHARD_WORKER": str(index),
+        "SCANNER_SHARD_WORKERS": str(num_workers),
+    }
+    previous = {name: os.environ.get(name) for name in environ}
+    os.environ.update(environ)
+    try:
+        process = ctx.Process(
+            target=_run_worker, name=worker_name(index), daemon=True
+        )
+        process.start()
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+    logger.info(f"Started {process.name} (pid {process.pid})")
+    return process
+
+
+"""
+Desc: Runs num_workers worker processes, each scanning its own share of the
+locations, until every worker finished. Workers which crash are restarted
+after a backoff. Workers are spawned rather than forked so that none of
+this process' event loop, connections or logging thread is inherited.
+"""
+def run_workers(num_workers: int = SHARD_WORKERS) -> None:
+    ctx = multiprocessing.get_context("spawn")
+    workers: Dict[int, multiprocessing.Process] = {
+        index: _start_worker(ctx, index, num_workers)
+        for index in range(num_workers)
+    }
+    failures: Dict[int, int] = {index: 0 for index in workers}
+    started_at: Dict[int, float] = {
+        index: time.monotonic() for index in workers
+    }
+    # Maps worker indexes to when they should be restarted
+    restart_at: Dict[int, float] = {}
+    try:
+        while workers or restart_at:
+            time.sleep(1)
+            now = time.monotonic()
+            for index, process in list(workers.items()):
+                if process.is_alive():
+                    continue
+                del workers[index]
+                if process.exitcode == 0:
+                    logger.info(f"{process.name} finished")
+                    continue
+                # Only back off further while it keeps crashing right away
+                if now - started_at[index] > SCANNER_RESTART_BACKOFF_MAX:
+                    failures[index] = 0
+                failures[index] += 1
+                delay = random.uniform(0.5, 1) * min(
+                    SCANNER_RESTART_BACKOFF_MAX,
+                    SCANNER_RESTART_BACKOFF * (2 ** (failures[index] - 1)),
+                )
+                logger.error(
+                    f"{process.name} exited with code {process.exitcode}, "
+                    f"restarting it in {delay:.0f}s"
+                )
+                restart_at[index] = now + delay
+            for index, at in list(restart_at.items()):
+                if at <= now:
+                    del restart_at[index]
+                    workers[index] = _start_worker(
+                        ctx, index, num_workers
+                    )
+                    started_at[index] = time.monotonic()
+    finally:
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.join()
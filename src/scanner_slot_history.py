@@ -0,0 +1,443 @@
+"""
+scanner_slot_history.py
+user: vhao
+date: 10-17-2026
+
+Records how the available slots of each location change over time, and
+reports on it: at which hours new slots are usually released, and how long
+slots stay available before someone books them.
+
+Only changes are recorded, one JSON line per poll which saw any:
+    {"t": 1792224000.0, "l": 5140, "a": [...], "d": [...]}
+with the slot start times which appeared ("a") and disappeared ("d") since
+the location's previous line. The first line of a location after a
+(re)start has all of its slots instead ({"t": ..., "l": ..., "s": [...]}),
+since we do not know what changed while nobody was looking.
+
+Lines are buffered and appended every SLOT_HISTORY_FLUSH_INTERVAL seconds
+as one gzip member to the segment of the day (UTC), so a crash loses at most
+one interval and segments can be read with zcat. Worker processes write
+their own segments. Segments older than SLOT_HISTORY_RETENTION are deleted.
+
+Reports, run from src/:
+    python scanner_slot_history.py --location DTW --days 30
+"""
+
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import asyncio
+import gzip
+import heapq
+import json
+import os
+import re
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from scanner_constants import (
+    SHARD_WORKER,
+    SLOT_HISTORY_DIR,
+    SLOT_HISTORY_FLUSH_INTERVAL,
+    SLOT_HISTORY_RETENTION,
+)
+from scanner_logger import getScannerLogger
+from scanner_types import SlotHistoryStats
+
+
+logger = getScannerLogger(__name__)
+
+_SEGMENT_RE = re.compile(
+    r"slots-(\d{4}-\d{2}-\d{2})(?:\.worker\d+)?\.jsonl\.gz"
+)
+# Slots which disappear less than this long before they start are counted as
+# expired rather than taken
+_EXPIRY_MARGIN = timedelta(days=1)
+_SLOT_FMT = "%Y-%m-%dT%H:%M"
+_WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def _utc_day(at: float) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(at))
+
+
+class SlotHistoryRecorder:
+    def __init__(
+        self,
+        directory: str = SLOT_HISTORY_DIR,
+        retention: timedelta = SLOT_HISTORY_RETENTION,
+    ):
+        self.directory = directory
+        self.retention = retention
+        # Maps locationIds to the slots of their last recorded line
+        self._slots: Dict[int, FrozenSet[str]] = {}
+        # Encoded lines not written yet
+        self._pending: List[str] = []
+        # Day of the last prune, segments are pruned once per day
+        self._pruned_day: Optional[str] = None
+
+    def _segment_path(self, day: str) -> str:
+        worker = f".worker{SHARD_WORKER}" if SHARD_WORKER else ""
+        return os.path.join(self.directory, f"slots-{day}{worker}.jsonl.gz")
+
+    # Buffers a line if the location's slots changed since the last one
+    def record(
+        self,
+        locationId: int,
+        slots: FrozenSet[str],
+        at: Optional[float] = None,
+    ) -> None:
+        previous = self._slots.get(locationId)
+        if previous == slots:
+            return
+        self._slots[locationId] = slots
+        line = {"t": round(at or time.time(), 3), "l": locationId}
+        if previous is None:
+            line["s"] = sorted(slots)
+        else:
+            line["a"] = sorted(slots - previous)
+            line["d"] = sorted(previous - slots)
+        self._pending.append(json.dumps(line, separators=(",", ":")))
+
+    # The location's next line will list all of its slots again
+    def forget(self, locationId: int) -> None:
+        self._slots.pop(locationId, None)
+
+    def _write(self, lines: List[str], now: float) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        data = gzip.compress(("\n".join(lines) + "\n").encode())
+        # One write per member, so readers never see half a member unless
+        # the process dies in the middle of it
+        with open(self._segment_path(_utc_day(now)), "ab") as f:
+            f.write(data)
+        if self._pruned_day != _utc_day(now):
+            self.prune(now)
+            self._pruned_day = _utc_day(now)
+
+    def flush(self) -> None:
+        if self._pending:
+            lines, self._pending = self._pending, []
+            self._write(lines, time.time())
+
+    # Deletes the segments which are entirely older than the retention
+    def prune(self, now: Optional[float] = None) -> None:
+        now = now or time.time()
+        oldest = _utc_day(now - self.retention.total_seconds())
+        for name in os.listdir(self.directory):
+            match = _SEGMENT_RE.fullmatch(name)
+            if match and match.group(1) < oldest:
+                logger.info(f"Deleting slot history segment {name}")
+                os.remove(os.path.join(self.directory, name))
+
+    # Writes the buffered lines every interval, off the event loop
+    async def flush_periodically(
+        self,
+        interval: float = SLOT_HISTORY_FLUSH_INTERVAL,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if self._pending:
+                    lines, self._pending = self._pending, []
+                    await loop.run_in_executor(
+                        None, self._write, lines, time.time()
+                    )
+        finally:
+            # Whatever is left when the scanners stop
+            self.flush()
+
+
+def _read_segment(path: str) -> Iterator[dict]:
+    try:
+        with gzip.open(path, "rt") as f:
+            for line in f:
+                yield json.loads(line)
+    except (EOFError, OSError, zlib.error, ValueError) as e:
+        # The last member of a crashed writer can be cut short
+        logger.warning(f"Stopped reading {path} at a damaged record: {e!r}")
+
+
+"""
+Desc: Yields the recorded lines in time order, optionally only the ones
+recorded since a time or about some locations.
+"""
+def read_history(
+    directory: str = SLOT_HISTORY_DIR,
+    since: float = 0,
+    location_ids: Optional[Set[int]] = None,
+) -> Iterator[dict]:
+    segments: Dict[str, List[str]] = defaultdict(list)
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            match = _SEGMENT_RE.fullmatch(name)
+            # Lines can be written up to a flush interval after their day
+            if match and match.group(1) >= _utc_day(since - 24 * 60 * 60):
+                segments[match.group(1)].append(
+                    os.path.join(directory, name)
+                )
+    # Each segment is in time order, the workers' segments of a day are
+    # interleaved
+    for day in sorted(segments):
+        for line in heapq.merge(
+            *(_read_segment(path) for path in segments[day]),
+            key=lambda line: line["t"],
+        ):
+            if line["t"] < since:
+                continue
+            if location_ids is not None and line["l"] not in location_ids:
+                continue
+            yield line
+
+
+def _expired(slot: str, at: datetime) -> bool:
+    try:
+        starts_at = datetime.strptime(slot[:16], _SLOT_FMT)
+    except ValueError:
+        return False
+    return starts_at - at < _EXPIRY_MARGIN
+
+
+"""
+Desc: Replays the history into per location stats. Hours and weekdays are in
+the given time zone, the host's local time by default.
+"""
+def analyze(
+    lines: Iterable[dict],
+    tz: Optional[timezone] = None,
+) -> Dict[int, SlotHistoryStats]:
+    stats: Dict[int, SlotHistoryStats] = {}
+    # Maps locationIds to their available slots and when each appeared,
+    # None when it was already there when recording (re)started
+    available: Dict[int, Dict[str, Optional[float]]] = {}
+
+    for line in lines:
+        at, locationId = line["t"], line["l"]
+        location_stats = stats.get(locationId)
+        if location_stats is None:
+            location_stats = stats[locationId] = SlotHistoryStats(
+                locationId, firstSeen=at
+            )
+        location_stats.lastSeen = at
+        slots = available.setdefault(locationId, {})
+        local_at = datetime.fromtimestamp(at, tz)
+        # Slot start times have no time zone, they compare to local times
+        naive_at = local_at.replace(tzinfo=None)
+
+        if "s" in line:
+            # Slots missing from a restart's snapshot disappeared at some
+            # unknown time, and the new ones appeared at some unknown time
+            available[locationId] = {
+                slot: slots.get(slot) for slot in line["s"]
+            }
+            continue
+
+        for slot in line.get("d", []):
+            appeared_at = slots.pop(slot, None)
+            if _expired(slot, naive_at):
+                location_stats.expired += 1
+            elif appeared_at is not None:
+                location_stats.lifetimes.append(at - appeared_at)
+        new_slots = line.get("a", [])
+        for slot in new_slots:
+            slots[slot] = at
+        if new_slots:
+            location_stats.releasesByHour[local_at.hour] += 1
+            location_stats.slotsByHour[local_at.hour] += len(new_slots)
+            location_stats.releasesByWeekday[local_at.weekday()] += 1
+
+    for locationId, slots in available.items():
+        stats[locationId].stillAvailable = len(slots)
+    return stats
+
+
+def _quantile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def _fmt_seconds(seconds: float) -> str:
+    if seconds >= 60 * 60:
+        return f"{seconds / (60 * 60):.1f}h"
+    if seconds >= 60:
+        return f"{seconds / 60:.1f}m"
+    return f"{seconds:.0f}s"
+
+
+"""
+Desc: Refresh time which would have seen about 90% of the slots which were
+taken, i.e. the 10th percentile of their lifetimes. None without enough
+data.
+"""
+def suggest_refresh_time(
+    location_stats: SlotHistoryStats,
+    min_refresh_time: float = 10,
+) -> Optional[float]:
+    if len(location_stats.lifetimes) < 10:
+        return None
+    return max(min_refresh_time, _quantile(location_stats.lifetimes, 0.1))
+
+
+def format_report(
+    location_stats: SlotHistoryStats,
+    name: str = "",
+) -> str:
+    days = (location_stats.lastSeen - location_stats.firstSeen) / (24 * 3600)
+    releases = sum(location_stats.releasesByHour)
+    lines = [
+        f"{location_stats.locationId} {name}".rstrip(),
+        f"  {sum(location_stats.slotsByHour)} new slots in {releases} "
+        f"releases over {days:.1f} days",
+    ]
+    if releases:
+        lines.append("  Releases by hour:")
+        peak = max(location_stats.releasesByHour)
+        for hour, count in enumerate(location_stats.releasesByHour):
+            if count:
+                bar = "#" * max(1, round(40 * count / peak))
+                lines.append(
+                    f"    {hour:02d}:00  {bar} {count} "
+                    f"({location_stats.slotsByHour[hour]} slots)"
+                )
+        lines.append("  Releases by weekday: " + ", ".join(
+            f"{weekday} {count}" for weekday, count in zip(
+                _WEEKDAYS, location_stats.releasesByWeekday
+            )
+        ))
+    lifetimes = location_stats.lifetimes
+    if lifetimes:
+        lines.append(
+            f"  Slots taken after: median "
+            f"{_fmt_seconds(_quantile(lifetimes, 0.5))}, p10 "
+            f"{_fmt_seconds(_quantile(lifetimes, 0.1))}, p90 "
+            f"{_fmt_seconds(_quantile(lifetimes, 0.9))} "
+            f"({len(lifetimes)} slots)"
+        )
+    lines.append(
+        f"  {location_stats.expired} slots expired unbooked, "
+        f"{location_stats.stillAvailable} still available"
+    )
+    refresh_time = suggest_refresh_time(location_stats)
+    if refresh_time is not None:
+        lines.append(
+            f"  Suggested refreshTime: \"{refresh_time:.0f}s\" "
+            "(sees ~90% of the slots which were taken)"
+        )
+    return "\n".join(lines)
+
+
+# Maps locationIds to names, from whichever catalogs are available
+def _location_names() -> Dict[int, Tuple[str, ...]]:
+    from scanner_constants import (
+        LOCATIONS_CACHE_PATHS,
+        RAW_LOCATIONS_PATHS,
+        SELECTED_TTPS,
+    )
+    from scanner_locations import get_catalog
+
+    names: Dict[int, Tuple[str, ...]] = {}
+    for program in SELECTED_TTPS:
+        if not os.path.isfile(LOCATIONS_CACHE_PATHS[program]) and (
+            not os.path.isfile(RAW_LOCATIONS_PATHS[program])
+        ):
+            continue
+        for location in get_catalog(program):
+            names[location.locationId] = (
+                location.name, location.shortName, location.city
+            )
+    return names
+
+
+# Resolves --location values, which are locationIds or parts of a name
+def _resolve_location_ids(
+    queries: List[str],
+    names: Dict[int, Tuple[str, ...]],
+) -> Set[int]:
+    location_ids = set()
+    for query in queries:
+        if query.isdigit():
+            location_ids.add(int(query))
+            continue
+        matches = {
+            locationId
+            for locationId, location_names in names.items()
+            if any(query.lower() in name.lower() for name in location_names)
+        }
+        if not matches:
+            raise ValueError(f"No location matches {query!r}")
+        location_ids |= matches
+    return location_ids
+
+
+if __name__ == "__main__":
+    import argparse
+    import dataclasses
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="Reports on the recorded slot history"
+    )
+    parser.add_argument(
+        "--location",
+        action="append",
+        default=[],
+        help="locationId or part of a location name, can be repeated "
+        "(default: every location)",
+    )
+    parser.add_argument(
+        "--days", type=float, default=30, help="Only the last N days"
+    )
+    parser.add_argument(
+        "--utc",
+        action="store_true",
+        help="Hours and weekdays in UTC instead of local time",
+    )
+    parser.add_argument("--dir", default=SLOT_HISTORY_DIR)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    names = _location_names()
+    location_ids = None
+    if args.location:
+        try:
+            location_ids = _resolve_location_ids(args.location, names)
+        except ValueError as e:
+            sys.exit(str(e))
+    stats = analyze(
+        read_history(
+            args.dir,
+            since=time.time() - args.days * 24 * 60 * 60,
+            location_ids=location_ids,
+        ),
+        tz=timezone.utc if args.utc else None,
+    )
+    if args.json:
+        json.dump(
+            {
+                locationId: {
+                    **dataclasses.asdict(location_stats),
+                    "suggestedRefreshTime": suggest_refresh_time(
+                        location_stats
+                    ),
+                }
+                for locationId, location_stats in sorted(stats.items())
+            },
+            sys.stdout,
+            indent=4,
+        )
+        print()
+    elif not stats:
+        print(f"No slot history in {args.dir}")
+    else:
+        for locationId, location_stats in sorted(stats.items()):
+            name = names.get(locationId, ("",))[0]
+            print(format_report(location_stats, name) + "\n")
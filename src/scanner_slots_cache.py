@@ -0,0 +1,100 @@
+"""
+scanner_slots_cache.py
+user: vhao
+date: 10-17-2026
+
+Remembers a fingerprint of the last /slots response for each location so
+that polls which return the same data as last time can skip JSON decoding,
+filtering and notify() entirely.
+
+The fingerprint is the response's ETag/Last-Modified when the server sends
+them (which are also sent back as If-None-Match/If-Modified-Since so the
+server can answer with an empty 304), otherwise a hash of the body, or of
+the part of it which was decoded when the body was streamed (see
+scanner_slots_parser.py).
+"""
+
+from typing import Dict, Hashable, Optional
+
+import hashlib
+from dataclasses import dataclass
+from scanner_constants import SLOTS_CACHE_REPORT_EVERY
+from scanner_logger import getScannerLogger
+from scanner_types import HttpResponse
+
+
+logger = getScannerLogger(__name__)
+
+
+@dataclass
+class _Fingerprint:
+    etag: Optional[str]
+    lastModified: Optional[str]
+    digest: bytes
+
+
+class SlotsResponseCache:
+    def __init__(self, report_every: int = SLOTS_CACHE_REPORT_EVERY):
+        self._fingerprints: Dict[Hashable, _Fingerprint] = {}
+        self._report_every = report_every
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def conditional_headers(self, key: Hashable) -> Dict[str, str]:
+        fingerprint = self._fingerprints.get(key)
+        headers = {}
+        if fingerprint is not None:
+            if fingerprint.etag:
+                headers["If-None-Match"] = fingerprint.etag
+            if fingerprint.lastModified:
+                headers["If-Modified-Since"] = fingerprint.lastModified
+        return headers
+
+    def _fingerprint(self, res: HttpResponse) -> _Fingerprint:
+        return _Fingerprint(
+            etag=res.headers.get("etag"),
+            lastModified=res.headers.get("last-modified"),
+            digest=res.parsed.digest if res.parsed is not None else (
+                hashlib.blake2b(res.content, digest_size=16).digest()
+            ),
+        )
+
+    # Returns True if the response is the same as the last stored one
+    def is_unchanged(self, key: Hashable, res: HttpResponse) -> bool:
+        previous = self._fingerprints.get(key)
+        if previous is None:
+            unchanged = False
+        elif res.status_code == 304:
+            unchanged = True
+        else:
+            unchanged = self._fingerprint(res).digest == previous.digest
+
+        if unchanged:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if (self.hits + self.misses) % self._report_every == 0:
+            logger.info(
+                f"Slots cache: {self.hits} hits, {self.misses} misses, "
+                f"hit ratio {self.hit_ratio:.1%}"
+            )
+        return unchanged
+
+    """
+    Desc: Remembers the response once it has been fully processed, so that a
+    poll which failed halfway (e.g. notify raised) is processed again.
+    """
+    def store(self, key: Hashable, res: HttpResponse) -> None:
+        if res.status_code != 304:
+            self._fingerprints[key] = self._fingerprint(res)
+
+    def remove(self, key: Hashable) -> None:
+        self._fingerprints.pop(key, None)
+
+    def clear(self) -> None:
+        self._fingerprints.clear()
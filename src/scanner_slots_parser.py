@@ -0,0 +1,112 @@
+"""
+scanner_slots_parser.py
+user: vhao
+date: 10-17-2026
+
+Streaming decoder for /slots responses.
+
+The body is a JSON array of appointments ordered by startTimestamp
+(orderBy=soonest). Instead of buffering the whole body and decoding it with
+json.loads, SlotsStreamParser is fed the body as it is received and decodes
+one appointment at a time with JSONDecoder.raw_decode. Once an appointment
+starts after stop_after, nothing after it can match any subscriber, so the
+parser tells the transport to stop reading and the rest is never decoded.
+
+The parser also hashes the part of the body it decoded, which the slots
+response cache uses as the response's fingerprint. Changes past stop_after
+therefore do not count as changes.
+"""
+
+from typing import List, Optional
+
+import codecs
+import hashlib
+import json
+import re
+from scanner_transport import BodyParser
+
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Between appointments
+_SEPARATORS = re.compile(r"[ \t\n\r,]*")
+
+
+class SlotsStreamParser(BodyParser):
+    """
+    Args:
+        stop_after: Start time ("%Y-%m-%dT%H:%M") after which appointments
+                    are not needed, None to decode the whole body
+    """
+    def __init__(self, stop_after: Optional[str] = None):
+        self.stop_after = stop_after
+        # Appointments decoded so far
+        self.result: List[dict] = []
+        # Whether the body was cut short at stop_after
+        self.stopped_early = False
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._hash = hashlib.blake2b(digest_size=16)
+        # Undecoded text, starting at the next value
+        self._buffer = ""
+        self._started = False
+        self._done = False
+
+    @property
+    def digest(self) -> bytes:
+        return self._hash.digest()
+
+    def feed(self, chunk: bytes) -> bool:
+        if not self._done:
+            self._buffer += self._text_decoder.decode(chunk)
+            self._parse()
+        return self._done
+
+    def close(self) -> None:
+        if not self._done:
+            self._buffer += self._text_decoder.decode(b"", final=True)
+            self._parse()
+        if not self._done:
+            raise ValueError("/slots response ended in the middle of a value")
+
+    def _parse(self) -> None:
+        buffer = self._buffer
+        pos = _WHITESPACE.match(buffer).end()
+        if not self._started:
+            if pos == len(buffer):
+                return
+            if buffer[pos] != "[":
+                raise ValueError(f"Expected a JSON array, got {buffer[:20]!r}")
+            self._started = True
+            pos += 1
+        # Bound once, this loop runs for every appointment
+        scan_once = self._decoder.scan_once
+        skip = _SEPARATORS.match
+        append = self.result.append
+        stop_after = self.stop_after
+        length = len(buffer)
+        while True:
+            pos = skip(buffer, pos).end()
+            if pos == length:
+                break
+            if buffer[pos] == "]":
+                self._done = True
+                break
+            try:
+                appointment, end = scan_once(buffer, pos)
+            except (StopIteration, json.JSONDecodeError):
+                # The rest of the value has not been received yet
+                break
+            if stop_after is not None and (
+                appointment["startTimestamp"][:16] > stop_after
+            ):
+                self.stopped_early = True
+                self._done = True
+                break
+            append(appointment)
+            pos = end
+        # Hashing all the text consumed at once is much cheaper than hashing
+        # each appointment, and gives the same digest however the body was
+        # split into chunks
+        self._hash.update(buffer[:pos].encode())
+        # Only the incomplete value is kept around
+        self._buffer = "" if self._done else buffer[pos:]
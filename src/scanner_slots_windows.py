@@ -0,0 +1,158 @@
+"""
+scanner_slots_windows.py
+user: vhao
+date: 10-17-2026
+
+Windowed /slots fetching (SLOTS_FETCH = "windowed" in scanner_constants.py).
+
+/schedulerapi/slots only returns the first "limit" slots of a location, so
+at a busy location the slots in a user's date range can be hidden behind
+earlier ones. The scheduler also answers date-bounded queries:
+    /schedulerapi/locations/{locationId}/slots
+        ?startTimestamp=2026-11-02T00:00:00&endTimestamp=2026-11-30T23:59:00
+which return every slot in the span. The spans a location needs come from
+the union of its subscribers' daily windows: one span per window, from its
+first day's start time to its last day's end time, clipped to today. Spans
+which overlap or are close are merged, and long ones are split so that no
+request covers more than SLOTS_WINDOW_MAX_DAYS. The spans are fetched
+concurrently, and the results are merged and deduplicated into the same
+shape /schedulerapi/slots returns.
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import hashlib
+from datetime import date, datetime, time, timedelta
+from scanner_constants import (
+    SLOTS_WINDOW_MAX_DAYS,
+    SLOTS_WINDOW_MERGE_GAP_DAYS,
+)
+from scanner_matcher import AppointmentMatcher
+
+
+Span = Tuple[datetime, datetime]
+
+_TIMESTAMP_FMT = "%Y-%m-%dT%H:%M:%S"
+
+
+# Derived from SCHEDULER_API so that a stub server is used for both
+def windowed_slots_url(scheduler_api: str, locationId: int) -> str:
+    base = scheduler_api.rstrip("/")
+    if base.endswith("/slots"):
+        base = base[:-len("/slots")]
+    return f"{base}/locations/{locationId}/slots"
+
+
+"""
+Desc: Returns the sorted, non overlapping spans of start times the matcher
+can match from today on.
+
+Args:
+    today:  Spans are clipped to a day before it, since the locations' time
+            zones can be behind ours
+"""
+def wanted_spans(
+    matcher: AppointmentMatcher,
+    today: Optional[date] = None,
+    max_days: int = SLOTS_WINDOW_MAX_DAYS,
+    merge_gap_days: int = SLOTS_WINDOW_MERGE_GAP_DAYS,
+) -> List[Span]:
+    first_day = (today or date.today()).toordinal() - 1
+    spans = []
+    for window in matcher.windows:
+        if window.lastDay < first_day:
+            continue
+        start_day = max(window.firstDay, first_day)
+        start_minute = 0
+        if start_day == window.firstDay:
+            start_minute = window.startMinute
+        spans.append((
+            datetime.combine(date.fromordinal(start_day), time())
+            + timedelta(minutes=start_minute),
+            datetime.combine(date.fromordinal(window.lastDay), time())
+            + timedelta(minutes=window.endMinute),
+        ))
+    spans.sort()
+
+    merged: List[Span] = []
+    gap = timedelta(days=merge_gap_days)
+    for start, end in spans:
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    split = []
+    max_span = timedelta(days=max_days)
+    for start, end in merged:
+        while end - start > max_span:
+            split.append((start, start + max_span))
+            start += max_span
+        split.append((start, end))
+    return split
+
+
+def span_params(span: Span) -> Dict[str, str]:
+    return {
+        "startTimestamp": span[0].strftime(_TIMESTAMP_FMT),
+        "endTimestamp": span[1].strftime(_TIMESTAMP_FMT),
+    }
+
+
+"""
+Desc: Converts an entry of a windowed response into a /schedulerapi/slots
+appointment, None if no appointment is left in the slot.
+"""
+def normalize_slot(
+    slot: Dict[str, Any],
+    locationId: int,
+) -> Optional[Dict[str, Any]]:
+    timestamp = slot.get("startTimestamp") or slot.get("timestamp")
+    # "active" is the number of open appointments in the slot here, and a
+    # bool in /schedulerapi/slots
+    if not timestamp or not slot.get("active", True):
+        return None
+    duration = slot.get("duration", 0)
+    return {
+        "locationId": locationId,
+        "startTimestamp": timestamp[:16],
+        "endTimestamp": slot.get("endTimestamp") or (
+            datetime.fromisoformat(timestamp[:16])
+            + timedelta(minutes=duration)
+        ).strftime("%Y-%m-%dT%H:%M"),
+        "active": True,
+        "duration": duration,
+        "remoteInd": slot.get("remoteInd", slot.get("remote", False)),
+    }
+
+
+# Merged windowed responses, in place of a streamed body's BodyParser
+class MergedSlots:
+    stopped_early = False
+
+    def __init__(self, result: List[Dict[str, Any]]):
+        self.result = result
+        self.digest = hashlib.blake2b(
+            "\n".join(
+                appointment["startTimestamp"] for appointment in result
+            ).encode(),
+            digest_size=16,
+        ).digest()
+
+
+# Merges the responses of the spans, sorted by start time like orderBy=soonest
+def merge_slots(
+    responses: Iterable[List[Dict[str, Any]]],
+    locationId: int,
+) -> MergedSlots:
+    appointments: Dict[str, Dict[str, Any]] = {}
+    for slots in responses:
+        for slot in slots:
+            appointment = normalize_slot(slot, locationId)
+            if appointment is not None:
+                appointments.setdefault(
+                    appointment["startTimestamp"], appointment
+                )
+    return MergedSlots([
+        appointments[timestamp] for timestamp in sorted(appointments)
+    ])
@@ -0,0 +1,504 @@
+"""
+scanner_storage.py
+user: vhao
+date: 10-17-2026
+
+Key-value storage for the scanner's persistent state, with one interface
+over local files, SQLite and S3 (see STORAGE_BACKEND in
+scanner_constants.py).
+
+Records are bytes stored under "/"-separated string keys, so that a reader
+only fetches the records it needs instead of loading and rewriting a whole
+file. Every backend supports:
+    - Batched writes. Writes made inside "with backend.batch():" are
+      buffered and applied together when the block exits, or dropped if it
+      raises. Nested batches act as savepoints: a nested batch which raises
+      only drops its own writes, and one which exits hands its writes to
+      the enclosing batch. SQLite applies them in a single transaction. The file backend
+      writes every file before replacing any of them, and S3 (which has no
+      transactions) at least only writes each record once per batch.
+    - A read-through LRU cache of the last STORAGE_CACHE_SIZE records read
+      or written, including records which do not exist. invalidate() drops
+      it when another process may have changed the records since.
+    - Expiring records. A record can be written with the (sortable, e.g.
+      "%Y-%m-%d %H:%M") time after which it is no longer needed. SQLite
+      indexes it, so delete_expired() is a single DELETE. The other
+      backends do not keep it (supports_expiry is False) and the caller has
+      to scan their records instead.
+"""
+
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import os
+import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import quote, unquote
+from scanner_constants import (
+    DEBUG_AWS_LAMBDA_LOCAL,
+    S3_BUCKET,
+    S3_PATH,
+    STORAGE_BACKEND,
+    STORAGE_CACHE_SIZE,
+    STORAGE_DB_PATH,
+    STORAGE_DIR,
+    USING_AWS_LAMBDA,
+)
+from scanner_logger import getScannerLogger
+
+
+logger = getScannerLogger(__name__)
+
+
+class _Record(NamedTuple):
+    value: bytes
+    expires: Optional[str]
+
+
+# Changes by key, None for deletions
+_Changes = Dict[str, Optional[_Record]]
+
+
+class StorageBackend:
+    # Whether records keep their expiry time, see delete_expired
+    supports_expiry: bool = False
+
+    def __init__(self, cache_size: int = STORAGE_CACHE_SIZE):
+        self._cache_size = cache_size
+        # Maps keys to their records, None for records which do not exist
+        self._cache: OrderedDict[str, Optional[bytes]] = OrderedDict()
+        # Writes buffered by each open batch, outermost first
+        self._levels: List[_Changes] = []
+
+    def get(self, key: str) -> Optional[bytes]:
+        for pending in reversed(self._levels):
+            if key in pending:
+                record = pending[key]
+                return record.value if record is not None else None
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        value = self._read(key)
+        self._remember(key, value)
+        return value
+
+    # Whether get() can return the record without reading the backend
+    def is_cached(self, key: str) -> bool:
+        return key in self._cache or any(
+            key in pending for pending in self._levels
+        )
+
+    """
+    Args:
+        expires:    Time after which delete_expired may delete the record,
+                    compared as a string
+    """
+    def put(
+        self,
+        key: str,
+        value: bytes,
+        expires: Optional[str] = None,
+    ) -> None:
+        self._change(key, _Record(value, expires))
+
+    def delete(self, key: str) -> None:
+        self._change(key, None)
+
+    # Returns the sorted keys starting with prefix, including pending writes
+    def keys(self, prefix: str = "") -> List[str]:
+        keys = set(self._list(prefix))
+        for key, record in self._pending_changes():
+            if not key.startswith(prefix):
+                continue
+            if record is None:
+                keys.discard(key)
+            else:
+                keys.add(key)
+        return sorted(keys)
+
+    """
+    Desc: Returns the sorted (key, record) pairs whose key starts with
+    prefix, including pending writes. Bypasses the cache, so that scanning
+    every record does not evict the ones being looked up.
+    """
+    def items(self, prefix: str = "") -> List[Tuple[str, bytes]]:
+        records = dict(self._items(prefix))
+        for key, record in self._pending_changes():
+            if not key.startswith(prefix):
+                continue
+            if record is None:
+                records.pop(key, None)
+            else:
+                records[key] = record.value
+        return sorted(records.items())
+
+    """
+    Desc: Deletes the records which expire before the given time, including
+    pending writes, and returns how many were deleted from the backend.
+    Only supported when supports_expiry is True.
+    """
+    def delete_expired(self, before: str) -> int:
+        if not self.supports_expiry:
+            logger.fatal(f"{type(self).__name__} does not keep expiry times")
+            raise RuntimeError("Storage backend does not support expiry")
+        for pending in self._levels:
+            for key, record in pending.items():
+                if record is not None and _expired(record, before):
+                    pending[key] = None
+        deleted = self._delete_expired(before)
+        # The deleted keys are not known
+        self.invalidate()
+        return deleted
+
+    def begin(self) -> None:
+        self._levels.append({})
+
+    # Hands the innermost batch's writes to the enclosing batch, or applies
+    # them when it is the outermost one
+    def commit(self) -> None:
+        if not self._levels:
+            logger.fatal("Storage batch committed without begin()")
+            raise RuntimeError("No storage batch to commit")
+        pending = self._levels.pop()
+        if self._levels:
+            self._levels[-1].update(pending)
+        elif pending:
+            self._apply(pending)
+
+    # Drops the innermost batch's writes, enclosing batches keep theirs
+    def rollback(self) -> None:
+        if not self._levels:
+            logger.fatal("Storage batch rolled back without begin()")
+            raise RuntimeError("No storage batch to roll back")
+        self._levels.pop()
+
+    @property
+    def in_batch(self) -> bool:
+        return bool(self._levels)
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        self.begin()
+        try:
+            yield
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def invalidate(self) -> None:
+        self._cache.clear()
+
+    def close(self) -> None:
+        pass
+
+    # Writes of every open batch, inner batches overriding outer ones
+    def _pending_changes(self) -> List[Tuple[str, Optional[_Record]]]:
+        changes: _Changes = {}
+        for pending in self._levels:
+            changes.update(pending)
+        return list(changes.items())
+
+    def _change(self, key: str, record: Optional[_Record]) -> None:
+        if self._levels:
+            self._levels[-1][key] = record
+        else:
+            self._apply({key: record})
+
+    def _apply(self, changes: _Changes) -> None:
+        try:
+            self._write(changes)
+        except BaseException:
+            # Some of the changes may have been written
+            for key in changes:
+                self._cache.pop(key, None)
+            raise
+        for key, record in changes.items():
+            self._remember(key, record.value if record is not None else None)
+
+    def _remember(self, key: str, value: Optional[bytes]) -> None:
+        if self._cache_size <= 0:
+            return
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def _read(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def _write(self, changes: _Changes) -> None:
+        raise NotImplementedError
+
+    def _delete_expired(self, before: str) -> int:
+        raise NotImplementedError
+
+    def _list(self, prefix: str) -> List[str]:
+        raise NotImplementedError
+
+    def _items(self, prefix: str) -> List[Tuple[str, bytes]]:
+        items = []
+        for key in self._list(prefix):
+            value = self._read(key)
+            if value is not None:
+                items.append((key, value))
+        return items
+
+
+def _expired(record: _Record, before: str) -> bool:
+    return record.expires is not None and record.expires < before
+
+
+# Quoting "." as well keeps "." and ".." out of paths, and ".tmp" suffixes
+# free for partially written files
+def _quote_part(part: str) -> str:
+    return quote(part, safe="").replace(".", "%2E")
+
+
+# One file per record, keys map to paths under root
+class FileStorageBackend(StorageBackend):
+    def __init__(self, root: str, cache_size: int = STORAGE_CACHE_SIZE):
+        super().__init__(cache_size)
+        self._root = root
+
+    def _path(self, key: str) -> str:
+        parts = key.split("/")
+        if "" in parts:
+            raise ValueError(f"Invalid storage key {key!r}")
+        return os.path.join(self._root, *map(_quote_part, parts))
+
+    def _read(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, changes: _Changes) -> None:
+        # Every file is written before any is replaced, so a crash while
+        # writing leaves the previous records untouched
+        replaced = []
+        try:
+            for key, record in changes.items():
+                if record is None:
+                    continue
+                path = self._path(key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".tmp", "wb") as f:
+                    f.write(record.value)
+                    f.flush()
+                    os.fsync(f.fileno())
+                replaced.append(path)
+        except BaseException:
+            for path in replaced:
+                try:
+                    os.remove(path + ".tmp")
+                except FileNotFoundError:
+                    pass
+            raise
+        for path in replaced:
+            os.replace(path + ".tmp", path)
+        for key, record in changes.items():
+            if record is None:
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+
+    def _list(self, prefix: str) -> List[str]:
+        keys = []
+        for dirpath, _, filenames in os.walk(self._root):
+            relpath = os.path.relpath(dirpath, self._root)
+            parts = [] if relpath == "." else relpath.split(os.path.sep)
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                key = "/".join(unquote(part) for part in parts + [filename])
+                if key.startswith(prefix):
+                    keys.append(key)
+        return keys
+
+
+"""
+Desc: Records of every namespace share one table, whose primary key doubles
+as the index for point lookups and prefix scans, and which is also indexed
+by expiry time. Several processes can use the database at once.
+"""
+class SqliteStorageBackend(StorageBackend):
+    supports_expiry = True
+
+    def __init__(
+        self,
+        namespace: str,
+        db_path: str = STORAGE_DB_PATH,
+        cache_size: int = STORAGE_CACHE_SIZE,
+    ):
+        super().__init__(cache_size)
+        self._namespace = namespace
+        self._db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._db_path), exist_ok=True)
+            # Autocommit, transactions are started explicitly. Backends are
+            # not thread safe, but callers holding their own lock may use
+            # them from executor threads.
+            conn = sqlite3.connect(
+                self._db_path, timeout=30, isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "namespace TEXT NOT NULL, "
+                "key TEXT NOT NULL, "
+                "value BLOB NOT NULL, "
+                "expires TEXT, "
+                "PRIMARY KEY (namespace, key)"
+                ") WITHOUT ROWID"
+            )
+            columns = [
+                row[1] for row in conn.execute("PRAGMA table_info(records)")
+            ]
+            if "expires" not in columns:
+                # Created before records could expire
+                conn.execute("ALTER TABLE records ADD COLUMN expires TEXT")
+            # For delete_expired()
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS records_expires "
+                "ON records (namespace, expires)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _read(self, key: str) -> Optional[bytes]:
+        row = self._connect().execute(
+            "SELECT value FROM records WHERE namespace = ? AND key = ?",
+            (self._namespace, key),
+        ).fetchone()
+        return row[0] if row else None
+
+    def _write(self, changes: _Changes) -> None:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO records (namespace, key, value, expires) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET "
+                "value = excluded.value, expires = excluded.expires",
+                [
+                    (self._namespace, key, record.value, record.expires)
+                    for key, record in changes.items() if record is not None
+                ],
+            )
+            conn.executemany(
+                "DELETE FROM records WHERE namespace = ? AND key = ?",
+                [
+                    (self._namespace, key)
+                    for key, record in changes.items() if record is None
+                ],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _list(self, prefix: str) -> List[str]:
+        # A range instead of LIKE so that the primary key is used
+        return [
+            key for key, in self._connect().execute(
+                "SELECT key FROM records WHERE namespace = ? "
+                "AND key >= ? AND key < ?",
+                (self._namespace, prefix, prefix + "\U0010ffff"),
+            )
+        ]
+
+    def _items(self, prefix: str) -> List[Tuple[str, bytes]]:
+        return self._connect().execute(
+            "SELECT key, value FROM records WHERE namespace = ? "
+            "AND key >= ? AND key < ?",
+            (self._namespace, prefix, prefix + "\U0010ffff"),
+        ).fetchall()
+
+    def _delete_expired(self, before: str) -> int:
+        with self._connect() as conn:
+            return conn.execute(
+                "DELETE FROM records WHERE namespace = ? AND expires < ?",
+                (self._namespace, before),
+            ).rowcount
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+# One object per record under S3_PATH/prefix
+class S3StorageBackend(StorageBackend):
+    def __init__(self, prefix: str, cache_size: int = STORAGE_CACHE_SIZE):
+        super().__init__(cache_size)
+        self._prefix = os.path.join(S3_PATH, prefix, "")
+
+    def _read(self, key: str) -> Optional[bytes]:
+        from scanner_lambdas_utils import get_s3_client
+        try:
+            res = get_s3_client().get_object(
+                Bucket=S3_BUCKET, Key=self._prefix + key
+            )
+        except Exception as e:
+            response = getattr(e, "response", None) or {}
+            if response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            logger.warning(f"Unable to read {self._prefix + key} from S3")
+            raise e
+        return res["Body"].read()
+
+    def _write(self, changes: _Changes) -> None:
+        from scanner_lambdas_utils import get_s3_client
+        s3_client = get_s3_client()
+        for key, record in changes.items():
+            if record is None:
+                s3_client.delete_object(
+                    Bucket=S3_BUCKET, Key=self._prefix + key
+                )
+            else:
+                s3_client.put_object(
+                    Bucket=S3_BUCKET, Key=self._prefix + key,
+                    Body=record.value,
+                )
+
+    def _list(self, prefix: str) -> List[str]:
+        from scanner_lambdas_utils import get_s3_client
+        paginator = get_s3_client().get_paginator("list_objects_v2")
+        keys = []
+        for page in paginator.paginate(
+            Bucket=S3_BUCKET, Prefix=self._prefix + prefix
+        ):
+            for obj in page.get("Contents", ()):
+                keys.append(obj["Key"][len(self._prefix):])
+        return keys
+
+
+"""
+Args:
+    namespace:  Kind of records stored, e.g. "seen". Namespaces never share
+                keys.
+"""
+def create_storage_backend(
+    namespace: str,
+    backend: str = STORAGE_BACKEND,
+) -> StorageBackend:
+    if not backend:
+        on_lambda = USING_AWS_LAMBDA and not DEBUG_AWS_LAMBDA_LOCAL
+        backend = "s3" if on_lambda else "file"
+    if backend == "file":
+        return FileStorageBackend(os.path.join(STORAGE_DIR, namespace))
+    if backend == "sqlite":
+        return SqliteStorageBackend(namespace)
+    if backend == "s3":
+        return S3StorageBackend(namespace)
+    logger.fatal(f"Unknown STORAGE_BACKEND {backend!r}")
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}")
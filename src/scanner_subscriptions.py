@@ -0,0 +1,145 @@
+"""
+scanner_subscriptions.py
+user: vhao
+date: 10-17-2026
+
+Groups every user's LocationOptions by locationId so that each distinct
+location is polled only once, no matter how many users watch it.
+
+Locations are shared between Trusted Traveler Programs (the same enrollment
+center offers e.g. both Global Entry and NEXUS interviews) and /slots does
+not depend on the program, so a location watched for several programs is
+still polled once.
+
+Each LocationSubscribers keeps a union of all of its subscribers' daily
+windows. A slot is parsed once and checked against the union first, and only
+slots which match the union are checked against each subscriber's matcher.
+
+When the config is reloaded, retarget swaps in the location's new
+subscriptions in place, so its scanner keeps running.
+"""
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from collections import defaultdict
+from scanner_matcher import AppointmentMatcher, parse_timestamp
+from scanner_types import (
+    AdaptiveRefreshOptions,
+    Subscription,
+    UserOptions,
+)
+
+
+def _union(subscriptions: Iterable[Subscription]) -> AppointmentMatcher:
+    return AppointmentMatcher(
+        window
+        for subscription in subscriptions
+        for window in subscription.locationOptions.matcher.windows
+    )
+
+
+# "" when nothing can match, which sorts before every start time
+def _last_wanted(union: AppointmentMatcher) -> str:
+    latest = union.latest
+    return latest.strftime("%Y-%m-%dT%H:%M") if latest else ""
+
+
+def _match_key(subscriptions: Iterable[Subscription]) -> List[tuple]:
+    return [
+        (
+            subscription.userOptions.userId,
+            subscription.locationOptions.program,
+            subscription.locationOptions.matcher.windows,
+        )
+        for subscription in subscriptions
+    ]
+
+
+class LocationSubscribers:
+    def __init__(self, locationId: int, subscriptions: List[Subscription]):
+        self.locationId = locationId
+        self.subscriptions = subscriptions
+        self.name = subscriptions[0].locationOptions.name
+        self.union = _union(subscriptions)
+        # Latest start time ("%Y-%m-%dT%H:%M") any subscriber wants
+        self.lastWanted = _last_wanted(self.union)
+
+    """
+    Desc: Replaces the subscriptions, e.g. after the config was reloaded.
+    The union is only rebuilt when some subscriber's windows changed.
+    Returns whether what gets matched (windows, users or programs) changed.
+    """
+    def retarget(self, subscriptions: List[Subscription]) -> bool:
+        changed = _match_key(subscriptions) != _match_key(self.subscriptions)
+        self.subscriptions = subscriptions
+        self.name = subscriptions[0].locationOptions.name
+        if changed:
+            self.union = _union(subscriptions)
+            self.lastWanted = _last_wanted(self.union)
+        return changed
+
+    # Polls as often as the most demanding subscriber asks for
+    @property
+    def refreshTime(self) -> float:
+        return min(
+            subscription.userOptions.refreshTime
+            for subscription in self.subscriptions
+        )
+
+    @property
+    def programs(self) -> List[str]:
+        return sorted({
+            subscription.locationOptions.program
+            for subscription in self.subscriptions
+        })
+
+    @property
+    def adaptiveRefresh(self) -> Optional[AdaptiveRefreshOptions]:
+        for subscription in self.subscriptions:
+            if subscription.userOptions.adaptiveRefresh is not None:
+                return subscription.userOptions.adaptiveRefresh
+        return None
+
+    """
+    Desc: Returns each subscription together with the start times (formatted
+    as "%Y-%m-%d %H:%M") of the appointments matching it. Subscriptions
+    without any matches are left out.
+    """
+    def match(
+        self,
+        appointments: Iterable[dict],
+    ) -> List[Tuple[Subscription, Set[str]]]:
+        matches: Dict[int, Set[str]] = defaultdict(set)
+        single = len(self.subscriptions) == 1
+        for appointment in appointments:
+            timestamp = appointment["startTimestamp"]
+            day, minute = parse_timestamp(timestamp)
+            if not self.union.matches_parsed(day, minute):
+                continue
+            formatted = timestamp[:16].replace("T", " ")
+            if single:
+                matches[0].add(formatted)
+                continue
+            for i, subscription in enumerate(self.subscriptions):
+                matcher = subscription.locationOptions.matcher
+                if matcher.matches_parsed(day, minute):
+                    matches[i].add(formatted)
+        return [
+            (self.subscriptions[i], valid_appointments)
+            for i, valid_appointments in sorted(matches.items())
+        ]
+
+
+def build_location_index(
+    user_options_list: Iterable[UserOptions],
+) -> Dict[int, LocationSubscribers]:
+    subscriptions: Dict[int, List[Subscription]] = defaultdict(list)
+    for user_options in user_options_list:
+        for location_options in user_options.locationOptionsList:
+            subscriptions[location_options.locationId].append(
+                Subscription(user_options, location_options)
+            )
+    return {
+        locationId: LocationSubscribers(locationId, location_subscriptions)
+        for locationId, location_subscriptions in subscriptions.items()
+    }
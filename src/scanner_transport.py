@@ -0,0 +1,413 @@
+"""
+scanner_transport.py
+user: vhao
+date: 10-17-2026
+
+Pluggable HTTP transports used by send_request.
+
+AiohttpTransport is the default and talks to the TTP APIs natively on the
+event loop, reusing pooled keep-alive connections to ttp.cbp.dhs.gov.
+RequestsTransport keeps the original behaviour of running a blocking
+requests.Session in the default thread pool executor.
+
+Both transports cap the number of requests in flight, can stream the body
+of a response into a BodyParser instead of buffering it, and share the same
+retry strategy (RETRY_* in scanner_constants.py), jittered exponential
+backoff done with asyncio.sleep, and a circuit breaker per upstream host
+(BREAKER_* in scanner_constants.py). Any object implementing
+Transport.get can be passed to send_request, e.g. to point the scanner at a
+local stub server.
+"""
+
+from typing import Any, Callable, Dict, Optional
+
+import asyncio
+import functools
+import math
+import random
+import re
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from scanner_circuit_breaker import CircuitBreaker
+from scanner_constants import (
+    HTTP_TRANSPORT,
+    KEEPALIVE_TIMEOUT,
+    MAX_REQUESTS_IN_FLIGHT,
+    STREAM_CHUNK_SIZE,
+    STREAM_DRAIN_LIMIT,
+    REQUEST_TIMEOUT,
+    RETRY_BACKOFF_FACTOR,
+    RETRY_BACKOFF_MAX,
+    RETRY_STATUS_FORCELIST,
+    RETRY_TOTAL,
+)
+from scanner_logger import getScannerLogger
+from scanner_metrics import metrics
+from scanner_types import HttpResponse
+
+
+logger = getScannerLogger(__name__)
+
+
+# Upstream is struggling, the request may succeed if tried again later
+class TransientTransportError(Exception):
+    pass
+
+
+class MaxRetriesExceeded(TransientTransportError):
+    pass
+
+
+class CircuitOpen(TransientTransportError):
+    def __init__(self, host: str, retry_in: float):
+        super().__init__(
+            f"Circuit for {host} is open, retrying in {retry_in:.0f}s"
+        )
+        self.host = host
+        self.retry_in = retry_in
+
+
+# A single attempt failed to connect or timed out
+class TransportError(Exception):
+    pass
+
+
+"""
+Desc: Decodes a response body while it is being received. The transport
+feeds it the body of 200 responses chunk by chunk and stops reading once
+feed returns True, e.g. when the rest of the body is not needed.
+"""
+class BodyParser:
+    # Returns True when no more of the body is needed
+    def feed(self, chunk: bytes) -> bool:
+        raise NotImplementedError
+
+    # Called once the whole body was fed. Raises ValueError if it is invalid.
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+# Metrics are labelled by the URL's path, e.g. /schedulerapi/slots, with
+# ids left out so that each location does not get its own series
+def get_endpoint(url: str) -> str:
+    return re.sub(r"/\d+(?=/|$)", "/{id}", urlsplit(url).path)
+
+
+"""
+Desc: Seconds to sleep before the given retry. Uses "full jitter": a random
+time between 0 and backoff_factor * 2^(n-1) seconds, capped at
+RETRY_BACKOFF_MAX, so that scanners which failed together do not all retry
+together. A Retry-After header (seconds or an HTTP date) takes precedence,
+also capped at RETRY_BACKOFF_MAX.
+"""
+def get_backoff_time(
+    consecutive_errors: int,
+    retry_after: Optional[str] = None,
+) -> float:
+    if retry_after:
+        delay = parse_retry_after(retry_after)
+        if delay is not None:
+            return min(max(delay, 0), RETRY_BACKOFF_MAX)
+    return random.uniform(0, min(
+        RETRY_BACKOFF_MAX,
+        RETRY_BACKOFF_FACTOR * (2 ** (consecutive_errors - 1)),
+    ))
+
+
+# Seconds to wait from a Retry-After header, None if it is not valid
+def parse_retry_after(retry_after: str) -> Optional[float]:
+    try:
+        delay = float(retry_after)
+    except ValueError:
+        pass
+    else:
+        return delay if math.isfinite(delay) else None
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return (retry_at - datetime.now(timezone.utc)).total_seconds()
+
+
+class Transport:
+    def __init__(self, max_in_flight: int = MAX_REQUESTS_IN_FLIGHT):
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        # One breaker per upstream host
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get_breaker(self, url: str) -> CircuitBreaker:
+        host = urlsplit(url).netloc
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = self._breakers[host] = CircuitBreaker(host)
+        return breaker
+
+    """
+    Desc: GETs the url, retrying connection errors, timeouts and
+    RETRY_STATUS_FORCELIST responses up to RETRY_TOTAL times. The in flight
+    slot is only held during an attempt, never while backing off.
+    With body_parser, the body of a 200 response is streamed into a new
+    parser for each attempt, which is returned as the response's parsed.
+    Raises CircuitOpen without sending anything while the host's breaker is
+    open, and MaxRetriesExceeded once the retries run out.
+    """
+    async def get(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict] = None,
+        timeout: float = REQUEST_TIMEOUT,
+        body_parser: Optional[Callable[[], BodyParser]] = None,
+    ) -> HttpResponse:
+        endpoint = get_endpoint(url)
+        breaker = self.get_breaker(url)
+        # Identifies this request to the breaker
+        request = object()
+        if not breaker.allow(request):
+            raise CircuitOpen(breaker.name, breaker.retry_in)
+
+        recorded = False
+        start = time.monotonic()
+        attempt = 0
+        try:
+            while True:
+                retry_after = None
+                try:
+                    parser = body_parser() if body_parser else None
+                    async with self._in_flight:
+                        res = await self._get(
+                            url, params, headers, timeout, parser
+                        )
+                    if res.status_code not in RETRY_STATUS_FORCELIST:
+                        break
+                    reason = f"status code {res.status_code}"
+                    retry_after = res.headers.get("retry-after")
+                except TransportError as e:
+                    reason = str(e)
+
+                attempt += 1
+                if attempt > RETRY_TOTAL:
+                    breaker.record_failure()
+                    recorded = True
+                    metrics.inc(
+                        "ttp_retries_exhausted_total", endpoint=endpoint
+                    )
+                    raise MaxRetriesExceeded(
+                        f"Max retries exceeded for {url} ({reason})"
+                    )
+
+                backoff = get_backoff_time(attempt, retry_after)
+                metrics.inc("ttp_retries_total", endpoint=endpoint)
+                metrics.inc(
+                    "ttp_backoff_seconds_total", backoff, endpoint=endpoint
+                )
+                logger.debug(
+                    "Retrying %s in %.2f seconds after %s (attempt %d/%d)",
+                    url, backoff, reason, attempt, RETRY_TOTAL,
+                )
+                await asyncio.sleep(backoff)
+
+            if res.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            recorded = True
+        finally:
+            if not recorded:
+                breaker.abandon(request)
+
+        metrics.observe(
+            "ttp_request_seconds", time.monotonic() - start, endpoint=endpoint
+        )
+        metrics.inc(
+            "ttp_responses_total", endpoint=endpoint, status=res.status_code
+        )
+        return res
+
+    # Makes a single attempt, raising TransportError if it could not get a
+    # response at all
+    async def _get(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]],
+        headers: Optional[Dict],
+        timeout: float,
+        parser: Optional[BodyParser] = None,
+    ) -> HttpResponse:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+# Creates a Session. Retries are done by Transport.get, not urllib3, so that
+# backing off never ties up an executor thread.
+def create_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class RequestsTransport(Transport):
+    def __init__(self, max_in_flight: int = MAX_REQUESTS_IN_FLIGHT):
+        super().__init__(max_in_flight)
+        self._session = create_session()
+
+    # Runs in the executor, reading the body only as far as the parser needs
+    def _get_streamed(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]],
+        headers: Optional[Dict],
+        timeout: float,
+        parser: BodyParser,
+    ) -> HttpResponse:
+        res = self._session.get(
+            url, params=params, headers=headers, timeout=timeout, stream=True
+        )
+        try:
+            response = HttpResponse(
+                status_code=res.status_code,
+                headers={k.lower(): v for k, v in res.headers.items()},
+                content=b"",
+            )
+            if res.status_code != 200:
+                response.content = res.content
+                return response
+            stopped = False
+            drained = 0
+            for chunk in res.iter_content(STREAM_CHUNK_SIZE):
+                if not stopped:
+                    stopped = parser.feed(chunk)
+                    continue
+                # Reading the rest keeps the connection alive for the next
+                # request, unless there is a lot of it
+                drained += len(chunk)
+                if drained > STREAM_DRAIN_LIMIT:
+                    break
+            if not stopped:
+                parser.close()
+            response.parsed = parser
+            return response
+        finally:
+            # Drops the connection if the body was not read to the end
+            res.close()
+
+    async def _get(
+        self, url, params, headers, timeout, parser=None
+    ) -> HttpResponse:
+        import requests
+
+        loop = asyncio.get_running_loop()
+        try:
+            if parser is not None:
+                return await loop.run_in_executor(None, functools.partial(
+                    self._get_streamed, url, params, headers, timeout, parser
+                ))
+            res = await loop.run_in_executor(
+                None,
+                functools.partial(
+                    self._session.get,
+                    url,
+                    params=params,
+                    headers=headers,
+                    timeout=timeout,
+                )
+            )
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            raise TransportError(repr(e)) from e
+
+        return HttpResponse(
+            status_code=res.status_code,
+            headers={k.lower(): v for k, v in res.headers.items()},
+            content=res.content,
+        )
+
+    async def close(self) -> None:
+        self._session.close()
+
+
+class AiohttpTransport(Transport):
+    def __init__(self, max_in_flight: int = MAX_REQUESTS_IN_FLIGHT):
+        super().__init__(max_in_flight)
+        self._max_in_flight = max_in_flight
+        self._session = None
+
+    # The session must be created from within the running event loop
+    def _get_session(self):
+        import aiohttp
+
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._max_in_flight,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _get(
+        self, url, params, headers, timeout, parser=None
+    ) -> HttpResponse:
+        import aiohttp
+
+        session = self._get_session()
+        try:
+            async with session.get(
+                url,
+                params=params,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as res:
+                response = HttpResponse(
+                    status_code=res.status,
+                    headers={k.lower(): v for k, v in res.headers.items()},
+                    content=b"",
+                )
+                if parser is None or res.status != 200:
+                    response.content = await res.read()
+                    return response
+                stopped = False
+                drained = 0
+                async for chunk in res.content.iter_any():
+                    if not stopped:
+                        stopped = parser.feed(chunk)
+                        continue
+                    # Reading the rest keeps the connection alive for the
+                    # next request, unless there is a lot of it
+                    drained += len(chunk)
+                    if drained > STREAM_DRAIN_LIMIT:
+                        res.close()
+                        break
+                if not stopped:
+                    parser.close()
+                response.parsed = parser
+                return response
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise TransportError(repr(e)) from e
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+def create_transport(
+    kind: str = HTTP_TRANSPORT,
+    max_in_flight: int = MAX_REQUESTS_IN_FLIGHT,
+) -> Transport:
+    if kind == "aiohttp":
+        return AiohttpTransport(max_in_flight)
+    elif kind == "requests":
+        return RequestsTransport(max_in_flight)
+    raise ValueError(f"Unknown HTTP transport: {kind}")
@@ -6,10 +6,11 @@ date: 03-27-2022
 Types defined for use by scanner functions.
 """
 
-from typing import Dict, List, Tuple
+from typing import Any, Dict, List, Optional
 
-from dataclasses import dataclass
-from datetime import datetime
+import json
+from dataclasses import dataclass, field
+from scanner_matcher import AppointmentMatcher
 
 
 @dataclass
@@ -19,13 +20,33 @@ class TwilioOptions:
     auth: str
 
 
+@dataclass
+class EmailOptions:
+    # SMTP server used to send emails
+    host: str
+    port: int
+    username: str
+    password: str
+    useTls: bool
+    # From address, defaults to username
+    sender: str
+
+
 @dataclass
 class LocationOptions:
     locationId: int
     name: str
-    # Each date has an entry in dictionary as a string
-    # which then maps to the actual time range for that date
-    dateToTimeRanges: Dict[str, List[Tuple[datetime, datetime]]]
+    # Matches appointment start times against the user's date ranges
+    matcher: AppointmentMatcher
+    # Trusted Traveler Program the location was picked from
+    program: str = "Global Entry"
+
+
+@dataclass
+class AdaptiveRefreshOptions:
+    # Seconds
+    minRefreshTime: float
+    maxRefreshTime: float
 
 
 @dataclass
@@ -34,3 +55,91 @@ class UserOptions:
     phoneNumber: str
     twilioOptions: TwilioOptions
     locationOptionsList: List[LocationOptions]
+    emailOptions: Optional[EmailOptions] = None
+    # Only set in multi-user mode (see users.example.json)
+    userId: str = ""
+    # Seconds between polls of each location
+    refreshTime: float = 60
+    # Adapts each location's refresh time when set
+    adaptiveRefresh: Optional[AdaptiveRefreshOptions] = None
+
+
+@dataclass
+class Subscription:
+    userOptions: UserOptions
+    locationOptions: LocationOptions
+
+
+@dataclass
+class Finding:
+    locationId: int
+    locationName: str
+    # Sorted appointment start times formatted as "%Y-%m-%d %H:%M"
+    appointments: List[str]
+    userId: str = ""
+    program: str = "Global Entry"
+    # time.monotonic() when scan() first saw the earliest found appointment
+    foundAt: float = 0
+
+
+@dataclass
+class HttpResponse:
+    status_code: int
+    # Header names are lowercased by the transport
+    headers: Dict[str, str]
+    content: bytes
+    # The BodyParser the body was streamed into instead of content, see
+    # Transport.get
+    parsed: Any = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    def json(self) -> Any:
+        if self.parsed is not None:
+            return self.parsed.result
+        return json.loads(self.content)
+
+
+@dataclass
+class SchedulerMetrics:
+    locations: int
+    # Polls which are due but have not been dispatched yet
+    queueDepth: int
+    inFlight: int
+    dispatched: int
+    # Seconds between when a poll was due and when it was dispatched
+    lastLag: float
+    maxLag: float
+    meanLag: float
+
+
+# locationIds affected by a config reload
+@dataclass
+class ConfigDiff:
+    added: List[int] = field(default_factory=list)
+    removed: List[int] = field(default_factory=list)
+    # Windows, users or programs changed
+    retargeted: List[int] = field(default_factory=list)
+    # Refresh time or adaptive refresh settings changed
+    rescheduled: List[int] = field(default_factory=list)
+
+
+# What the slot history says about one location, see scanner_slot_history.py
+@dataclass
+class SlotHistoryStats:
+    locationId: int
+    # Polls which found new slots, and how many slots they found, by local
+    # hour of the day (0-23) and weekday (0 is Monday)
+    releasesByHour: List[int] = field(default_factory=lambda: [0] * 24)
+    slotsByHour: List[int] = field(default_factory=lambda: [0] * 24)
+    releasesByWeekday: List[int] = field(default_factory=lambda: [0] * 7)
+    # Seconds each slot stayed available before it was taken
+    lifetimes: List[float] = field(default_factory=list)
+    # Slots which disappeared because they were about to start
+    expired: int = 0
+    # Slots still available at the end of the history
+    stillAvailable: int = 0
+    firstSeen: float = 0
+    lastSeen: float = 0
@@ -9,208 +9,339 @@ critera are available.
 """
 
 
-from typing import Any, Dict, List, Optional, Set
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import asyncio
+import contextlib
 import copy
 import functools
 import json
 import os
-import requests
-import traceback
-import pandas as pd
-from collections import defaultdict
-from datetime import datetime
-from random import random
-from requests.adapters import HTTPAdapter, Retry
-from twilio.rest import Client as TwilioClient
-from urllib3.exceptions import MaxRetryError
+import re
+import time
+from urllib.parse import urlencode
 from scanner_constants import (
+    DEFAULT_REFRESH_TIME,
+    DEFAULT_TTP,
+    LAMBDA_FLUSH_MARGIN_MS,
+    LAMBDA_POLL_WINDOW,
+    LOOP_WATCHDOG,
+    POLL_REQUESTS_PER_SECOND,
     SCHEDULER_API,
     SCHEDULER_PARAMS,
-    SELECTED_TTP,
-    SELECTED_TTP_LINK,
-    DEBUG_AWS_LAMBDA_LOCAL, 
+    SELECTED_TTPS,
+    SLOT_HISTORY,
+    SLOTS_FETCH,
+    SLOTS_STREAM_PARSE,
     USING_AWS_LAMBDA,
-    PREV_SEEN_APPTS_PATH,
     USER_OPTIONS_PATH,
-    RAW_LOCATIONS_PATH,
-    LOCATIONS_PATH,
+    USER_OPTIONS_SNAPSHOT,
+    MULTI_USER_OPTIONS_PATH,
+    LOCATIONS_PATHS,
+)
+from scanner_locations import (
+    Location,
+    LocationCatalog,
+    get_catalog,
+    refresh_locations,
+    refresh_locations_periodically,
+)
+from scanner_logger import LazyFormat, getScannerLogger
+from scanner_matcher import AppointmentMatcher, compile_date_ranges
+from scanner_metrics import metrics, start_exporter
+from scanner_options_snapshot import (
+    file_digest,
+    load_snapshot,
+    save_snapshot,
+    snapshot_key,
+)
+from scanner_notifier import (
+    NotificationDispatcher,
+    SmtpEmailSender,
+    TwilioSmsSender,
+)
+from scanner_scheduler import AdaptiveInterval, PollScheduler
+from scanner_seen_store import (
+    SeenAppointmentStore,
+    create_seen_store,
+    seen_key,
+)
+from scanner_slot_history import SlotHistoryRecorder
+from scanner_slots_cache import SlotsResponseCache
+from scanner_slots_parser import SlotsStreamParser
+from scanner_slots_windows import (
+    merge_slots,
+    span_params,
+    wanted_spans,
+    windowed_slots_url,
+)
+from scanner_subscriptions import LocationSubscribers, build_location_index
+from scanner_transport import (
+    BodyParser,
+    Transport,
+    TransientTransportError,
+    create_transport,
 )
-from scanner_logger import getScannerLogger
 from scanner_types import (
+    AdaptiveRefreshOptions,
+    EmailOptions,
+    Finding,
+    HttpResponse,
     LocationOptions,
     TwilioOptions,
     UserOptions
 )
+from scanner_watchdog import LoopWatchdog, install_profiler_signal, profiler
 
 
 logger = getScannerLogger(__name__)
 
 
-# Maps locationIds to a list of appointment start times
-# formatted as datetime strings
-prev_seen_appts: Dict[str, List[str]] = defaultdict(list)
-twilio_client: Optional[TwilioClient] = None
+# Appointments the user has already been notified about
+seen_store: SeenAppointmentStore = create_seen_store()
+# Maps locationIds to the slot start times returned by the last poll, used to
+# tell whether a location's slots are changing
+last_polled_slots: Dict[int, FrozenSet[str]] = {}
+# Fingerprints of the last /slots response for each locationId
+slots_cache = SlotsResponseCache()
+# Looked up on every digest since lambda fan-out swaps seen_store
+notification_dispatcher = NotificationDispatcher(
+    batch=lambda: seen_store.batch()
+)
+# Maps seen_keys to when scan() first saw each not yet delivered appointment
+first_seen_at: Dict[str, Dict[str, float]] = {}
+# Records every change in the locations' slots, None when not recording
+slot_history: Optional[SlotHistoryRecorder] = (
+    SlotHistoryRecorder() if SLOT_HISTORY and not USING_AWS_LAMBDA else None
+)
 
 
-def pretty_fmt_req(req) -> str:
-    if req.headers.items():
+def pretty_fmt_req(
+    method: str,
+    url: str,
+    params: Optional[Dict[str, Any]] = None,
+    headers: Optional[Dict] = None,
+) -> str:
+    if params:
+        url = url + '?' + urlencode(params)
+    if headers:
         return ('{}\r\n{}'.format(
-            req.method + ' ' + req.url,
-            '\r\n'.join('{}: {}'.format(k, v) for k, v in req.headers.items()),
+            method + ' ' + url,
+            '\r\n'.join('{}: {}'.format(k, v) for k, v in headers.items()),
         ))
     else:
         return ('{}'.format(
-            req.method + ' ' + req.url,
+            method + ' ' + url,
         ))
 
 
-# Formats raw locations JSON into something user readable
-def pretty_fmt_locations(raw_locations: List[Dict]) -> str:
-    state_to_location = defaultdict(list)
-    for location in raw_locations:
-        state = location["state"]
-        state_to_location[state].append({
-            "name": location["name"],
-            "shortName": location["shortName"],
-            "locationId": location["id"],
-        })
-    return json.dumps(state_to_location, indent=4, sort_keys=True)
-
-
-# Populates prev_seen_appts from file.
-def get_prev_seen_appointments() -> None:
-    global prev_seen_appts
-    path = PREV_SEEN_APPTS_PATH
-    if USING_AWS_LAMBDA and not DEBUG_AWS_LAMBDA_LOCAL:
-        from scanner_lambdas_utils import lambda_read
-        try:
-            prev_seen_appts = defaultdict(list, json.loads(lambda_read(path)))
-            # Write it back to local in case we failed to retrieve 
-            # from local
-            put_prev_seen_appointments(writethrough=False)
-        except Exception as e:
-            # While not being able to read the file could cause spam,
-            # we have no way of knowing if this is the first time running
-            # the script or if the user has simply deleted the file.
-            logger.warning(
-                "Unable to load previously seen appointments from file. If this "
-                "is the first time running the lambda or if the file was deleted "
-                "on purpose, this warning can be safely ignored. Otherwise spam "
-                "may occur; please be careful."
-            )
+_DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 60 * 60}
+
+
+# Parses durations such as "30s", "1m", "2h" or a plain number of seconds
+def parse_duration(duration: Union[str, int, float]) -> float:
+    if isinstance(duration, (int, float)):
+        return float(duration)
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smh]?)\s*", duration)
+    if not match:
+        raise ValueError(
+            f"Invalid duration {duration!r}, expected something like "
+            "\"30s\", \"1m\" or \"2h\""
+        )
+    return float(match.group(1)) * _DURATION_UNITS[match.group(2)]
+
+
+def _get_catalogs() -> Dict[str, LocationCatalog]:
+    return {program: get_catalog(program) for program in SELECTED_TTPS}
+
+
+"""
+Desc: Resolves a "locations" entry to the locations it covers. Entries either
+name a single "locationId", every location in a "state", or every location
+"near" a point given as "latitude"/"longitude" (or as a "locationId") within
+"miles".
+"""
+def _resolve_locations(
+    user_loc_options: Dict[str, Any],
+    catalog: LocationCatalog,
+) -> List[Location]:
+    program = catalog.program
+    if "near" in user_loc_options:
+        near = user_loc_options["near"]
+        if "locationId" in near:
+            center = catalog.get(near["locationId"])
+            if center is None or center.latitude is None:
+                logger.fatal(
+                    f"Location {near['locationId']} is not a {program} "
+                    "location with known coordinates"
+                )
+                raise ValueError(
+                    f"Unknown {program} locationId {near['locationId']}"
+                )
+            latitude, longitude = center.latitude, center.longitude
+        else:
+            latitude, longitude = near["latitude"], near["longitude"]
+        locations = catalog.within(latitude, longitude, near["miles"])
+        description = f"within {near['miles']} miles"
+    elif "state" in user_loc_options:
+        locations = catalog.in_state(user_loc_options["state"])
+        description = f"in {user_loc_options['state']}"
     else:
-        try:
-            with open(path, "r") as f:
-                prev_seen_appts = defaultdict(list, json.load(f))
-        except Exception as e:
-            logger.warning(
-                "".join(traceback.format_exception(None, e, e.__traceback__))
+        locationId = user_loc_options["locationId"]
+        location = catalog.get(locationId)
+        if location is None:
+            logger.fatal(
+                f"Location {locationId} is not a {program} location, please "
+                f"check {LOCATIONS_PATHS[program]}"
             )
-            logger.warning("Unable to load previously seen appointments.")
+            raise ValueError(f"Unknown {program} locationId {locationId}")
+        return [location]
 
-    logger.debug(f"prev_seen_appts:\n{prev_seen_appts}")
+    if not locations:
+        logger.warning(f"No {program} locations found {description}")
+    else:
+        logger.info(
+            f"Found {len(locations)} {program} locations {description}: "
+            f"{[location.locationId for location in locations]}"
+        )
+    return locations
 
-""""
-Note: This MUST execute synchronously to prevent later updates
-to prev_seen_appts from being overwritten by an earlier update
-as we overwite the entire file instead of appending.
 
-Args:
-    locationId: location id
-    appointments: list of datetime strings to add to prev_seen_appts
-    writethrough: When using AWS Lambda, whether or not to write to S3 
 """
-def put_prev_seen_appointments(
-    locationId: int, 
-    appointments: List[str], 
-    writethrough: bool = True
-) -> None:
-    # Update global var
-    prev_seen_appts[str(locationId)].extend(appointments)
-
-    path = PREV_SEEN_APPTS_PATH
-    json_string = json.dumps(prev_seen_appts, indent=4, sort_keys=True)
-    if USING_AWS_LAMBDA and not DEBUG_AWS_LAMBDA_LOCAL:
-        from scanner_lambdas_utils import lambda_write
-        try:
-            lambda_write(path, json_string, writethrough=writethrough)
-        except Exception as e:
+Desc: Sets up the SMS/email senders from parsed user options. Users share the
+twilio*/smtp* settings. Only called once a whole config parsed, so that a
+config which is rejected never replaces the senders in use.
+"""
+def register_senders(user_options_list: List[UserOptions]) -> None:
+    if not user_options_list:
+        return
+    twilio_options = user_options_list[0].twilioOptions
+    email_options = user_options_list[0].emailOptions
+    if twilio_options.number and twilio_options.sid and twilio_options.auth:
+        notification_dispatcher.set_sender(TwilioSmsSender(twilio_options))
+    if email_options is not None:
+        notification_dispatcher.set_sender(SmtpEmailSender(email_options))
+
+
+# Parses the SMS/email sender settings from the twilio*/smtp* options
+def _parse_sender_options(
+    options_dict: Dict[str, Any],
+) -> Tuple[TwilioOptions, Optional[EmailOptions]]:
+    twilio_options = TwilioOptions(
+        options_dict.get("twilioNumber", ""),
+        options_dict.get("twilioSID", ""),
+        options_dict.get("twilioAuth", ""),
+    )
+    email_options = None
+    if options_dict.get("smtpHost"):
+        email_options = EmailOptions(
+            host=options_dict["smtpHost"],
+            port=int(options_dict.get("smtpPort", 587)),
+            username=options_dict.get("smtpUsername", ""),
+            password=options_dict.get("smtpPassword", ""),
+            useTls=options_dict.get("smtpUseTls", True),
+            sender=options_dict.get("emailFrom", ""),
+        )
+    return twilio_options, email_options
+
+
+def _parse_user_options(
+    user_options_dict: Dict[str, Any],
+    catalogs: Dict[str, LocationCatalog],
+    twilio_options: TwilioOptions,
+    email_options: Optional[EmailOptions],
+    userId: str = "",
+) -> UserOptions:
+    dtfmt = user_options_dict["dateTimeFormat"]
+    location_options_list: List[LocationOptions] = []
+    # Entries covering the same location are merged into one LocationOptions
+    location_options_by_id: Dict[Tuple[str, int], LocationOptions] = {}
+    # Parse LocationOptions
+    for user_loc_options in user_options_dict["locations"]:
+        program = user_loc_options.get(
+            "program", user_options_dict.get("program", DEFAULT_TTP)
+        )
+        if program not in catalogs:
             logger.fatal(
-                f"SERIOUS ISSUE: Unable to write previously seen appointments to "
-                "S3. This could cause a ton of spam. Please stop the lambda "
-                "trigger event ASAP."
+                f"Locations {user_loc_options} are for {program}, which is "
+                f"not one of the selected programs {SELECTED_TTPS}"
             )
-            raise e
-    else:
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "w") as f:
-            f.write(json_string)
+            raise ValueError(f"Program {program!r} is not selected")
+        matcher = compile_date_ranges(user_loc_options["dateRanges"], dtfmt)
+
+        catalog = catalogs[program]
+        for location in _resolve_locations(user_loc_options, catalog):
+            key = (program, location.locationId)
+            existing = location_options_by_id.get(key)
+            if existing is not None:
+                existing.matcher = AppointmentMatcher(
+                    existing.matcher.windows + matcher.windows
+                )
+                continue
+            location_options = LocationOptions(
+                location.locationId, location.name, matcher, program
+            )
+            location_options_by_id[key] = location_options
+            location_options_list.append(location_options)
 
+    refresh_time = parse_duration(
+        user_options_dict.get("refreshTime", DEFAULT_REFRESH_TIME)
+    )
+    adaptive_refresh = None
+    adaptive_dict = user_options_dict.get("adaptiveRefresh")
+    if adaptive_dict and adaptive_dict.get("enabled"):
+        adaptive_refresh = AdaptiveRefreshOptions(
+            minRefreshTime=parse_duration(
+                adaptive_dict.get("minRefreshTime", refresh_time)
+            ),
+            maxRefreshTime=parse_duration(
+                adaptive_dict.get("maxRefreshTime", refresh_time)
+            ),
+        )
 
-def get_user_options() -> UserOptions:
-    get_prev_seen_appointments()
+    return UserOptions(
+        email=user_options_dict.get("email", ""),
+        phoneNumber=user_options_dict.get("phoneNumber", ""),
+        twilioOptions=twilio_options,
+        locationOptionsList=location_options_list,
+        emailOptions=email_options,
+        refreshTime=refresh_time,
+        adaptiveRefresh=adaptive_refresh,
+        userId=userId,
+    )
+
+
+"""
+Args:
+    load_seen:  Also load previously seen appointments, only needed on start
+"""
+def get_user_options(load_seen: bool = True) -> UserOptions:
+    if load_seen:
+        seen_store.load()
 
     user_options_dict = None
     with open(USER_OPTIONS_PATH, "r") as f:
         user_options_dict = json.load(f)
 
-    locationid_to_name = {}
-    with open(LOCATIONS_PATH, "r") as f:
-        locations_dict = json.load(f)
-        for _, locations in locations_dict.items():
-            for location in locations:
-                locationId = location["locationId"]
-                locationName = location["name"]
-                locationid_to_name[locationId] = locationName
+    catalogs = _get_catalogs()
 
     if user_options_dict:
-
-        dtfmt = user_options_dict["dateTimeFormat"]
-        location_options_list: List[LocationOptions] = []
-        # Parse LocationOptions
-        for user_loc_options in user_options_dict["locations"]:
-            locationId = user_loc_options["locationId"]
-            locationName = locationid_to_name[locationId]
-            dateToTimeRanges = defaultdict(list)
-            for user_date_range in user_loc_options["dateRanges"]:
-                startDate = user_date_range["startDate"]
-                endDate = user_date_range["endDate"]
-                dailyStartTime = user_date_range["dailyStartTime"]
-                dailyEndTime = user_date_range["dailyEndTime"]
-
-                date_range = pd.date_range(start=startDate, end=endDate)
-                for date in date_range:
-                    date_str = date.strftime("%Y-%m-%d")
-                    start_time = datetime.strptime(
-                        date_str + " " + dailyStartTime, dtfmt)
-                    end_time = datetime.strptime(
-                        date_str + " " + dailyEndTime, dtfmt)
-                    time_range = (start_time, end_time)
-                    dateToTimeRanges[date_str].append(time_range)
-
-            location_options_list.append(
-                LocationOptions(locationId, locationName, dateToTimeRanges))
-
-        email = user_options_dict["email"]
-        phone_number = user_options_dict["phoneNumber"]
-        twilio_options = TwilioOptions(
-            user_options_dict["twilioNumber"],
-            user_options_dict["twilioSID"],
-            user_options_dict["twilioAuth"],
-        )
-        if twilio_options.number and twilio_options.sid and twilio_options.auth:
-            global twilio_client
-            twilio_client = TwilioClient(
-                twilio_options.sid, twilio_options.auth
-            )
-
-        user_options = UserOptions(
-            email=email,
-            phoneNumber=phone_number,
-            twilioOptions=twilio_options,
-            locationOptionsList=location_options_list,
+        twilio_options, email_options = _parse_sender_options(user_options_dict)
+        user_options = _parse_user_options(
+            user_options_dict,
+            catalogs,
+            twilio_options,
+            email_options,
         )
         logger.debug(f"Got the following user options:\n{user_options}")
         return user_options
@@ -222,82 +353,124 @@ def get_user_options() -> UserOptions:
         exit(1)
 
 
-# Gets TTP locations and writes to file
-def get_locations() -> None:
-    if not os.path.isfile(LOCATIONS_PATH):
-        logger.info(
-            f"{LOCATIONS_PATH} not found, regenerating locations from "
-            "raw locations..."
-        )
+"""
+Desc: Loads every user from users.json in multi-user mode. Settings outside
+of "users" (dateTimeFormat, refreshTime, twilio*, smtp*, ...) are shared by
+all users, and can be overridden per user except for twilio*/smtp*.
+"""
+def get_multi_user_options(load_seen: bool = True) -> List[UserOptions]:
+    if load_seen:
+        seen_store.load()
 
-        if not os.path.isfile(RAW_LOCATIONS_PATH):
-            logger.info(f"{RAW_LOCATIONS_PATH} not found, getting raw "
-            "locations from TTP website")
-            try:
-                res = requests.get(SELECTED_TTP_LINK)
-                os.makedirs(os.path.dirname(RAW_LOCATIONS_PATH), exist_ok=True)
-                with open(RAW_LOCATIONS_PATH, "w") as f:
-                    json.dump(res.json(), f, indent=4, sort_keys=True)
-            except Exception as e:
-                logger.fatal(
-                    "Failed to get raw locations list, if this continues "
-                    "to occur, please try to retrieve them manually"
-                )
-                raise e
+    with open(MULTI_USER_OPTIONS_PATH, "r") as f:
+        multi_user_dict = json.load(f)
+
+    user_options_list = parse_multi_user_options(multi_user_dict)
+    logger.info(
+        f"Loaded {len(user_options_list)} users from {MULTI_USER_OPTIONS_PATH}"
+    )
+    return user_options_list
+
+
+def parse_multi_user_options(
+    multi_user_dict: Dict[str, Any],
+) -> List[UserOptions]:
+    catalogs = _get_catalogs()
+    shared_dict = {
+        key: value for key, value in multi_user_dict.items() if key != "users"
+    }
+    twilio_options, email_options = _parse_sender_options(shared_dict)
+
+    user_options_list = []
+    for user_dict in multi_user_dict["users"]:
+        user_options_list.append(_parse_user_options(
+            {**shared_dict, **user_dict},
+            catalogs,
+            twilio_options,
+            email_options,
+            userId=str(user_dict["userId"]),
+        ))
+    return user_options_list
 
-        with open(RAW_LOCATIONS_PATH, "r") as f:
-            raw_locations = json.load(f)
 
-        os.makedirs(os.path.dirname(LOCATIONS_PATH), exist_ok=True)
-        with open(LOCATIONS_PATH, "w") as f:
-            f.write(pretty_fmt_locations(raw_locations))
+"""
+Desc: Parses the contents of either config file, multi-user mode when it has
+"users".
+"""
+def parse_all_user_options(options_dict: Dict[str, Any]) -> List[UserOptions]:
+    if "users" in options_dict:
+        return parse_multi_user_options(options_dict)
+    twilio_options, email_options = _parse_sender_options(options_dict)
+    return [_parse_user_options(
+        options_dict, _get_catalogs(), twilio_options, email_options
+    )]
 
 
-# Creates a Session with a given retry strategy
-def create_session() -> requests.Session:
-    retry_strategy = Retry(
-        total=3,
-        backoff_factor=5,
-        status_forcelist=[429, 500, 502, 503, 504],
-        method_whitelist=["GET"]
-    )
-    session = requests.Session()
-    session.mount('https://', HTTPAdapter(max_retries=retry_strategy))
-    return session
+"""
+Desc: Uses users.json (multi-user mode) if it exists, user_options.json
+otherwise. Loads the compiled user options from their snapshot when neither
+the config nor the location catalogs changed since it was saved. Sets up
+the SMS/email senders once the config parsed.
+"""
+def get_all_user_options(load_seen: bool = True) -> List[UserOptions]:
+    path = get_user_options_path()
+    if USER_OPTIONS_SNAPSHOT:
+        config_digest = file_digest(path)
+        user_options_list = load_snapshot(snapshot_key(path))
+        if user_options_list is not None:
+            if load_seen:
+                seen_store.load()
+            register_senders(user_options_list)
+            logger.info(
+                f"Loaded {len(user_options_list)} user(s) from the snapshot "
+                f"of {path}"
+            )
+            return user_options_list
+
+    if path == MULTI_USER_OPTIONS_PATH:
+        user_options_list = get_multi_user_options(load_seen)
+    else:
+        user_options_list = [get_user_options(load_seen)]
+    # Keyed by the files as they are after parsing, which may have rebuilt a
+    # catalog's pickle. Not saved if the config changed while we were
+    # parsing it, since we cannot tell which version was parsed.
+    if USER_OPTIONS_SNAPSHOT and file_digest(path) == config_digest:
+        save_snapshot(snapshot_key(path), user_options_list)
+    register_senders(user_options_list)
+    return user_options_list
+
+
+def get_user_options_path() -> str:
+    if os.path.isfile(MULTI_USER_OPTIONS_PATH):
+        return MULTI_USER_OPTIONS_PATH
+    return USER_OPTIONS_PATH
+
+
+# Gets the locations of every selected TTP, downloading them again once they
+# are older than LOCATIONS_CACHE_TTL
+def get_locations() -> None:
+    for program in SELECTED_TTPS:
+        refresh_locations(program)
 
 
 async def send_request(
     url: str,
     params: Optional[Dict[str, Any]] = None,
     headers: Optional[Dict] = None,
-    session: Optional[requests.Session] = None,
-) -> requests.Response:
-    if not session:
-        session = create_session()
-
-    prepared = requests.Request(
-        'GET', url, params=params, headers=headers).prepare()
-    pretty_request = pretty_fmt_req(prepared)
-    logger.debug(f"Sending request: {pretty_request}")
-
-    while True:
-        try:
-            loop = asyncio.get_event_loop()
-            res = await loop.run_in_executor(
-                None, functools.partial(session.send, prepared, timeout=5)
-            )
-            break
-        except MaxRetryError:
-            if USING_AWS_LAMBDA:
-                raise RuntimeError(
-                    "Max retries reached on AWS lambda, will NOT retry after sleep"
-                )
-
-            logger.warning(
-                "Maximum retries for this request reached, sleeping "
-                f"for 5 minutes ({pretty_request})"
-            )
-            await asyncio.sleep(5*60)
+    transport: Optional[Transport] = None,
+    body_parser: Optional[Callable[[], BodyParser]] = None,
+) -> HttpResponse:
+    if not transport:
+        transport = create_transport()
+
+    pretty_request = LazyFormat(pretty_fmt_req, 'GET', url, params, headers)
+    logger.debug("Sending request: %s", pretty_request)
+
+    # Transient failures (MaxRetriesExceeded, CircuitOpen) are left to the
+    # caller, the transport has already backed off without blocking anyone
+    res = await transport.get(
+        url, params=params, headers=headers, body_parser=body_parser
+    )
 
     if res.ok:
         return res
@@ -308,190 +481,448 @@ async def send_request(
             "site API has changed?")
         raise RuntimeError("Request failed with client error")
     elif res.status_code >= 500:
-        logger.fatal(
+        logger.error(
             f"Request failed with status code {res.status_code}. "
             "Server may be experiencing significant issues"
         )
-        raise RuntimeError("Request failed with non-retryable server error")
+        raise TransientTransportError(
+            f"Request failed with server error {res.status_code}"
+        )
 
 
+def _on_delivered(finding: Finding) -> None:
+    logger.debug(
+        f"Scanner {finding.locationId}: User was successfully notified by "
+        "at least one means. Will no longer notify for these times."
+    )
+    # Must writethrough since /tmp is ephemeral. On lambda the
+    # write to S3 is buffered and done once per invocation by
+    # flush_seen_appointments, so several locations finding
+    # appointments only cost a single PUT.
+    key = seen_key(finding.userId, finding.locationId)
+    seen_store.add(key, finding.appointments, writethrough=True)
+
+    if finding.foundAt:
+        metrics.observe(
+            "scanner_slot_to_notify_seconds",
+            time.monotonic() - finding.foundAt,
+        )
+    key_first_seen = first_seen_at.get(key)
+    if key_first_seen is not None:
+        for appointment in finding.appointments:
+            key_first_seen.pop(appointment, None)
+        if not key_first_seen:
+            del first_seen_at[key]
+
+
+def _on_failed(finding: Finding) -> None:
+    logger.warning(
+        f"Scanner {finding.locationId}: User was not notified in any way. "
+        "Please make sure your email or phone number and twilio/SMTP "
+        "information are set up properly."
+    )
+    # Make sure the next poll processes the appointments again even if
+    # the response has not changed
+    seen_store.release(
+        seen_key(finding.userId, finding.locationId), finding.appointments
+    )
+    slots_cache.remove(finding.locationId)
+
+
+"""
+Desc: Submits new appointments to the notification dispatcher. Does not wait
+for the notifications to be sent.
+"""
 async def notify(
     location_options: LocationOptions,
     user_options: UserOptions,
-    appointment_times: Set[datetime],
+    appointment_times: Set[str],
+    found_at: Optional[float] = None,
 ) -> None:
     locationId = location_options.locationId
     location_name = location_options.name
     email = user_options.email
     phone_number = user_options.phoneNumber
-    twilio_number = user_options.twilioOptions.number
 
-    new_appointments = appointment_times - \
-        set(prev_seen_appts[str(locationId)])
+    key = seen_key(user_options.userId, locationId)
+    # Skips the appointments already on their way to the user and, when
+    # sharded, the ones another process is notifying about already
+    new_appointments = await seen_store.claim_unseen(
+        key, appointment_times, notification_dispatcher.pending(key)
+    )
     sorted_appointments = list(new_appointments)
     sorted_appointments.sort()
     if sorted_appointments:
         logger.info(
-            f"Scanner {locationId}: Found new appointments for {location_name}! "
-            f"Appointment times: {sorted_appointments}."
+            "Scanner %s: Found new appointments for %s! Appointment times: "
+            "%s.", locationId, location_name, sorted_appointments
         )
 
-        at_least_one_success = False
+        # Appointments which failed to be delivered before keep the time
+        # they were first seen. Ones which are no longer available are
+        # forgotten.
+        key_first_seen = {
+            appointment: seen_at
+            for appointment, seen_at in first_seen_at.get(key, {}).items()
+            if appointment in appointment_times
+        }
+        first_seen_at[key] = key_first_seen
+        found_at = found_at or time.monotonic()
+        for appointment in sorted_appointments:
+            key_first_seen.setdefault(appointment, found_at)
+
+        recipients = []
         if email:
-            logger.info(
-                f"Scanner {locationId}: Sending email to {email} "
-                "to notify user..."
-            )
-            # TODO
-            at_least_one_success = True
+            recipients.append(("email", email))
+        if phone_number:
+            recipients.append(("sms", phone_number))
+        notification_dispatcher.submit(
+            Finding(
+                locationId,
+                location_name,
+                sorted_appointments,
+                userId=user_options.userId,
+                program=location_options.program,
+                foundAt=min(
+                    key_first_seen[appointment]
+                    for appointment in sorted_appointments
+                ),
+            ),
+            recipients,
+            on_delivered=_on_delivered,
+            on_failed=_on_failed,
+        )
+    else:
+        logger.info(
+            "Scanner %s: All appointments found have already been sent to "
+            "the user before. Will not notify again.", locationId,
+            extra={"sample_key": ("already_sent", key)},
+        )
 
-        if phone_number and twilio_client is not None:
-            logger.info(
-                f"Scanner {locationId}: Sending text to {phone_number} "
-                "to notify user..."
-            )
-            truncate = min(len(sorted_appointments), 3)
-            body = (
-                f"[{SELECTED_TTP} SCANNER]: Preferred appointment(s) available!\n"
-                f"Appointment Location: {location_name}\n"
-                f"Appointment Times: {sorted_appointments[:truncate]}"
-            )
-            if len(sorted_appointments) > truncate:
-                body += (
-                    f" as well as {len(sorted_appointments) - truncate} more! "
-                    f"To see all times, please check the {SELECTED_TTP} website."
-                )
 
-            message = twilio_client.messages.create(
-                body=body,
-                from_=twilio_number,
-                to=phone_number,
-            )
-            logger.debug(
-                f"Successfully sent text with message sid {message.sid}")
+"""
+Desc: Fetches the first SCHEDULER_PARAMS["limit"] slots of the location from
+/schedulerapi/slots.
+"""
+async def fetch_soonest_slots(
+    transport: Transport,
+    subscribers: LocationSubscribers,
+    scheduler_api: str = SCHEDULER_API,
+) -> HttpResponse:
+    locationId = subscribers.locationId
 
-            # We assume success since not using StatusCallback URL
-            at_least_one_success = True
+    # Set the locationId for the request
+    params = copy.deepcopy(SCHEDULER_PARAMS)
+    params["locationId"] = locationId
+    body_parser = None
+    # Only the soonest first order lets us stop at the last wanted time,
+    # otherwise json.loads on the whole body is faster
+    if SLOTS_STREAM_PARSE and params.get("orderBy") == "soonest":
+        body_parser = functools.partial(
+            SlotsStreamParser, subscribers.lastWanted
+        )
+    return await send_request(
+        scheduler_api,
+        params=params,
+        headers=slots_cache.conditional_headers(locationId),
+        transport=transport,
+        body_parser=body_parser,
+    )
 
-        if at_least_one_success:
-            logger.debug(
-                f"Scanner {locationId}: User was successfully notified by "
-                "at least one means. Will no longer notify for these times."
-            )
-            # Must writethrough since /tmp is ephemeral
-            # Since this only triggers upon user notif, and user notifs
-            # are grouped by region, it is pretty unlikely that we will
-            # exhaust the 2000 PUT requests/month limit for free tier.
-            put_prev_seen_appointments(
-                locationId, sorted_appointments, writethrough=True
-            )
-        else:
-            logger.warning(
-                f"Scanner {locationId}: User was not notified in any way. "
-                "Please make sure your email or phone number and twilio "
-                "information are set up properly."
-            )
+
+"""
+Desc: Fetches every slot in the date spans the location's subscribers want,
+one concurrent request per span, see scanner_slots_windows.py. The merged
+slots are returned as the response's parsed.
+"""
+async def fetch_windowed_slots(
+    transport: Transport,
+    subscribers: LocationSubscribers,
+    scheduler_api: str = SCHEDULER_API,
+) -> HttpResponse:
+    locationId = subscribers.locationId
+    url = windowed_slots_url(scheduler_api, locationId)
+    results = await asyncio.gather(
+        *(
+            send_request(url, params=span_params(span), transport=transport)
+            for span in wanted_spans(subscribers.union)
+        ),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return HttpResponse(
+        status_code=200,
+        headers={},
+        content=b"",
+        parsed=merge_slots((res.json() for res in results), locationId),
+    )
+
+
+# Returns whether the location's slots changed since the last poll
+async def scan_once(
+    transport: Transport,
+    subscribers: LocationSubscribers,
+    scheduler_api: str = SCHEDULER_API,
+) -> bool:
+    locationId = subscribers.locationId
+
+    logger.info(
+        "Scanner %s: Checking for appointments...", locationId,
+        extra={"sample_key": ("checking", locationId)},
+    )
+    if SLOTS_FETCH == "windowed":
+        res = await fetch_windowed_slots(transport, subscribers, scheduler_api)
+    elif SLOTS_FETCH == "soonest":
+        res = await fetch_soonest_slots(transport, subscribers, scheduler_api)
     else:
+        logger.fatal(f"Unknown SLOTS_FETCH {SLOTS_FETCH!r}")
+        raise ValueError(f"Unknown SLOTS_FETCH {SLOTS_FETCH!r}")
+    found_at = time.monotonic()
+    if res.parsed is not None and res.parsed.stopped_early:
+        metrics.inc("scanner_slots_stopped_early_total")
+    # Most polls return exactly what we saw last time, in which case there
+    # is nothing new to decode, filter or notify about
+    if slots_cache.is_unchanged(locationId, res):
         logger.info(
-            f"Scanner {locationId}: All appointments found have already "
-            "been sent to the user before. Will not notify again."
+            "Scanner %s: Available appointments unchanged since last check",
+            locationId, extra={"sample_key": ("unchanged", locationId)},
         )
+        return False
 
+    available_appointments = res.json()
+    logger.info(
+        "Scanner %s: Found %d available appointments", locationId,
+        len(available_appointments),
+        extra={"sample_key": ("available", locationId)},
+    )
 
+    slots = frozenset(
+        appointment["startTimestamp"] for appointment in available_appointments
+    )
+    previous_slots = last_polled_slots.get(locationId)
+    changed = previous_slots is not None and previous_slots != slots
+    last_polled_slots[locationId] = slots
+    if slot_history is not None:
+        slot_history.record(locationId, slots)
+
+    matches = subscribers.match(available_appointments)
+    for subscription, valid_appointments in matches:
+        await notify(
+            subscription.locationOptions,
+            subscription.userOptions,
+            valid_appointments,
+            found_at,
+        )
+    if not matches:
+        logger.info(
+            "Scanner %s: None of found appointments satisfy requirements",
+            locationId, extra={"sample_key": ("no_match", locationId)},
+        )
+    slots_cache.store(locationId, res)
+    return changed
+
+
+"""
+Desc: Polls a location once for all of its subscribers. Used as the
+PollScheduler callback, so returns whether the location should be polled
+again. Transient upstream failures just skip this poll; anything else is
+raised to the PollScheduler, which restarts the scanner after a backoff.
+"""
 async def scan(
-    session: requests.Session,
-    location_options: LocationOptions,
-    user_options: UserOptions,
-) -> None:
-    locationId = location_options.locationId
-    date_to_time_ranges = location_options.dateToTimeRanges
+    transport: Transport,
+    subscribers: LocationSubscribers,
+    interval: Optional[AdaptiveInterval] = None,
+    scheduler_api: str = SCHEDULER_API,
+) -> bool:
+    locationId = subscribers.locationId
+    try:
+        changed = await scan_once(transport, subscribers, scheduler_api)
+    except TransientTransportError as e:
+        logger.warning(
+            "Scanner %s: Upstream unavailable, skipping this poll (%s)",
+            locationId, str(e),
+            extra={"sample_key": ("transient", locationId)},
+        )
+        return not USING_AWS_LAMBDA
 
-    # Sleep a random amount to prevent stampeding the servers
-    # when script starts and also offsets each thread a slight
-    # amount when requesting again
-    max_sleeptime = 2 if USING_AWS_LAMBDA else 10
-    sleeptime: float = random() * max_sleeptime
-    logger.info(
-        f"Scanner {locationId}: Sleeping for {sleeptime} seconds "
-        "before starting..."
-    )
-    await asyncio.sleep(sleeptime)
-    
-    # Set the locationId for the request
-    params = copy.deepcopy(SCHEDULER_PARAMS)
-    params["locationId"] = locationId
+    if USING_AWS_LAMBDA:
+        logger.info("Scanner %s finished", locationId)
+        return False
 
-    # Continuously send requests until we get a non-retryable error
-    # or the script is stopped by user
-    while True:
-        try:
-            logger.info(f"Scanner {locationId}: Checking for appointments...")
-            res = await send_request(SCHEDULER_API, params=params, session=session)
-            available_appointments = res.json()
+    if interval is not None:
+        previous = interval.current
+        current = interval.update(changed)
+        if round(current) != round(previous):
             logger.info(
-                f"Scanner {locationId}: Found {len(available_appointments)} "
-                "available appointments"
+                "Scanner %s: Slots %s, refresh time %.0fs -> %.0fs",
+                locationId, "changed" if changed else "unchanged",
+                previous, current,
             )
+    return True
 
-            valid_appointments = set()
-            for appointment in available_appointments:
-                appt_start = appointment["startTimestamp"]
-                appt_start_dt = datetime.strptime(appt_start, "%Y-%m-%dT%H:%M")
-                date_str = appt_start_dt.strftime("%Y-%m-%d")
-
-                # Check if there are any timeranges for the given date
-                if date_str in date_to_time_ranges:
-                    for time_range in date_to_time_ranges[date_str]:
-                        if (
-                            appt_start_dt >= time_range[0] and
-                            appt_start_dt <= time_range[1]
-                        ):
-                            valid_appointments.add(
-                                appt_start_dt.strftime("%Y-%m-%d %H:%M")
-                            )
-
-            if valid_appointments:
-                await notify(location_options, user_options, valid_appointments)
-            else:
-                logger.info(
-                    f"Scanner {locationId}: None of found appointments satisfy "
-                    "requirements"
-                )
 
-            if USING_AWS_LAMBDA:
-                logger.info(f"Scanner {locationId} finished")
-                break
+def flush_seen_appointments() -> None:
+    seen_store.flush()
 
-            # Sleep 1 minute before checking again
-            delay = 60
-            logger.info(
-                f"Scanner {locationId}: Sleeping for {delay} seconds...")
-            await asyncio.sleep(delay)
-        except Exception as e:
-            logger.fatal(
-                "".join(traceback.format_exception(None, e, e.__traceback__))
-            )
-            logger.fatal(
-                f"Scanner for locationId: {locationId} encountered a "
-                "non-retryable error. Will NOT scan for this location "
-                "anymore. Please restart the script to scan for this "
-                "location again."
-            )
+
+"""
+Desc: Flushes buffered seen appointments once the lambda invocation is about
+to time out, so they are not lost if the invocation is killed.
+
+Args:
+    get_remaining_ms:   The lambda context's get_remaining_time_in_millis
+"""
+async def flush_before_deadline(get_remaining_ms: Callable[[], int]) -> None:
+    while True:
+        remaining = get_remaining_ms() - LAMBDA_FLUSH_MARGIN_MS
+        if remaining <= 0:
             break
+        await asyncio.sleep(min(remaining / 1000, 1))
+    logger.warning(
+        "Lambda invocation is about to time out, flushing previously seen "
+        "appointments"
+    )
+    flush_seen_appointments()
 
 
-async def launch_scanners(user_options: UserOptions):
-    location_options_list = user_options.locationOptionsList
-    scanner_tasks = []
-    session = create_session()
-    for location_options in location_options_list:
-        logger.info(
-            f"Launching scanner for locationId: {location_options.locationId}")
-        scanner_tasks.append(
-            asyncio.create_task(
-                scan(session, location_options, user_options)
-            )
+"""
+Desc: Registers the scanner for one location with the scheduler, replacing
+any scanner it already had for the location.
+"""
+def add_scanner(
+    scheduler: PollScheduler,
+    transport: Transport,
+    subscribers: LocationSubscribers,
+    scheduler_api: str = SCHEDULER_API,
+) -> None:
+    interval = None
+    adaptive_refresh = subscribers.adaptiveRefresh
+    if adaptive_refresh is not None:
+        interval = AdaptiveInterval(
+            subscribers.refreshTime,
+            adaptive_refresh.minRefreshTime,
+            adaptive_refresh.maxRefreshTime,
         )
+    scheduler.add(
+        subscribers.locationId,
+        functools.partial(
+            scan, transport, subscribers, interval, scheduler_api
+        ),
+        interval=interval or subscribers.refreshTime,
+    )
+
+
+# Forgets the per location state of a location which is no longer scanned
+# Makes the next poll process the location's slots even if unchanged, e.g.
+# after its subscriptions changed
+def reset_location(locationId: int) -> None:
+    last_polled_slots.pop(locationId, None)
+    slots_cache.remove(locationId)
+
 
-    await asyncio.gather(*scanner_tasks)
+# reset_location for every location
+def reset_locations() -> None:
+    last_polled_slots.clear()
+    slots_cache.clear()
+
+
+def forget_location(locationId: int) -> None:
+    reset_location(locationId)
+    if slot_history is not None:
+        slot_history.forget(locationId)
+
+
+"""
+Desc: Runs what the scanners need alongside them (notification workers,
+location refreshes, metrics exporter, slot history writes) for the duration
+of the block, then sends any pending digests and closes the transport unless
+told not to.
+"""
+@contextlib.asynccontextmanager
+async def scanner_services(
+    transport: Transport,
+    close_transport: bool = True,
+):
+    notification_dispatcher.start()
+    watchdog = LoopWatchdog() if LOOP_WATCHDOG else None
+    if watchdog is not None:
+        watchdog.start()
+    remove_profiler_signal = None
+    # Lambda's location files are static, and its metrics are emitted by
+    # lambda_handler
+    background_tasks = []
+    if not USING_AWS_LAMBDA:
+        remove_profiler_signal = install_profiler_signal()
+        background_tasks.append(asyncio.create_task(
+            refresh_locations_periodically(transport)
+        ))
+        exporter = start_exporter()
+        if exporter is not None:
+            background_tasks.append(exporter)
+        if slot_history is not None:
+            background_tasks.append(asyncio.create_task(
+                slot_history.flush_periodically()
+            ))
+    try:
+        yield
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        # Send anything still waiting in a digest before we stop
+        await notification_dispatcher.close()
+        flush_seen_appointments()
+        if close_transport:
+            await transport.close()
+        if remove_profiler_signal is not None:
+            remove_profiler_signal()
+            # Keep what was sampled so far
+            profiler.stop()
+        if watchdog is not None:
+            await watchdog.stop()
+
+
+"""
+Desc: Polls every distinct location once per refresh, no matter how many of
+the users watch it, and fans the results out to each subscriber.
+
+Args:
+    scheduler_api:          /slots endpoint, e.g. a local stub when load testing
+    transport:              Created when not given
+    requests_per_second:    Global request budget of the PollScheduler
+    close_transport:        False keeps the transport open afterwards, e.g.
+                            for the next invocation of a warm lambda
+"""
+async def launch_scanners(
+    user_options_list: List[UserOptions],
+    scheduler_api: str = SCHEDULER_API,
+    transport: Optional[Transport] = None,
+    requests_per_second: float = POLL_REQUESTS_PER_SECOND,
+    close_transport: bool = True,
+):
+    location_index = build_location_index(user_options_list)
+    logger.info(
+        f"Watching {len(location_index)} distinct locations for "
+        f"{len(user_options_list)} user(s)"
+    )
+    if transport is None:
+        transport = create_transport()
+    # Lambda is run again on its next schedule anyway
+    scheduler = PollScheduler(
+        requests_per_second, restart_failed=not USING_AWS_LAMBDA
+    )
+    for locationId, subscribers in location_index.items():
+        logger.info(
+            f"Launching scanner for locationId: {locationId} "
+            f"({', '.join(subscribers.programs)}, "
+            f"{len(subscribers.subscriptions)} subscriber(s))")
+        add_scanner(scheduler, transport, subscribers, scheduler_api)
+
+    # Polls are spread evenly across the refresh window instead of each
+    # scanner sleeping a random amount to prevent stampeding the servers
+    window = LAMBDA_POLL_WINDOW if USING_AWS_LAMBDA else None
+    async with scanner_services(transport, close_transport):
+        await scheduler.run(window=window)
     logger.info("All scanner tasks finished, stopping...")
@@ -0,0 +1,306 @@
+"""
+scanner_watchdog.py
+user: vhao
+date: 10-17-2026
+
+Event loop health checks and an on-demand sampling profiler.
+
+LoopWatchdog (LOOP_WATCHDOG in scanner_constants.py) runs a task which
+sleeps for LOOP_WATCHDOG_INTERVAL seconds at a time and records how late it
+wakes up as the loop's lag. A monitor thread watches the same deadline: when
+the loop has not woken the task LOOP_BLOCK_THRESHOLD seconds after it was
+due, something is running on the loop without yielding (a synchronous
+Twilio/SMTP call, pandas, a file write, ...), and the thread logs the task
+which is running along with the loop thread's stack. The watchdog also makes
+the loop's default executor an InstrumentedExecutor, so that the number of
+jobs waiting for a free thread can be reported.
+
+SamplingProfiler samples the stacks of every thread from a background
+thread and writes them as collapsed stacks ("outer;inner;leaf <count>"
+lines), which flamegraph.pl and speedscope read. It is toggled while the
+scanner runs with SIGUSR2, or POST /profile on the daemon's control API.
+"""
+
+from typing import Callable, Dict, Optional
+
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from scanner_constants import (
+    LOOP_BLOCK_THRESHOLD,
+    LOOP_WATCHDOG_INTERVAL,
+    PROFILER_DIR,
+    PROFILER_INTERVAL,
+)
+from scanner_logger import getScannerLogger
+from scanner_metrics import metrics
+
+
+logger = getScannerLogger(__name__)
+
+
+# Counts the jobs waiting for a thread and the ones running
+class InstrumentedExecutor(ThreadPoolExecutor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._counts_lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+
+    @property
+    def max_workers(self) -> int:
+        return self._max_workers
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        def run():
+            with self._counts_lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._counts_lock:
+                    self.active -= 1
+
+        with self._counts_lock:
+            self.queued += 1
+        try:
+            return super().submit(run)
+        except BaseException:
+            with self._counts_lock:
+                self.queued -= 1
+            raise
+
+
+class LoopWatchdog:
+    def __init__(
+        self,
+        interval: float = LOOP_WATCHDOG_INTERVAL,
+        block_threshold: float = LOOP_BLOCK_THRESHOLD,
+    ):
+        self._interval = interval
+        self._block_threshold = block_threshold
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._executor: Optional[InstrumentedExecutor] = None
+        # The loop's default executor before start(), None if it had none yet
+        self._previous_executor: Optional[Executor] = None
+        self._task: Optional[asyncio.Task] = None
+        self._monitor: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        # time.monotonic() by which the loop should wake the lag task
+        self._due = 0.0
+
+    # Must be called from the event loop's thread
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._executor = InstrumentedExecutor(
+            thread_name_prefix="scanner-executor"
+        )
+        self._previous_executor = getattr(
+            self._loop, "_default_executor", None
+        )
+        self._loop.set_default_executor(self._executor)
+        self._due = time.monotonic() + self._interval
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._measure_lag())
+        self._monitor = threading.Thread(
+            target=self._watch, name="scanner-watchdog", daemon=True
+        )
+        self._monitor.start()
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._monitor.join()
+        self._task = None
+        self._monitor = None
+        # Without one, asyncio would have created a plain ThreadPoolExecutor
+        # on first use. Jobs already submitted finish on the old threads.
+        self._loop.set_default_executor(
+            self._previous_executor or ThreadPoolExecutor()
+        )
+        await asyncio.to_thread(self._executor.shutdown, wait=True)
+        self._executor = None
+        self._previous_executor = None
+
+    async def _measure_lag(self) -> None:
+        while True:
+            self._due = time.monotonic() + self._interval
+            await asyncio.sleep(self._interval)
+            lag = max(time.monotonic() - self._due, 0)
+            metrics.observe("scanner_loop_lag_seconds", lag)
+            self._report_executor()
+
+    def _report_executor(self) -> None:
+        executor = self._executor
+        metrics.set("scanner_executor_queued", executor.queued)
+        metrics.set("scanner_executor_active", executor.active)
+        if executor.queued:
+            logger.warning(
+                "All %d executor threads are busy, %d job(s) waiting",
+                executor.max_workers, executor.queued,
+                extra={"sample_key": ("executor_saturated",)},
+            )
+
+    # Runs in the monitor thread
+    def _watch(self) -> None:
+        # The deadline which was last reported as blocked
+        reported_due = None
+        while not self._stopped.wait(self._block_threshold / 2):
+            due = self._due
+            blocked_for = time.monotonic() - due
+            if blocked_for < self._block_threshold or due == reported_due:
+                continue
+            reported_due = due
+            metrics.inc("scanner_loop_blocked_total")
+            logger.warning(
+                "Event loop blocked for %.3fs so far by %s:\n%s",
+                blocked_for, self._describe_running_task(),
+                self._format_loop_stack(),
+            )
+
+    def _describe_running_task(self) -> str:
+        try:
+            task = asyncio.current_task(self._loop)
+        except RuntimeError:
+            task = None
+        if task is None:
+            return "a callback outside of any task"
+        coro = task.get_coro()
+        name = getattr(coro, "__qualname__", repr(coro))
+        return f"task {task.get_name()!r} ({name})"
+
+    def _format_loop_stack(self) -> str:
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return ""
+        return "".join(traceback.format_stack(frame))
+
+
+# Thread names by thread id, for the root of each collapsed stack
+def _thread_names() -> Dict[int, str]:
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+
+class SamplingProfiler:
+    def __init__(
+        self,
+        interval: float = PROFILER_INTERVAL,
+        out_dir: str = PROFILER_DIR,
+    ):
+        self._interval = interval
+        self._out_dir = out_dir
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        # Maps collapsed stacks to how many samples they were seen in
+        self._stacks: Counter = Counter()
+        self._samples = 0
+        # Frame names by code object, formatting them dominates sampling
+        self._names: Dict[object, str] = {}
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stacks.clear()
+        self._samples = 0
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="scanner-profiler", daemon=True
+        )
+        self._thread.start()
+        logger.info(
+            "Profiler started, sampling every %.1fms", self._interval * 1000
+        )
+
+    # Returns the path the samples were written to
+    def stop(self) -> Optional[str]:
+        if not self.running:
+            return None
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        path = self._write()
+        logger.info("Profiler stopped, %d samples written to %s",
+                    self._samples, path)
+        return path
+
+    # Returns the path the samples were written to when stopping
+    def toggle(self) -> Optional[str]:
+        if self.running:
+            return self.stop()
+        self.start()
+        return None
+
+    def _run(self) -> None:
+        own_thread = threading.get_ident()
+        while not self._stopped.wait(self._interval):
+            names = _thread_names()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread:
+                    self._stacks[self._collapse(
+                        names.get(thread_id, str(thread_id)), frame
+                    )] += 1
+            self._samples += 1
+
+    def _collapse(self, thread_name: str, frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            name = self._names.get(code)
+            if name is None:
+                qualname = getattr(code, "co_qualname", code.co_name)
+                name = self._names[code] = (
+                    f"{qualname} ({os.path.basename(code.co_filename)}:"
+                    f"{code.co_firstlineno})"
+                ).replace(";", ":")
+            names.append(name)
+            frame = frame.f_back
+        names.append(thread_name.replace(";", ":"))
+        return ";".join(reversed(names))
+
+    def _write(self) -> str:
+        os.makedirs(self._out_dir, exist_ok=True)
+        path = os.path.join(
+            self._out_dir,
+            f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.folded",
+        )
+        with open(path, "w") as f:
+            for stack, count in sorted(self._stacks.items()):
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+profiler = SamplingProfiler()
+
+
+"""
+Desc: Toggles the profiler on SIGUSR2 until the returned function is
+called. Does nothing where signals cannot be handled by the loop (Windows,
+or not on the main thread).
+"""
+def install_profiler_signal() -> Callable[[], None]:
+    loop = asyncio.get_running_loop()
+    if not hasattr(signal, "SIGUSR2"):
+        return lambda: None
+    try:
+        loop.add_signal_handler(signal.SIGUSR2, profiler.toggle)
+    except (NotImplementedError, RuntimeError, ValueError):
+        return lambda: None
+    return lambda: loop.remove_signal_handler(signal.SIGUSR2)